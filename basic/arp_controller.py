@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import grpc
+import os
+import socket
+import struct
+import sys
+import time
+from collections import deque
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../utils/'))
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+import p4runtime_lib.helper
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.batch import DEFAULT_BATCH_SIZE, batchSizeArg
+from controller_lib.p4info_index import attachIndex
+from controller_lib.pipeline import PreparedPipeline, ensurePipelines, printPipelineStatus
+from controller_lib.reactive import DEFAULT_MAX_DELAY, CoalescingInstaller, LatencyRecorder
+from controller_lib.ruleset import compileRulesCached, installRuleSet
+from controller_lib.scheduler import WriteScheduler
+from controller_lib.stream import DEFAULT_QUEUE_SIZE, PacketIO, StreamDispatcher
+from controller_lib.topology import connectSwitches, loadTopology
+
+DEFAULT_CACHE_DIR = './build/rules-cache'
+TYPE_IPV4 = 0x0800
+TYPE_ARP = 0x0806
+ARP_REQUEST = 1
+ARP_REPLY = 2
+_ARP = struct.Struct('!HHBBH6s4s6s4s')
+
+
+def macBytes(mac):
+    return bytes(int(part, 16) for part in mac.split(':'))
+
+
+def ipv4Checksum(header):
+    total = sum(struct.unpack('!10H', header[:10] + b'\x00\x00' + header[12:20]))
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def arpReply(payload, host_mac):
+    """The reply to an ARP request payload, answered on behalf of host_mac."""
+    _, _, _, _, oper, sha, spa, _, tpa = _ARP.unpack_from(payload, 14)
+    if oper != ARP_REQUEST:
+        return None
+    return (sha + host_mac + struct.pack('!H', TYPE_ARP) +
+            _ARP.pack(1, TYPE_IPV4, 6, 4, ARP_REPLY, host_mac, tpa, sha, spa))
+
+
+def forwardPayload(payload, dst_mac):
+    """payload as ipv4_forward would have sent it (MACs, ttl, checksum)."""
+    packet = bytearray(payload)
+    packet[6:12] = payload[0:6]
+    packet[0:6] = dst_mac
+    packet[22] = (packet[22] - 1) & 0xff
+    packet[24:26] = struct.pack('!H', ipv4Checksum(bytes(packet[14:34])))
+    return bytes(packet)
+
+
+class Network(object):
+    """Hosts and next hops from the "hosts" and "links" topology sections."""
+
+    def __init__(self, topology):
+        self.switch_macs = dict((name, macBytes(settings['mac']))
+                                for name, settings in topology['switches'].items()
+                                if 'mac' in settings)
+        self.hosts = {}
+        for host in topology.get('hosts', {}).values():
+            self.hosts[socket.inet_aton(host['ip'])] = host
+        self.ports = {}
+        for link in topology.get('links', []):
+            self.ports.setdefault(link['a'], {})[link['b']] = link['a_port']
+            self.ports.setdefault(link['b'], {})[link['a']] = link['b_port']
+        self._next_hops = {}
+
+    def nextHop(self, sw_name, dst_switch):
+        """First switch on a shortest path from sw_name to dst_switch."""
+        key = (sw_name, dst_switch)
+        if key not in self._next_hops:
+            first = {}
+            queue = deque()
+            for neighbour in self.ports.get(sw_name, {}):
+                first[neighbour] = neighbour
+                queue.append(neighbour)
+            while queue:
+                current = queue.popleft()
+                for neighbour in self.ports.get(current, {}):
+                    if neighbour != sw_name and neighbour not in first:
+                        first[neighbour] = first[current]
+                        queue.append(neighbour)
+            self._next_hops[key] = first.get(dst_switch)
+        return self._next_hops[key]
+
+    def route(self, sw_name, dst_ip):
+        """(port, dst MAC) that sw_name uses to reach dst_ip, or None."""
+        host = self.hosts.get(dst_ip)
+        if host is None:
+            return None
+        if host['switch'] == sw_name:
+            return host['port'], macBytes(host['mac'])
+        hop = self.nextHop(sw_name, host['switch'])
+        if hop is None:
+            return None
+        return self.ports[sw_name][hop], self.switch_macs[hop]
+
+
+class ReactiveController(object):
+    """Answers ARP and installs one ipv4_lpm /32 per new destination."""
+
+    def __init__(self, p4info_helper, network, installer, packet_io, max_pending):
+        self.p4info_helper = p4info_helper
+        self.network = network
+        self.installer = installer
+        self.packet_io = packet_io
+        self.pending = asyncio.Semaphore(max_pending)
+        self.latency = LatencyRecorder()
+        self.flows = set()
+        self.stats = dict.fromkeys(('arp_replies', 'arp_unknown', 'flows', 'forwarded',
+                                    'unroutable', 'rejected'), 0)
+
+    def onPacket(self, sw, packet, arrival):
+        payload = packet.payload
+        if len(payload) < 14:
+            return None
+        ether_type = struct.unpack_from('!H', payload, 12)[0]
+        ingress_port = self.packet_io.decode(packet).get('ingress_port', 0)
+        if ether_type == TYPE_ARP and len(payload) >= 14 + _ARP.size:
+            self.answerArp(sw, payload, ingress_port)
+        elif ether_type == TYPE_IPV4 and len(payload) >= 34:
+            # Awaiting the semaphore here stalls dispatch once max_pending
+            # flows are being set up
+            return self.startFlow(sw, payload, arrival)
+        return None
+
+    def answerArp(self, sw, payload, ingress_port):
+        host = self.network.hosts.get(payload[14 + 24:14 + 28])
+        if host is None:
+            self.stats['arp_unknown'] += 1
+            return
+        reply = arpReply(payload, macBytes(host['mac']))
+        if reply is not None:
+            self.packet_io.send(sw, reply, egress_port=ingress_port)
+            self.stats['arp_replies'] += 1
+
+    async def startFlow(self, sw, payload, arrival):
+        await self.pending.acquire()
+        self.installer.loop.create_task(self.setupFlow(sw, payload, arrival))
+
+    async def setupFlow(self, sw, payload, arrival):
+        try:
+            dst_ip = payload[30:34]
+            route = self.network.route(sw.name, dst_ip)
+            if route is None:
+                self.stats['unroutable'] += 1
+                return
+            port, dst_mac = route
+            entry = self.p4info_helper.buildTableEntry(
+                table_name="MyIngress.ipv4_lpm",
+                match_fields={"hdr.ipv4.dstAddr": (socket.inet_ntoa(dst_ip), 32)},
+                action_name="MyIngress.ipv4_forward",
+                action_params={"dstAddr": ':'.join('%02x' % b for b in dst_mac), "port": port})
+            # Packets queued behind the first one of a flow still count as setups
+            flow = (sw.name, dst_ip)
+            new_flow = flow not in self.flows
+            error = await self.installer.install(sw, entry)
+            if error is not None:
+                self.stats['rejected'] += 1
+                print("  Rejected update:", error)
+                return
+            if new_flow:
+                self.latency.record(time.perf_counter() - arrival)
+                self.flows.add(flow)
+                self.stats['flows'] += 1
+            self.stats['forwarded'] += 1
+            # The packet that missed the table is forwarded by the controller
+            self.packet_io.send(sw, forwardPayload(payload, dst_mac), egress_port=port)
+        except grpc.RpcError as e:
+            printGrpcError(e)
+        finally:
+            self.pending.release()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            p50, p90, p99 = self.latency.percentiles()
+            print("flows %d (%d batches), flow setup p50 %.2f ms p90 %.2f ms p99 %.2f ms, "
+                  "forwarded %d, arp replies %d, unknown arp %d, unroutable %d, rejected %d" % (
+                      self.stats['flows'], self.installer.batches, p50 * 1000, p90 * 1000, p99 * 1000,
+                      self.stats['forwarded'],
+                      self.stats['arp_replies'], self.stats['arp_unknown'],
+                      self.stats['unroutable'], self.stats['rejected']))
+
+
+def printGrpcError(e):
+    print("gRPC Error:", e.details(), end=' ')
+    status_code = e.code()
+    print("(%s)" % status_code.name, end=' ')
+    traceback = sys.exc_info()[2]
+    print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
+
+
+async def serve(p4info_helper, network, switches, batch_size, max_delay, queue_size, report_interval):
+    loop = asyncio.get_running_loop()
+    installer = CoalescingInstaller(loop, batch_size=batch_size, max_delay=max_delay,
+                                    maxsize=queue_size)
+    controller = ReactiveController(p4info_helper, network, installer,
+                                    PacketIO(p4info_helper.p4info), queue_size)
+    dispatcher = StreamDispatcher(loop, queue_size)
+    dispatcher.on('packet', controller.onPacket)
+    for sw in switches:
+        dispatcher.attach(sw)
+        # A switch that reconnects may have lost the flows installed so far
+        installer.watch(sw)
+    loop.create_task(installer.run())
+    loop.create_task(controller.report(report_interval))
+    await dispatcher.run()
+
+
+def main(p4info_file_path, bmv2_file_path, topology_file_path,
+         batch_size=DEFAULT_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY,
+         queue_size=DEFAULT_QUEUE_SIZE, report_interval=5.0):
+    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    attachIndex(p4info_helper, p4info_file_path)
+    topology = loadTopology(topology_file_path)
+    network = Network(topology)
+    desired = compileRulesCached(p4info_helper, topology['rules'], DEFAULT_CACHE_DIR)
+    # The bmv2 JSON is read and serialized once for every switch
+    prepared = PreparedPipeline(p4info_helper.p4info, bmv2_file_path)
+
+    try:
+        switches = list(connectSwitches(topology).values())
+        # Default (send_to_cpu) entries first; backs off when a switch is overloaded
+        batcher = WriteScheduler(batch_size)
+        for sw in switches:
+            sw.MasterArbitrationUpdate()
+        # Reactive entries are not kept across restarts, so always push;
+        # the uploads to all switches overlap
+        pushed = ensurePipelines(switches, prepared)
+        for sw in switches:
+            printPipelineStatus(sw, pushed[sw.name])
+            # ipv4_lpm misses go to the controller instead of drop()
+            print(installRuleSet(sw, desired.get(sw.name, []), batcher, current=[]))
+
+        print('\n----- Handling packet-ins -----')
+        asyncio.run(serve(p4info_helper, network, switches, batch_size, max_delay,
+                          queue_size, report_interval))
+
+    except KeyboardInterrupt:
+        print(" Shutting down.")
+    except grpc.RpcError as e:
+        printGrpcError(e)
+
+    ShutdownAllSwitchConnections()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reactive ARP/IPv4 controller for Arp.p4')
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=False,
+                        default='./build/Arp.p4.p4info.txt')
+    parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
+                        type=str, action="store", required=False,
+                        default='./build/Arp.json')
+    parser.add_argument('--topology', help='topology file with hosts and links (JSON or YAML)',
+                        type=str, action="store", required=False,
+                        default='./arp-topology.json')
+    parser.add_argument('--batch-size', help='max updates per WriteRequest (1 for one per entry)',
+                        type=batchSizeArg, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max-delay-ms', help='how long a reactive install waits for others to batch with',
+                        type=float, action="store", required=False,
+                        default=DEFAULT_MAX_DELAY * 1000)
+    parser.add_argument('--queue-size', help='max packet-ins and flow setups in flight',
+                        type=int, action="store", required=False,
+                        default=DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--report-interval', help='seconds between statistics lines',
+                        type=float, action="store", required=False, default=5.0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.p4info):
+        parser.print_help()
+        print("\np4info file not found: %s\nHave you run 'make'?" % args.p4info)
+        parser.exit(1)
+    if not os.path.exists(args.bmv2_json):
+        parser.print_help()
+        print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topology, args.batch_size,
+         args.max_delay_ms / 1000.0, args.queue_size, args.report_interval)
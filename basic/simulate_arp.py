@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.route_compiler import LPM_FIELD, LPM_TABLE, intToIp, ipToInt
+from controller_lib.topology import loadTopology
+
+# Offline model of Arp.p4: parser -> ipv4_lpm -> MyComputeChecksum.
+# Packets are processed in NumPy batches so that rule sets with 100k
+# routes can be replayed against millions of headers before deployment.
+
+TYPE_IPV4 = 0x0800
+TYPE_ARP = 0x0806
+ETHERNET_LEN = 14
+IPV4_LEN = 20
+ARP_LEN = 28
+CPU_PORT = 255
+DROP_PORT = 511         # egress_spec written by mark_to_drop() on bmv2
+PORT_COUNT = 512        # egressSpec is bit<9>
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+FORWARD, DROP, NO_ACTION, SEND_TO_CPU = 0, 1, 2, 3
+ACTIONS = OrderedDict([
+    ('MyIngress.ipv4_forward', FORWARD),
+    ('MyIngress.drop', DROP),
+    ('NoAction', NO_ACTION),
+    ('MyIngress.send_to_cpu', SEND_TO_CPU),
+])
+ACTION_NAMES = dict((code, name) for name, code in ACTIONS.items())
+
+_PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\x4d\x3c\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\xa1\xb2\x3c\x4d': '>',
+}
+_LINKTYPE_ETHERNET = 1
+
+
+def _prefixMask(prefix_len):
+    return (0xffffffff << (32 - prefix_len)) & 0xffffffff
+
+
+def _intValue(value):
+    """Field values as found in topology files (dotted IPs, MACs, ints)
+    or in table dumps (hex strings)."""
+    if isinstance(value, int):
+        return value
+    if '.' in value:
+        return ipToInt(value)
+    if ':' in value:
+        return int(value.replace(':', ''), 16)
+    return int(value, 16)
+
+
+class LpmRuleSet(object):
+    """ipv4_lpm entries as parallel arrays, grouped by prefix length.
+
+    Duplicate (prefix, prefix_len) keys keep the last entry, as a MODIFY
+    would on the switch.
+    """
+
+    def __init__(self, rules, default_action=(DROP, 0, 0)):
+        by_key = OrderedDict()
+        self.duplicates = 0
+        for prefix, prefix_len, action, port, mac in rules:
+            key = (prefix & _prefixMask(prefix_len), prefix_len)
+            if key in by_key:
+                self.duplicates += 1
+            by_key[key] = (action, port, mac)
+        self.default_action = default_action
+        self.prefix = np.fromiter((k[0] for k in by_key), np.uint32, len(by_key))
+        self.prefix_len = np.fromiter((k[1] for k in by_key), np.uint8, len(by_key))
+        self.action = np.fromiter((v[0] for v in by_key.values()), np.uint8, len(by_key))
+        self.port = np.fromiter((v[1] for v in by_key.values()), np.uint16, len(by_key))
+        self.mac = np.fromiter((v[2] for v in by_key.values()), np.uint64, len(by_key))
+
+        # Longest prefixes first; within a length, keys are sorted for searchsorted
+        self.groups = []
+        for prefix_len in sorted(set(self.prefix_len.tolist()), reverse=True):
+            ids = np.flatnonzero(self.prefix_len == prefix_len)
+            ids = ids[np.argsort(self.prefix[ids], kind='stable')]
+            self.groups.append((np.uint32(_prefixMask(prefix_len)), self.prefix[ids], ids))
+
+    def __len__(self):
+        return len(self.prefix)
+
+    def label(self, i):
+        action = int(self.action[i])
+        text = '%s/%d -> %s' % (intToIp(int(self.prefix[i])), self.prefix_len[i],
+                                ACTION_NAMES[action])
+        if action == FORWARD:
+            mac = '%012x' % int(self.mac[i])
+            text += '(dstAddr=%s, port=%d)' % (
+                ':'.join(mac[j:j + 2] for j in range(0, 12, 2)), self.port[i])
+        return text
+
+    def lookup(self, dst):
+        """Index of the longest matching entry per address, -1 on a miss."""
+        result = np.full(len(dst), -1, np.int64)
+        pending = np.arange(len(dst))
+        for mask, keys, ids in self.groups:
+            if not len(pending):
+                break
+            masked = dst[pending] & mask
+            pos = np.minimum(np.searchsorted(keys, masked), len(keys) - 1)
+            hit = keys[pos] == masked
+            result[pending[hit]] = ids[pos[hit]]
+            pending = pending[~hit]
+        return result
+
+    def analyze(self):
+        """(unreachable, redundant) entry indices.
+
+        Prefixes are either nested or disjoint, so a sweep in (start, length)
+        order finds every entry's closest covering entry. An entry is
+        unreachable when the longer prefixes directly below it cover all of
+        its addresses, and redundant when removing it would leave its
+        addresses to a covering entry (or the default) with the same action.
+        """
+        count = len(self)
+        order = np.lexsort((self.prefix_len, self.prefix))
+        prefixes = self.prefix.astype(np.int64)
+        sizes = np.int64(1) << (32 - self.prefix_len.astype(np.int64))
+        ends = prefixes + sizes - 1
+        parent = np.full(count, -1, np.int64)
+        stack = []
+        for i in order.tolist():
+            while stack and ends[stack[-1]] < prefixes[i]:
+                stack.pop()
+            if stack:
+                parent[i] = stack[-1]
+            stack.append(i)
+
+        covered = np.zeros(count, np.int64)
+        children = parent >= 0
+        np.add.at(covered, parent[children], sizes[children])
+        unreachable = np.flatnonzero(covered == sizes)
+
+        behaviour = [tuple(v) for v in zip(self.action.tolist(), self.port.tolist(), self.mac.tolist())]
+        default = tuple(self.default_action)
+        redundant = [i for i in range(count) if covered[i] != sizes[i] and
+                     behaviour[i] == (behaviour[parent[i]] if parent[i] >= 0 else default)]
+        return unreachable, np.array(redundant, np.int64)
+
+
+def _actionTuple(action, params):
+    if action not in ACTIONS:
+        raise ValueError("action %s is not part of Arp.p4's ipv4_lpm" % action)
+    params = params or {}
+    return (ACTIONS[action], _intValue(params.get('port', 0)), _intValue(params.get('dstAddr', 0)))
+
+
+def rulesFromDicts(rows):
+    """ipv4_lpm entries and default action from topology rules or dump rows."""
+    rules = []
+    default_action = (DROP, 0, 0)
+    for row in rows:
+        if row.get('table') != LPM_TABLE:
+            continue
+        if row.get('default_action'):
+            default_action = _actionTuple(row['action'], row.get('params'))
+            continue
+        value, prefix_len = row['match'][LPM_FIELD]
+        rules.append((_intValue(value), int(prefix_len)) + _actionTuple(row['action'], row.get('params')))
+    return LpmRuleSet(rules, default_action)
+
+
+def loadRules(topology_path=None, switch=None, dump_path=None, p4info_path=None):
+    if topology_path:
+        rule_sets = loadTopology(topology_path)['rules']
+        if switch is None:
+            if len(rule_sets) != 1:
+                raise ValueError("%s has rules for %s; pick one with --switch"
+                                 % (topology_path, ', '.join(rule_sets)))
+            switch = next(iter(rule_sets))
+        return rulesFromDicts(rule_sets[switch])
+    if dump_path.endswith('.bin'):
+        # TableEntry protobufs from table_dump --format bin need the P4Info for names
+        from google.protobuf import text_format
+        from p4.config.v1 import p4info_pb2
+
+        from controller_lib.p4info_index import loadIndex
+        from controller_lib.table_dump import decodeEntry, readBinaryDump
+
+        if not p4info_path:
+            raise ValueError("--p4info is required to decode %s" % dump_path)
+        p4info = p4info_pb2.P4Info()
+        with open(p4info_path) as f:
+            text_format.Merge(f.read(), p4info)
+        index = loadIndex(p4info, p4info_path)
+        return rulesFromDicts(decodeEntry(index, switch, entry).toDict()
+                              for entry in readBinaryDump(dump_path))
+    with open(dump_path) as f:
+        return rulesFromDicts(json.loads(line) for line in f if line.strip())
+
+
+class PacketBatch(object):
+    """Header fields Arp.p4 looks at, one array element per packet.
+
+    ipv4 holds the 20 fixed header bytes after Ethernet; length is the
+    captured length, used to reproduce short-packet parser errors.
+    """
+
+    __slots__ = ('eth_dst', 'eth_type', 'ipv4', 'length')
+
+    def __init__(self, eth_dst, eth_type, ipv4, length):
+        self.eth_dst = eth_dst
+        self.eth_type = eth_type
+        self.ipv4 = ipv4
+        self.length = length
+
+    def __len__(self):
+        return len(self.eth_type)
+
+
+def csum16(ipv4):
+    """Ones' complement checksum of the MyComputeChecksum field list.
+
+    The list covers the fixed header minus hdrChecksum, so IP options are
+    not included.
+    """
+    words = ipv4.view('>u2').astype(np.uint32)
+    total = words.sum(axis=1) - words[:, 5]
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return (~total & 0xffff).astype(np.uint16)
+
+
+def checksumValid(ipv4):
+    total = ipv4.view('>u2').astype(np.uint32).sum(axis=1)
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return total == 0xffff
+
+
+def syntheticPackets(rules, count, chunk_size, seed=0, ipv4_fraction=0.9, hit_fraction=0.8):
+    """Yield PacketBatches of random Ethernet/IPv4 (and ARP) headers.
+
+    hit_fraction of the IPv4 destinations are drawn from inside the rule
+    prefixes, the rest uniformly from the address space.
+    """
+    rng = np.random.default_rng(seed)
+    while count > 0:
+        n = min(count, chunk_size)
+        count -= n
+        ipv4 = np.zeros((n, IPV4_LEN), np.uint8)
+        total_len = rng.integers(IPV4_LEN + 8, 1500, n, dtype=np.uint16)
+        ipv4[:, 0] = 0x45
+        ipv4[:, 2:4] = total_len.astype('>u2').view(np.uint8).reshape(n, 2)
+        ipv4[:, 4:6] = rng.integers(0, 256, (n, 2), dtype=np.uint8)
+        ipv4[:, 8] = rng.integers(0, 65, n, dtype=np.uint8)
+        ipv4[:, 9] = rng.choice(np.array([1, 6, 17], np.uint8), n)
+        ipv4[:, 12:16] = rng.integers(0, 256, (n, 4), dtype=np.uint8)
+
+        dst = rng.integers(0, 1 << 32, n, dtype=np.uint64).astype(np.uint32)
+        if len(rules):
+            inside = np.flatnonzero(rng.random(n) < hit_fraction)
+            picked = rng.integers(0, len(rules), len(inside))
+            host_bits = (np.uint64(1) << (32 - rules.prefix_len[picked].astype(np.uint64))) - 1
+            dst[inside] = rules.prefix[picked] | (dst[inside] & host_bits.astype(np.uint32))
+        ipv4[:, 16:20] = dst.astype('>u4').view(np.uint8).reshape(n, 4)
+        ipv4[:, 10:12] = csum16(ipv4).astype('>u2').view(np.uint8).reshape(n, 2)
+
+        eth_type = np.where(rng.random(n) < ipv4_fraction, TYPE_IPV4, TYPE_ARP).astype(np.uint16)
+        eth_dst = rng.integers(0, 1 << 48, n, dtype=np.uint64)
+        length = (ETHERNET_LEN + total_len).astype(np.uint32)
+        yield PacketBatch(eth_dst, eth_type, ipv4, length)
+
+
+def pcapPackets(path, chunk_size):
+    """Yield PacketBatches from a classic (not pcapng) Ethernet pcap file."""
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    endian = _PCAP_MAGIC.get(bytes(data[:4]))
+    if endian is None:
+        raise ValueError("%s is not a classic pcap file" % path)
+    if struct.unpack_from(endian + 'I', data, 20)[0] != _LINKTYPE_ETHERNET:
+        raise ValueError("%s does not contain Ethernet frames" % path)
+    record = struct.Struct(endian + 'IIII')
+    wanted = np.arange(ETHERNET_LEN + IPV4_LEN)
+    offsets, lengths = [], []
+    pos = 24
+    size = len(data)
+    while True:
+        done = pos + record.size > size
+        if not done:
+            captured = record.unpack_from(data, pos)[2]
+            offsets.append(pos + record.size)
+            lengths.append(min(captured, size - pos - record.size))
+            pos += record.size + captured
+        if offsets and (done or len(offsets) == chunk_size):
+            start = np.array(offsets, np.int64)
+            length = np.array(lengths, np.uint32)
+            raw = data[np.minimum(start[:, None] + wanted, size - 1)]
+            raw[wanted[None, :] >= length[:, None]] = 0
+            eth_dst = np.zeros(len(start), np.uint64)
+            for i in range(6):
+                eth_dst = (eth_dst << np.uint64(8)) | raw[:, i]
+            eth_type = (raw[:, 12].astype(np.uint16) << 8) | raw[:, 13]
+            yield PacketBatch(eth_dst, eth_type, np.ascontiguousarray(raw[:, ETHERNET_LEN:]), length)
+            offsets, lengths = [], []
+        if done:
+            return
+
+
+class SimulationStats(object):
+    """Counters accumulated over all batches."""
+
+    def __init__(self, rule_count):
+        self.packets = 0
+        self.ipv4 = 0
+        self.arp = 0
+        self.other = 0
+        self.parser_errors = 0
+        self.ports = np.zeros(PORT_COUNT, np.int64)
+        self.drops = OrderedDict([('table miss (default action)', 0),
+                                  ('drop action', 0),
+                                  ('forwarded to port %d' % DROP_PORT, 0)])
+        self.hits = np.zeros(rule_count, np.int64)
+        self.ttl_wrapped = 0
+        self.bad_checksums = 0
+        self.with_options = 0
+
+
+def simulate(rules, batch, stats):
+    """Run one PacketBatch through Arp.p4; returns (egress_spec, ttl, checksum)."""
+    n = len(batch)
+    stats.packets += n
+    # MyParser: Ethernet, then IPv4 or ARP by etherType; short packets stop with an error.
+    # Replayed traffic never enters on the CPU port, so packet_out is not modelled.
+    has_eth = batch.length >= ETHERNET_LEN
+    is_ipv4 = has_eth & (batch.eth_type == TYPE_IPV4)
+    is_arp = has_eth & (batch.eth_type == TYPE_ARP)
+    truncated = (is_ipv4 & (batch.length < ETHERNET_LEN + IPV4_LEN)) | \
+        (is_arp & (batch.length < ETHERNET_LEN + ARP_LEN))
+    is_ipv4 &= ~truncated
+    is_arp &= ~truncated
+    stats.parser_errors += int(np.count_nonzero(~has_eth | truncated))
+    stats.arp += int(np.count_nonzero(is_arp))
+    stats.other += int(np.count_nonzero(has_eth & ~is_ipv4 & ~is_arp & ~truncated))
+
+    ipv4_idx = np.flatnonzero(is_ipv4)
+    stats.ipv4 += len(ipv4_idx)
+    ipv4 = batch.ipv4[ipv4_idx].copy()
+    stats.bad_checksums += int(np.count_nonzero(~checksumValid(ipv4)))
+    stats.with_options += int(np.count_nonzero((ipv4[:, 0] & 0x0f) > 5))
+
+    # MyIngress: ipv4_lpm only applies to valid IPv4 headers
+    dst = ipv4[:, 16:20].copy().view('>u4').ravel().astype(np.uint32)
+    hit = rules.lookup(dst)
+    matched = hit >= 0
+    if len(rules):
+        stats.hits += np.bincount(hit[matched], minlength=len(rules))
+    action = np.full(len(ipv4_idx), rules.default_action[0], np.uint8)
+    port = np.full(len(ipv4_idx), rules.default_action[1], np.uint16)
+    action[matched] = rules.action[hit[matched]]
+    port[matched] = rules.port[hit[matched]]
+
+    # egress_spec stays 0 unless an action sets it; ARP always goes to the controller
+    egress = np.zeros(n, np.uint16)
+    egress[is_arp] = CPU_PORT
+    forward = action == FORWARD
+    drop = action == DROP
+    egress[ipv4_idx[forward]] = port[forward]
+    egress[ipv4_idx[drop]] = DROP_PORT
+    egress[ipv4_idx[action == SEND_TO_CPU]] = CPU_PORT
+    stats.drops['table miss (default action)'] += int(np.count_nonzero(drop & ~matched))
+    stats.drops['drop action'] += int(np.count_nonzero(drop & matched))
+    stats.drops['forwarded to port %d' % DROP_PORT] += int(np.count_nonzero(forward & (port == DROP_PORT)))
+
+    # ipv4_forward: ttl is bit<8> and Arp.p4 does not check it, so 0 wraps to 255
+    stats.ttl_wrapped += int(np.count_nonzero(forward & (ipv4[:, 8] == 0)))
+    ipv4[forward, 8] -= 1
+    # MyComputeChecksum runs for every valid IPv4 header
+    checksum = csum16(ipv4)
+
+    stats.ports += np.bincount(egress[egress != DROP_PORT], minlength=PORT_COUNT)
+    ttl = np.zeros(n, np.uint8)
+    ttl[ipv4_idx] = ipv4[:, 8]
+    out_checksum = np.zeros(n, np.uint16)
+    out_checksum[ipv4_idx] = checksum
+    return egress, ttl, out_checksum
+
+
+def report(rules, stats, unreachable, redundant, limit):
+    print('packets            %12d' % stats.packets)
+    print('  ipv4             %12d' % stats.ipv4)
+    print('  arp              %12d  (sent to CPU port %d)' % (stats.arp, CPU_PORT))
+    print('  other            %12d  (egress_spec 0)' % stats.other)
+    print('  parser errors    %12d  (truncated headers)' % stats.parser_errors)
+    print('\n----- egress ports -----')
+    for port in np.flatnonzero(stats.ports):
+        print('  port %3d         %12d' % (port, stats.ports[port]))
+    print('\n----- drops -----')
+    for reason, count in stats.drops.items():
+        print('  %-30s %12d' % (reason, count))
+    print('\n----- ipv4 -----')
+    print('  ttl wrapped (forwarded with ttl 0)  %d' % stats.ttl_wrapped)
+    print('  bad input checksum (not verified)   %d' % stats.bad_checksums)
+    print('  with options (excluded from csum16) %d' % stats.with_options)
+
+    never_hit = np.flatnonzero(stats.hits == 0)
+    print('\n----- %d ipv4_lpm entries -----' % len(rules))
+    if rules.duplicates:
+        print('  duplicate keys (last one kept): %d' % rules.duplicates)
+    for title, ids in (('unreachable (fully covered by longer prefixes)', unreachable),
+                       ('redundant (same action as the covering entry)', redundant),
+                       ('never hit by this traffic', never_hit)):
+        print('  %s: %d' % (title, len(ids)))
+        for i in ids[:limit]:
+            print('    %s' % rules.label(i))
+        if len(ids) > limit:
+            print('    ...')
+
+
+def main(rules, packets, limit, report_path=None, output_path=None):
+    stats = SimulationStats(len(rules))
+    outputs = []
+    for batch in packets:
+        result = simulate(rules, batch, stats)
+        if output_path:
+            outputs.append(result)
+    unreachable, redundant = rules.analyze()
+    report(rules, stats, unreachable, redundant, limit)
+
+    if output_path:
+        egress, ttl, checksum = (np.concatenate(parts) for parts in zip(*outputs)) \
+            if outputs else (np.zeros(0),) * 3
+        np.savez(output_path, egress_spec=egress, ttl=ttl, checksum=checksum)
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump({
+                'packets': stats.packets, 'ipv4': stats.ipv4, 'arp': stats.arp,
+                'other': stats.other, 'parser_errors': stats.parser_errors,
+                'ports': dict((int(p), int(stats.ports[p])) for p in np.flatnonzero(stats.ports)),
+                'drops': stats.drops, 'ttl_wrapped': stats.ttl_wrapped,
+                'bad_checksums': stats.bad_checksums,
+                'unreachable': [rules.label(i) for i in unreachable],
+                'redundant': [rules.label(i) for i in redundant],
+                'never_hit': [rules.label(i) for i in np.flatnonzero(stats.hits == 0)],
+            }, f, indent=2)
+    return len(unreachable)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline simulation of the Arp.p4 pipeline')
+    parser.add_argument('--topology', help='topology/rule-set file with ipv4_lpm rules',
+                        type=str, action="store", required=False)
+    parser.add_argument('--switch', help='switch whose rules are simulated',
+                        type=str, action="store", required=False)
+    parser.add_argument('--dump', help='table dump (.jsonl, or .bin with --p4info)',
+                        type=str, action="store", required=False)
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=False)
+    parser.add_argument('--pcap', help='classic pcap file to replay instead of synthetic traffic',
+                        type=str, action="store", required=False)
+    parser.add_argument('--packets', help='number of synthetic packets',
+                        type=int, action="store", required=False, default=1000000)
+    parser.add_argument('--seed', help='seed for synthetic traffic',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('--chunk-size', help='packets per NumPy batch',
+                        type=int, action="store", required=False, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--list', help='entries listed per category',
+                        type=int, action="store", required=False, default=20)
+    parser.add_argument('--report', help='write the results as JSON',
+                        type=str, action="store", required=False)
+    parser.add_argument('--output', help='write per-packet egress_spec/ttl/checksum (.npz)',
+                        type=str, action="store", required=False)
+    parser.add_argument('--fail-on-unreachable', help='exit with status 1 if any entry is unreachable',
+                        action="store_true", default=False)
+    args = parser.parse_args()
+
+    if bool(args.topology) == bool(args.dump):
+        parser.error('give exactly one of --topology and --dump')
+    rules = loadRules(args.topology, args.switch, args.dump, args.p4info)
+    if args.pcap:
+        packets = pcapPackets(args.pcap, args.chunk_size)
+    else:
+        packets = syntheticPackets(rules, args.packets, args.chunk_size, args.seed)
+    unreachable = main(rules, packets, args.list, args.report, args.output)
+    if args.fail_on_unreachable and unreachable:
+        sys.exit(1)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../utils/'))
+import p4runtime_lib.bmv2
+import p4runtime_lib.helper
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.batch import DEFAULT_BATCH_SIZE, WriteBatcher
+from controller_lib.counters import CounterPoller
+from controller_lib.p4info_index import attachIndex, indexFor
+from controller_lib.pipeline import ensurePipeline
+from controller_lib.ruleset import compileRules, installRuleSet
+from controller_lib.table_dump import iterTableEntries
+
+from fake_p4runtime import FakeP4RuntimeServer
+
+INGRESS_TUNNEL_COUNTER = "MyIngress.ingressTunnelCounter"
+EGRESS_TUNNEL_COUNTER = "MyIngress.egressTunnelCounter"
+MAX_TUNNEL_ID = 1 << 16
+
+# Tables, actions and counters of the advanced_tunnel program, so that the
+# benchmark does not need p4c to produce a p4info.
+P4INFO_TEXT = """
+pkg_info { arch: "v1model" }
+tables {
+  preamble { id: 33574068 name: "MyIngress.ipv4_lpm" alias: "ipv4_lpm" }
+  match_fields { id: 1 name: "hdr.ipv4.dstAddr" bitwidth: 32 match_type: LPM }
+  action_refs { id: 16799317 }
+  action_refs { id: 16817264 }
+  action_refs { id: 16805608 }
+  action_refs { id: 16800567 }
+  size: 4194304
+}
+tables {
+  preamble { id: 33594183 name: "MyIngress.myTunnel_exact" alias: "myTunnel_exact" }
+  match_fields { id: 1 name: "hdr.myTunnel.dst_id" bitwidth: 16 match_type: EXACT }
+  action_refs { id: 16812896 }
+  action_refs { id: 16841371 }
+  action_refs { id: 16805608 }
+  size: 65536
+}
+actions { preamble { id: 16800567 name: "NoAction" alias: "NoAction" } }
+actions { preamble { id: 16805608 name: "MyIngress.drop" alias: "drop" } }
+actions {
+  preamble { id: 16799317 name: "MyIngress.ipv4_forward" alias: "ipv4_forward" }
+  params { id: 1 name: "dstAddr" bitwidth: 48 }
+  params { id: 2 name: "port" bitwidth: 9 }
+}
+actions {
+  preamble { id: 16817264 name: "MyIngress.myTunnel_ingress" alias: "myTunnel_ingress" }
+  params { id: 1 name: "dst_id" bitwidth: 16 }
+}
+actions {
+  preamble { id: 16812896 name: "MyIngress.myTunnel_forward" alias: "myTunnel_forward" }
+  params { id: 1 name: "port" bitwidth: 9 }
+}
+actions {
+  preamble { id: 16841371 name: "MyIngress.myTunnel_egress" alias: "myTunnel_egress" }
+  params { id: 1 name: "dstAddr" bitwidth: 48 }
+  params { id: 2 name: "port" bitwidth: 9 }
+}
+counters {
+  preamble { id: 302003102 name: "MyIngress.ingressTunnelCounter" alias: "ingressTunnelCounter" }
+  spec { unit: BOTH }
+  size: 65536
+}
+counters {
+  preamble { id: 302045227 name: "MyIngress.egressTunnelCounter" alias: "egressTunnelCounter" }
+  spec { unit: BOTH }
+  size: 65536
+}
+"""
+
+
+def syntheticRules(count):
+    """count ipv4_lpm host routes plus one myTunnel_exact entry per tunnel."""
+    rules = []
+    tunnels = min(count, MAX_TUNNEL_ID - 1)
+    for i in range(count):
+        tunnel_id = i % tunnels + 1
+        rules.append({
+            "table": "MyIngress.ipv4_lpm",
+            "match": {"hdr.ipv4.dstAddr": ["10.%d.%d.%d" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 32]},
+            "action": "MyIngress.myTunnel_ingress",
+            "params": {"dst_id": tunnel_id},
+        })
+    for tunnel_id in range(1, tunnels + 1):
+        rules.append({
+            "table": "MyIngress.myTunnel_exact",
+            "match": {"hdr.myTunnel.dst_id": tunnel_id},
+            "action": "MyIngress.myTunnel_forward",
+            "params": {"port": 2},
+        })
+    return rules
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def report(name, value, unit):
+    print("%-44s %14.1f %s" % (name, value, unit))
+
+
+def benchCompile(p4info_helper, count, measure_memory):
+    rules = syntheticRules(count)
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    entries = compileRules(p4info_helper, {'s1': rules})['s1']
+    elapsed = time.perf_counter() - start
+    report("compile %d rules" % len(entries), len(entries) / elapsed, "rules/s")
+    if measure_memory:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report("  memory held by compiled entries", current / float(1 << 20), "MiB")
+        report("  per entry", float(current) / len(entries), "bytes")
+    return entries
+
+
+def benchInstall(sw, entries, batch_size):
+    start = time.perf_counter()
+    installRuleSet(sw, entries, WriteBatcher(batch_size), current=[])
+    elapsed = time.perf_counter() - start
+    report("batched install (batch %d)" % batch_size, len(entries) / elapsed, "rules/s")
+
+
+def benchLegacyInstall(sw, entries):
+    start = time.perf_counter()
+    for entry in entries:
+        sw.WriteTableEntry(entry)
+    elapsed = time.perf_counter() - start
+    report("per-entry WriteTableEntry (%d rules)" % len(entries), len(entries) / elapsed, "rules/s")
+
+
+def benchRead(sw, p4info_helper):
+    index = indexFor(p4info_helper)
+    start = time.perf_counter()
+    count = sum(1 for _ in iterTableEntries(index, sw))
+    elapsed = time.perf_counter() - start
+    report("streamed read of %d entries" % count, count / elapsed, "entries/s")
+
+
+def benchCounters(server, sw, p4info_helper, rounds):
+    for name in (INGRESS_TUNNEL_COUNTER, EGRESS_TUNNEL_COUNTER):
+        counter_id = p4info_helper.get_counters_id(name)
+        server.setCounters(counter_id, ((i, (i * 3, i * 300)) for i in range(MAX_TUNNEL_ID)))
+
+    poller = CounterPoller(p4info_helper, [INGRESS_TUNNEL_COUNTER, EGRESS_TUNNEL_COUNTER])
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        poller.poll([sw])
+        samples.append((time.perf_counter() - start) * 1000)
+    poller.close()
+    for fraction in (0.5, 0.9, 0.99):
+        report("wildcard counter poll p%d (2 x %d indices)" % (fraction * 100, MAX_TUNNEL_ID),
+               percentile(samples, fraction), "ms")
+
+    # The pre-poller loop: one ReadCounters RPC per (counter, index)
+    counter_ids = [p4info_helper.get_counters_id(name)
+                   for name in (INGRESS_TUNNEL_COUNTER, EGRESS_TUNNEL_COUNTER)]
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for counter_id in counter_ids:
+            for index in range(100, 700, 100):
+                for _ in sw.ReadCounters(counter_id, index):
+                    pass
+        samples.append((time.perf_counter() - start) * 1000)
+    for fraction in (0.5, 0.9, 0.99):
+        report("per-index counter poll p%d (12 reads)" % (fraction * 100),
+               percentile(samples, fraction), "ms")
+
+
+def main(sizes, latency, batch_size, rounds, legacy_limit, measure_memory):
+    workdir = tempfile.mkdtemp(prefix='p4bench-')
+    p4info_file_path = os.path.join(workdir, 'bench.p4info.txt')
+    bmv2_file_path = os.path.join(workdir, 'bench.json')
+    with open(p4info_file_path, 'w') as f:
+        f.write(P4INFO_TEXT)
+    with open(bmv2_file_path, 'w') as f:
+        f.write('{}')
+
+    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    attachIndex(p4info_helper)
+    server = FakeP4RuntimeServer(latency=latency).start()
+    try:
+        sw = p4runtime_lib.bmv2.Bmv2SwitchConnection(
+            name='s1', address=server.address, device_id=0)
+
+        start = time.perf_counter()
+        sw.MasterArbitrationUpdate()
+        report("MasterArbitrationUpdate", (time.perf_counter() - start) * 1000, "ms")
+
+        for count in sizes:
+            print('\n----- %d rules, %.1f ms injected latency -----' % (count, latency * 1000))
+            entries = benchCompile(p4info_helper, count, measure_memory)
+            start = time.perf_counter()
+            ensurePipeline(sw, p4info_helper.p4info, bmv2_file_path)
+            report("SetForwardingPipelineConfig", (time.perf_counter() - start) * 1000, "ms")
+            benchInstall(sw, entries, batch_size)
+            benchRead(sw, p4info_helper)
+            if legacy_limit:
+                ensurePipeline(sw, p4info_helper.p4info, bmv2_file_path)
+                benchLegacyInstall(sw, entries[:legacy_limit])
+            del entries
+            report("max RSS so far",
+                   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, "MiB")
+
+        print('\n----- counters -----')
+        benchCounters(server, sw, p4info_helper, rounds)
+        print('\nRPCs served:', ', '.join(
+            '%s=%d' % item for item in sorted(server.servicer.rpc_counts.items())))
+    finally:
+        ShutdownAllSwitchConnections()
+        server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Controller benchmarks against a fake P4Runtime server')
+    parser.add_argument('--sizes', help='comma-separated rule counts',
+                        type=str, action="store", default='10000,100000')
+    parser.add_argument('--latency-ms', help='latency injected into every RPC',
+                        type=float, action="store", default=0.0)
+    parser.add_argument('--batch-size', help='max updates per WriteRequest',
+                        type=int, action="store", default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--rounds', help='counter poll rounds',
+                        type=int, action="store", default=50)
+    parser.add_argument('--legacy-limit', help='rules written one RPC at a time for comparison',
+                        type=int, action="store", default=2000)
+    parser.add_argument('--no-memory', help='skip tracemalloc measurements',
+                        action="store_true", default=False)
+    args = parser.parse_args()
+    main([int(size) for size in args.sizes.split(',')], args.latency_ms / 1000.0,
+         args.batch_size, args.rounds, args.legacy_limit, not args.no_memory)
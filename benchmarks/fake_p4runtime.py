@@ -0,0 +1,182 @@
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.rpc import code_pb2, status_pb2
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+from controller_lib.ruleset import entryKey
+
+READ_CHUNK = 1000
+
+
+class _WriteFailed(Exception):
+    pass
+
+
+class FakeP4RuntimeServicer(p4runtime_pb2_grpc.P4RuntimeServicer):
+    """In-memory stand-in for a switch's P4Runtime agent.
+
+    Implements enough of the service (Write, Read, Set/Get pipeline config,
+    StreamChannel arbitration, Capabilities) for the controller code paths
+    to run unchanged; every RPC is delayed by latency seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.config = None
+        self.tables = {}
+        self.counter_sizes = {}
+        self.counters = {}
+        self.rpc_counts = {}
+
+    def _enter(self, name):
+        with self.lock:
+            self.rpc_counts[name] = self.rpc_counts.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def Capabilities(self, request, context):
+        self._enter('Capabilities')
+        return p4runtime_pb2.CapabilitiesResponse(p4runtime_api_version='1.3.0')
+
+    def SetForwardingPipelineConfig(self, request, context):
+        self._enter('SetForwardingPipelineConfig')
+        with self.lock:
+            self.config = p4runtime_pb2.ForwardingPipelineConfig()
+            self.config.CopyFrom(request.config)
+            self.tables = {}
+            self.counter_sizes = dict((c.preamble.id, c.size)
+                                      for c in request.config.p4info.counters)
+            self.counters = {}
+        return p4runtime_pb2.SetForwardingPipelineConfigResponse()
+
+    def GetForwardingPipelineConfig(self, request, context):
+        self._enter('GetForwardingPipelineConfig')
+        response = p4runtime_pb2.GetForwardingPipelineConfigResponse()
+        with self.lock:
+            if self.config is not None and self.config.HasField('cookie'):
+                response.config.cookie.CopyFrom(self.config.cookie)
+        return response
+
+    def _applyUpdate(self, update):
+        entry = update.entity.table_entry
+        key = entryKey(entry)
+        table = self.tables.setdefault(entry.table_id, {})
+        if update.type == p4runtime_pb2.Update.INSERT:
+            if key in table:
+                raise _WriteFailed(code_pb2.ALREADY_EXISTS)
+            table[key] = entry.SerializeToString()
+        elif update.type == p4runtime_pb2.Update.MODIFY:
+            if key not in table and not entry.is_default_action:
+                raise _WriteFailed(code_pb2.NOT_FOUND)
+            table[key] = entry.SerializeToString()
+        elif update.type == p4runtime_pb2.Update.DELETE:
+            if table.pop(key, None) is None:
+                raise _WriteFailed(code_pb2.NOT_FOUND)
+
+    def Write(self, request, context):
+        self._enter('Write')
+        errors = []
+        with self.lock:
+            for update in request.updates:
+                error = p4runtime_pb2.Error()
+                try:
+                    self._applyUpdate(update)
+                except _WriteFailed as e:
+                    error.canonical_code = e.args[0]
+                    error.message = code_pb2.Code.Name(e.args[0])
+                errors.append(error)
+        if any(e.canonical_code != code_pb2.OK for e in errors):
+            status = status_pb2.Status(code=code_pb2.UNKNOWN, message='Write failure')
+            for error in errors:
+                status.details.add().Pack(error)
+            context.set_trailing_metadata(
+                (('grpc-status-details-bin', status.SerializeToString()),))
+            context.abort(grpc.StatusCode.UNKNOWN, 'Write failure')
+        return p4runtime_pb2.WriteResponse()
+
+    def _readEntities(self, entity):
+        kind = entity.WhichOneof('entity')
+        if kind == 'table_entry':
+            table_id = entity.table_entry.table_id
+            if len(entity.table_entry.match):
+                # A single entry: only that one, or nothing
+                with self.lock:
+                    data = self.tables.get(table_id, {}).get(entryKey(entity.table_entry))
+                if data is not None:
+                    result = p4runtime_pb2.Entity()
+                    result.table_entry.ParseFromString(data)
+                    yield result
+                return
+            with self.lock:
+                tables = [self.tables.get(table_id, {})] if table_id else list(self.tables.values())
+                snapshot = [list(t.values()) for t in tables]
+            for entries in snapshot:
+                for data in entries:
+                    result = p4runtime_pb2.Entity()
+                    result.table_entry.ParseFromString(data)
+                    yield result
+        elif kind == 'counter_entry':
+            counter_id = entity.counter_entry.counter_id
+            counter_ids = [counter_id] if counter_id else list(self.counter_sizes)
+            for cid in counter_ids:
+                if entity.counter_entry.HasField('index'):
+                    indices = [entity.counter_entry.index.index]
+                else:
+                    indices = range(self.counter_sizes.get(cid, 0))
+                values = self.counters.get(cid, {})
+                for index in indices:
+                    result = p4runtime_pb2.Entity()
+                    counter = result.counter_entry
+                    counter.counter_id = cid
+                    counter.index.index = index
+                    counter.data.packet_count, counter.data.byte_count = values.get(index, (0, 0))
+                    yield result
+
+    def Read(self, request, context):
+        self._enter('Read')
+        response = p4runtime_pb2.ReadResponse()
+        for requested in request.entities:
+            for entity in self._readEntities(requested):
+                response.entities.add().CopyFrom(entity)
+                if len(response.entities) >= READ_CHUNK:
+                    yield response
+                    response = p4runtime_pb2.ReadResponse()
+        if len(response.entities):
+            yield response
+
+    def StreamChannel(self, request_iterator, context):
+        for request in request_iterator:
+            if request.WhichOneof('update') == 'arbitration':
+                self._enter('MasterArbitrationUpdate')
+                response = p4runtime_pb2.StreamMessageResponse()
+                response.arbitration.CopyFrom(request.arbitration)
+                response.arbitration.status.code = code_pb2.OK
+                yield response
+
+
+class FakeP4RuntimeServer(object):
+    """Runs a FakeP4RuntimeServicer on a local port."""
+
+    def __init__(self, latency=0.0, max_workers=16):
+        self.servicer = FakeP4RuntimeServicer(latency)
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers),
+                                  options=[('grpc.max_send_message_length', 64 << 20),
+                                           ('grpc.max_receive_message_length', 64 << 20)])
+        p4runtime_pb2_grpc.add_P4RuntimeServicer_to_server(self.servicer, self.server)
+        self.port = self.server.add_insecure_port('127.0.0.1:0')
+        self.address = '127.0.0.1:%d' % self.port
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(None)
+
+    def setCounters(self, counter_id, values):
+        with self.servicer.lock:
+            self.servicer.counters[counter_id] = dict(values)
@@ -0,0 +1,181 @@
+import argparse
+import random
+
+import grpc
+from collections import OrderedDict
+
+from google.rpc import code_pb2, status_pb2
+from p4.v1 import p4runtime_pb2
+
+DEFAULT_BATCH_SIZE = 256
+BACKOFF_INITIAL = 0.1
+BACKOFF_MAX = 5.0
+
+# grpc.StatusCode values are (int, str) tuples; index them by the int code
+# carried in p4.v1.Error.canonical_code.
+_STATUS_CODES = dict((c.value[0], c) for c in grpc.StatusCode)
+
+
+def batchSizeArg(value):
+    """argparse type for --batch-size: a WriteRequest holds at least one update."""
+    size = int(value)
+    if size < 1:
+        raise argparse.ArgumentTypeError(
+            "must be at least 1 (1 sends one update per WriteRequest), got %s" % value)
+    return size
+
+
+def backoffDelay(attempt, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(maximum, initial * (2 ** attempt)))
+
+
+def setElectionId(election_id, sw):
+    """Fill an election_id message with the id this controller uses for sw."""
+    high, low = getattr(sw, 'election_id', (0, 1))
+    election_id.high = high
+    election_id.low = low
+
+
+def buildUpdate(table_entry, update_type=None):
+    """Wrap a TableEntry in an Update, choosing the type like WriteTableEntry."""
+    update = p4runtime_pb2.Update()
+    if update_type is None:
+        if table_entry.is_default_action:
+            update_type = p4runtime_pb2.Update.MODIFY
+        else:
+            update_type = p4runtime_pb2.Update.INSERT
+    update.type = update_type
+    update.entity.table_entry.CopyFrom(table_entry)
+    return update
+
+
+class UpdateError(object):
+    """One update of a batched Write that the switch rejected."""
+
+    __slots__ = ('switch', 'update', 'code', 'message')
+
+    def __init__(self, switch, update, code, message):
+        self.switch = switch
+        self.update = update
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return "%s: %s %s (%s)" % (
+            self.switch, p4runtime_pb2.Update.Type.Name(self.update.type),
+            self.message, self.code.name)
+
+
+def parseWriteErrors(e, sw_name, updates):
+    """Turn the rich status of a failed Write into a list of UpdateError.
+
+    Returns None when the error carries no per-update details (transport
+    failures, PERMISSION_DENIED, ...), in which case the caller should treat
+    the whole RPC as failed.
+    """
+    status = None
+    for key, value in e.trailing_metadata() or ():
+        if key == 'grpc-status-details-bin':
+            status = status_pb2.Status()
+            status.ParseFromString(value)
+            break
+    if status is None or len(status.details) != len(updates):
+        return None
+    errors = []
+    for update, detail in zip(updates, status.details):
+        p4_error = p4runtime_pb2.Error()
+        if not detail.Unpack(p4_error):
+            return None
+        if p4_error.canonical_code == code_pb2.OK:
+            continue
+        code = _STATUS_CODES.get(p4_error.canonical_code, grpc.StatusCode.UNKNOWN)
+        errors.append(UpdateError(sw_name, update, code, p4_error.message))
+    return errors
+
+
+def writeUpdates(sw, updates):
+    """Send updates to sw in a single WriteRequest.
+
+    Per-update failures are returned as a list of UpdateError; an error that
+    cannot be attributed to individual updates is re-raised.
+    """
+    request = p4runtime_pb2.WriteRequest()
+    request.device_id = sw.device_id
+    setElectionId(request.election_id, sw)
+    request.updates.extend(updates)
+    try:
+        sw.client_stub.Write(request)
+    except grpc.RpcError as e:
+        errors = parseWriteErrors(e, sw.name, updates)
+        if errors is None:
+            raise
+        return errors
+    return []
+
+
+class WriteBatcher(object):
+    """Collects table entries per switch and writes them as multi-update
+    WriteRequests of at most batch_size updates each.
+
+    Observers get beforeWrite(sw, updates) and afterWrite(sw, updates,
+    errors) around every WriteRequest; errors is None when the RPC failed
+    as a whole and the outcome is unknown.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, observers=()):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.batch_size = batch_size
+        self.observers = list(observers)
+        self._pending = OrderedDict()
+
+    def add(self, sw, table_entry, update_type=None):
+        self.addUpdate(sw, buildUpdate(table_entry, update_type))
+
+    def addUpdate(self, sw, update):
+        if sw.name not in self._pending:
+            self._pending[sw.name] = (sw, [])
+        self._pending[sw.name][1].append(update)
+
+    def pending(self, sw=None):
+        if sw is not None:
+            return len(self._pending.get(sw.name, (None, ()))[1])
+        return sum(len(updates) for _, updates in self._pending.values())
+
+    def switches(self):
+        return [sw for sw, _ in self._pending.values()]
+
+    def flushSwitch(self, sw):
+        """Write every queued update for sw; returns the rejected ones.
+
+        When a WriteRequest fails as a whole its error is raised, and the
+        updates after it, which were not sent, stay queued for the next
+        flush.
+        """
+        _, updates = self._pending.pop(sw.name, (sw, []))
+        errors = []
+        for start in range(0, len(updates), self.batch_size):
+            chunk = updates[start:start + self.batch_size]
+            for observer in self.observers:
+                observer.beforeWrite(sw, chunk)
+            try:
+                chunk_errors = writeUpdates(sw, chunk)
+            except grpc.RpcError:
+                for observer in self.observers:
+                    observer.afterWrite(sw, chunk, None)
+                unsent = updates[start + len(chunk):]
+                if unsent:
+                    queued = self._pending.pop(sw.name, (sw, []))[1]
+                    self._pending[sw.name] = (sw, unsent + queued)
+                raise
+            for observer in self.observers:
+                observer.afterWrite(sw, chunk, chunk_errors)
+            errors.extend(chunk_errors)
+        return errors
+
+    def flush(self):
+        errors = []
+        for sw in self.switches():
+            errors.extend(self.flushSwitch(sw))
+        return errors
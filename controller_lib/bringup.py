@@ -0,0 +1,64 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+
+
+class BringUpResult(object):
+    """Outcome of bringing up a single switch."""
+
+    __slots__ = ('switch', 'error', 'elapsed')
+
+    def __init__(self, switch, error, elapsed):
+        self.switch = switch
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def describeError(e):
+    if isinstance(e, grpc.RpcError):
+        return "gRPC Error: %s (%s)" % (e.details(), e.code().name)
+    return "%s: %s" % (type(e).__name__, e)
+
+
+def _timedSetup(setup, sw):
+    start = time.monotonic()
+    try:
+        setup(sw)
+    except Exception as e:
+        return BringUpResult(sw, e, time.monotonic() - start)
+    return BringUpResult(sw, None, time.monotonic() - start)
+
+
+def bringUpSwitches(switches, setup, max_workers=None):
+    """Run setup(sw) for every switch concurrently, one worker per switch.
+
+    Steps inside setup run in order for their switch; this call only returns
+    once every worker has finished, so it doubles as the barrier before any
+    cross-switch step. Exceptions are captured per switch rather than raised.
+    Results are returned in the order of switches.
+    """
+    switches = list(switches)
+    if not switches:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers or len(switches)) as pool:
+        futures = [pool.submit(_timedSetup, setup, sw) for sw in switches]
+        return [f.result() for f in futures]
+
+
+def printBringUpSummary(results):
+    """Print one line per switch and return the switches that came up."""
+    print('\n----- Switch bring-up summary -----')
+    for result in results:
+        if result.ok:
+            print("%s: OK (%.2fs)" % (result.switch.name, result.elapsed))
+        else:
+            print("%s: FAILED (%.2fs) %s" % (result.switch.name, result.elapsed,
+                                              describeError(result.error)))
+    ready = [r.switch for r in results if r.ok]
+    print("%d of %d switches ready" % (len(ready), len(results)))
+    return ready
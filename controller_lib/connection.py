@@ -0,0 +1,408 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+from p4runtime_lib.bmv2 import Bmv2SwitchConnection
+from p4runtime_lib.switch import GrpcRequestLogger, IterableQueue, connections
+
+from controller_lib.batch import backoffDelay
+from controller_lib.request_log import RequestLog, RequestLogInterceptor
+
+# gRPC servers (PI/bmv2 included) by default answer pings more often than
+# every 5 minutes on a connection without data with GOAWAY too_many_pings;
+# faster failure detection comes from health checks, which carry data
+DEFAULT_KEEPALIVE_MS = 300000
+DEFAULT_KEEPALIVE_TIMEOUT_MS = 5000
+DEFAULT_CONNECT_TIMEOUT = 2.0
+DEFAULT_RECONNECT_TIMEOUT = 60.0
+MAX_MESSAGE_LENGTH = 64 << 20
+# Health checks that time out in a row before the channel is replaced; a
+# single slow probe usually means a busy switch, not a dead connection
+HEALTH_TIMEOUTS_BEFORE_RECONNECT = 3
+
+# Codes that mean the connection, not the request, failed
+RETRYABLE_CODES = (grpc.StatusCode.UNAVAILABLE,)
+# unary-stream methods of the P4Runtime service; the rest are unary-unary
+_STREAM_METHODS = ('Read',)
+
+
+def _benignReplayErrors(e, updates):
+    """True when a replayed Write only failed on updates that had already
+    been applied before the connection dropped."""
+    from controller_lib.batch import parseWriteErrors
+
+    errors = parseWriteErrors(e, None, updates)
+    if errors is None:
+        return False
+    for error in errors:
+        if not ((error.update.type == p4runtime_pb2.Update.INSERT and
+                 error.code == grpc.StatusCode.ALREADY_EXISTS) or
+                (error.update.type == p4runtime_pb2.Update.DELETE and
+                 error.code == grpc.StatusCode.NOT_FOUND)):
+            return False
+    return True
+
+
+class _RetryingMethod(object):
+    """A stub method that reconnects and re-sends on connection failures."""
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def __getattr__(self, attr):
+        # .future(), .with_call() ... go to the current channel unretried
+        return getattr(getattr(self.conn.raw_stub, self.name), attr)
+
+    def __call__(self, request, *args, **kwargs):
+        if self.name in _STREAM_METHODS:
+            return self._stream(request, args, kwargs)
+        return self._unary(request, args, kwargs)
+
+    def _unary(self, request, args, kwargs):
+        attempt = 0
+        deadline = time.monotonic() + self.conn.reconnect_timeout
+        while True:
+            generation = self.conn.generation
+            try:
+                return getattr(self.conn.raw_stub, self.name)(request, *args, **kwargs)
+            except ValueError:
+                # Picked up a channel that a reconnect closed under us
+                if self.conn.generation == generation:
+                    raise
+                continue
+            except grpc.RpcError as e:
+                # A replayed Write may find its own earlier, unacknowledged attempt applied
+                if attempt and self.name == 'Write' and _benignReplayErrors(e, request.updates):
+                    return p4runtime_pb2.WriteResponse()
+                if self._cancelledByReconnect(e, generation):
+                    # It may have been applied before the cancel: a replay
+                    attempt += 1
+                    continue
+                if e.code() not in RETRYABLE_CODES or time.monotonic() > deadline:
+                    raise
+            self.conn.recover(generation, attempt, deadline)
+            attempt += 1
+
+    def _cancelledByReconnect(self, e, generation):
+        # Closing the old channel cancels the calls still on it; send them again
+        return e.code() == grpc.StatusCode.CANCELLED and self.conn.generation != generation
+
+    def _stream(self, request, args, kwargs):
+        attempt = 0
+        deadline = time.monotonic() + self.conn.reconnect_timeout
+        while True:
+            generation = self.conn.generation
+            received = False
+            try:
+                for response in getattr(self.conn.raw_stub, self.name)(request, *args, **kwargs):
+                    received = True
+                    yield response
+                return
+            except grpc.RpcError as e:
+                # Responses already handed out cannot be taken back
+                if received:
+                    raise
+                if self._cancelledByReconnect(e, generation):
+                    continue
+                if e.code() not in RETRYABLE_CODES or time.monotonic() > deadline:
+                    raise
+            self.conn.recover(generation, attempt, deadline)
+            attempt += 1
+
+
+class _RetryingStub(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self._methods = {}
+
+    def __getattr__(self, name):
+        if name == 'StreamChannel':
+            return self._conn.raw_stub.StreamChannel
+        method = self._methods.get(name)
+        if method is None:
+            method = self._methods[name] = _RetryingMethod(self._conn, name)
+        return method
+
+
+class HealthResult(object):
+    __slots__ = ('switch', 'error', 'latency')
+
+    def __init__(self, switch, error, latency):
+        self.switch = switch
+        self.error = error
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class ManagedSwitchConnection(Bmv2SwitchConnection):
+    """A Bmv2SwitchConnection that survives connection loss.
+
+    The channel uses HTTP/2 keepalives, so a dead switch or path is noticed
+    within keepalive_ms + keepalive_timeout_ms even when idle (lower
+    keepalive_ms only for servers that allow it). Interceptors
+    (including the proto_dump_file logger, a RequestLog when the file ends
+    in .bin) are kept in self.interceptors
+    and re-applied to every new channel.
+
+    client_stub retries RPCs that fail with UNAVAILABLE: the failing caller
+    reconnects with exponential backoff (one reconnect per failure, however
+    many threads saw it), redoes mastership arbitration when it had been
+    done before, and then re-sends its own request. Writes that were in
+    flight but never acknowledged are therefore replayed in their original
+    per-thread order; updates of a replay that turn out to have been
+    applied already (INSERT -> ALREADY_EXISTS, DELETE -> NOT_FOUND) are
+    not reported as errors. Responses of a Read that were already yielded
+    are not re-read.
+    """
+
+    def __init__(self, name=None, address='127.0.0.1:50051', device_id=0,
+                 proto_dump_file=None, election_id=(0, 1), interceptors=(), request_log=None,
+                 keepalive_ms=DEFAULT_KEEPALIVE_MS,
+                 keepalive_timeout_ms=DEFAULT_KEEPALIVE_TIMEOUT_MS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 reconnect_timeout=DEFAULT_RECONNECT_TIMEOUT):
+        # SwitchConnection.__init__ is not called: it opens a channel without
+        # options that would be replaced right away.
+        self.name = name
+        self.address = address
+        self.device_id = device_id
+        self.p4info = None
+        self.proto_dump_file = proto_dump_file
+        self.election_id = election_id
+        self.interceptors = list(interceptors)
+        self.request_log = None
+        if proto_dump_file is not None and proto_dump_file.endswith('.bin'):
+            # Binary, asynchronous and rotated; request_log holds RequestLog options
+            self.request_log = RequestLog(proto_dump_file, **(request_log or {}))
+            self.interceptors.append(RequestLogInterceptor(self.request_log))
+        elif proto_dump_file is not None:
+            self.interceptors.append(GrpcRequestLogger(proto_dump_file))
+        self.channel_options = [
+            ('grpc.keepalive_time_ms', keepalive_ms),
+            ('grpc.keepalive_timeout_ms', keepalive_timeout_ms),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+            ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+            ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+        ]
+        self.connect_timeout = connect_timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.reconnect_callbacks = []
+        self.arbitrated = False
+        self.last_arbitration = None
+        self.closed = False
+        self.health_timeouts = 0
+        self.generation = 0
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self.client_stub = _RetryingStub(self)
+        self._open(wait=False)
+        connections.append(self)
+
+    def _open(self, wait=True, old_stream=None):
+        channel = grpc.insecure_channel(self.address, options=self.channel_options)
+        if wait:
+            try:
+                grpc.channel_ready_future(channel).result(timeout=self.connect_timeout)
+            except grpc.FutureTimeoutError:
+                channel.close()
+                raise
+        if old_stream is not None:
+            # A switch still holding the old stream rejects the same
+            # election_id on a second one, so end it before arbitrating
+            old_stream[0].close()
+            old_stream[1].cancel()
+        raw_channel = channel
+        if self.interceptors:
+            channel = grpc.intercept_channel(channel, *self.interceptors)
+        raw_stub = p4runtime_pb2_grpc.P4RuntimeStub(channel)
+        requests_stream = IterableQueue()
+        stream_msg_resp = raw_stub.StreamChannel(iter(requests_stream))
+        if self.arbitrated:
+            # Regain mastership before anyone else can use the new channel
+            try:
+                self._arbitrate(requests_stream, stream_msg_resp)
+            except grpc.RpcError:
+                requests_stream.close()
+                stream_msg_resp.cancel()
+                raw_channel.close()
+                raise
+        self.raw_channel = raw_channel
+        self.channel = channel
+        self.raw_stub = raw_stub
+        self.requests_stream = requests_stream
+        self.stream_msg_resp = stream_msg_resp
+
+    def addInterceptor(self, interceptor):
+        """Add a client interceptor; takes effect on a fresh channel."""
+        with self._lock:
+            self.interceptors.append(interceptor)
+            self.channel = grpc.intercept_channel(self.channel, interceptor)
+            self.raw_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+
+    def reconnect(self, generation):
+        """Replace the channel, unless another thread already did since generation."""
+        with self._lock:
+            if self.closed or self.generation != generation:
+                return False
+            # The old channel stays in place until the new one is up; its
+            # StreamChannel is ended just before re-arbitrating
+            old = (self.requests_stream, self.stream_msg_resp)
+            old_channel = self.raw_channel
+            self._open(old_stream=old)
+            old_channel.close()
+            self.generation += 1
+            self.reconnects += 1
+        print("%s: reconnected to %s" % (self.name, self.address))
+        for callback in self.reconnect_callbacks:
+            callback(self)
+        return True
+
+    def recover(self, generation, attempt, deadline):
+        """Back off, then reconnect; keeps trying until deadline."""
+        while True:
+            time.sleep(backoffDelay(attempt))
+            try:
+                self.reconnect(generation)
+                return
+            except (grpc.RpcError, grpc.FutureTimeoutError):
+                if time.monotonic() > deadline:
+                    raise
+            attempt += 1
+
+    def _arbitrate(self, requests_stream, stream_msg_resp):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.arbitration.device_id = self.device_id
+        request.arbitration.election_id.high, request.arbitration.election_id.low = self.election_id
+        requests_stream.put(request)
+        for item in stream_msg_resp:
+            if item.WhichOneof('update') == 'arbitration':
+                # Tells whether we are master (OK) or a backup (ALREADY_EXISTS)
+                self.last_arbitration = item
+                return item
+        return None
+
+    def MasterArbitrationUpdate(self, dry_run=False, **kwargs):
+        if dry_run:
+            print("P4Runtime MasterArbitrationUpdate: election_id %d:%d" % self.election_id)
+            return None
+        attempt = 0
+        deadline = time.monotonic() + self.reconnect_timeout
+        while True:
+            generation = self.generation
+            try:
+                response = self._arbitrate(self.requests_stream, self.stream_msg_resp)
+                self.arbitrated = True
+                return response
+            except grpc.RpcError as e:
+                if e.code() not in RETRYABLE_CODES or time.monotonic() > deadline:
+                    raise
+            self.recover(generation, attempt, deadline)
+            attempt += 1
+
+    def streamResponses(self):
+        """StreamChannel responses, following the connection across reconnects."""
+        while not self.closed:
+            generation = self.generation
+            try:
+                for response in self.stream_msg_resp:
+                    yield response
+            except grpc.RpcError as e:
+                if e.code() not in RETRYABLE_CODES + (grpc.StatusCode.CANCELLED,):
+                    raise
+            if self.closed:
+                return
+            if self.generation == generation:
+                self.recover(generation, 0, time.monotonic() + self.reconnect_timeout)
+
+    def healthCheck(self, timeout=1.0):
+        """One Capabilities round trip; returns its latency in seconds.
+
+        UNAVAILABLE, or HEALTH_TIMEOUTS_BEFORE_RECONNECT timeouts in a row,
+        start a single reconnect attempt before re-raising.
+        """
+        generation = self.generation
+        start = time.perf_counter()
+        try:
+            self.raw_stub.Capabilities(p4runtime_pb2.CapabilitiesRequest(), timeout=timeout)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+                self.health_timeouts += 1
+            if (e.code() in RETRYABLE_CODES or
+                    self.health_timeouts >= HEALTH_TIMEOUTS_BEFORE_RECONNECT):
+                self.health_timeouts = 0
+                try:
+                    self.reconnect(generation)
+                except (grpc.RpcError, grpc.FutureTimeoutError):
+                    pass
+            raise
+        self.health_timeouts = 0
+        return time.perf_counter() - start
+
+    def shutdown(self):
+        self.closed = True
+        self.requests_stream.close()
+        self.stream_msg_resp.cancel()
+        self.raw_channel.close()
+        if self.request_log is not None:
+            self.request_log.close()
+
+
+def checkSwitches(switches, timeout=1.0, max_workers=None):
+    """Health-check every switch concurrently; returns HealthResults in order."""
+
+    def check(sw):
+        try:
+            return HealthResult(sw, None, sw.healthCheck(timeout))
+        except (grpc.RpcError, grpc.FutureTimeoutError) as e:
+            return HealthResult(sw, e, None)
+
+    if not switches:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers or len(switches)) as pool:
+        return list(pool.map(check, switches))
+
+
+class HealthMonitor(object):
+    """Runs checkSwitches every interval seconds on a daemon thread and
+    prints when a switch goes down or comes back."""
+
+    def __init__(self, switches, interval, timeout=1.0):
+        self.switches = list(switches)
+        self.interval = interval
+        self.timeout = timeout
+        self.healthy = dict((sw.name, True) for sw in self.switches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='health-monitor')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for result in checkSwitches(self.switches, self.timeout):
+                name = result.switch.name
+                if result.ok != self.healthy[name]:
+                    if result.ok:
+                        print("%s: healthy again (%.1f ms)" % (name, result.latency * 1000))
+                    else:
+                        print("%s: health check failed: %s" % (name, _describe(result.error)))
+                self.healthy[name] = result.ok
+
+
+def _describe(e):
+    if isinstance(e, grpc.RpcError):
+        return "%s (%s)" % (e.details(), e.code().name)
+    return "not ready within timeout"
@@ -0,0 +1,123 @@
+from array import array
+
+DEFAULT_CAPACITY = 150
+COUNTER_WIDTH = 64
+_MASK = (1 << 64) - 1
+
+
+def counterDelta(previous, current, width=COUNTER_WIDTH):
+    """Difference between two raw counter readings.
+
+    A reading below the previous one is a wrap when the gap is more than half
+    the counter range, and a reset (e.g. a pipeline re-push) otherwise, in
+    which case the new reading is the whole delta.
+    """
+    if current >= previous:
+        return current - previous
+    modulus = 1 << width
+    if previous - current > modulus >> 1:
+        return current + modulus - previous
+    return current
+
+
+class CounterSeries(object):
+    """Ring buffer of samples for one (switch, counter, index).
+
+    Samples are stored as running totals modulo 2**64, so the delta between
+    any two samples in the buffer is a single modular subtraction regardless
+    of wraps or resets of the underlying counter.
+    """
+
+    __slots__ = ('capacity', 'width', 'timestamps', 'packets', 'bytes',
+                 'head', 'size', 'raw_packets', 'raw_bytes')
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, width=COUNTER_WIDTH):
+        if capacity < 2:
+            raise ValueError("capacity must be at least 2")
+        self.capacity = capacity
+        self.width = width
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.packets = array('Q', bytes(8 * capacity))
+        self.bytes = array('Q', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+        self.raw_packets = 0
+        self.raw_bytes = 0
+
+    def _slot(self, age):
+        # age 0 is the newest sample
+        return (self.head - 1 - age) % self.capacity
+
+    def record(self, timestamp, packet_count, byte_count):
+        """Append a sample and return its (packet, byte) delta."""
+        if self.size:
+            last = self._slot(0)
+            d_packets = counterDelta(self.raw_packets, packet_count, self.width)
+            d_bytes = counterDelta(self.raw_bytes, byte_count, self.width)
+            packets = (self.packets[last] + d_packets) & _MASK
+            bytes_ = (self.bytes[last] + d_bytes) & _MASK
+        else:
+            d_packets = d_bytes = 0
+            packets, bytes_ = packet_count, byte_count
+        self.raw_packets = packet_count
+        self.raw_bytes = byte_count
+        self.timestamps[self.head] = timestamp
+        self.packets[self.head] = packets
+        self.bytes[self.head] = bytes_
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return d_packets, d_bytes
+
+    def delta(self, intervals=1):
+        """(seconds, packets, bytes) covered by the last intervals samples."""
+        intervals = min(intervals, self.size - 1)
+        if intervals < 1:
+            return 0.0, 0, 0
+        new, old = self._slot(0), self._slot(intervals)
+        return (self.timestamps[new] - self.timestamps[old],
+                (self.packets[new] - self.packets[old]) & _MASK,
+                (self.bytes[new] - self.bytes[old]) & _MASK)
+
+    def rate(self, intervals=1):
+        """(packets/s, bits/s) over the last intervals samples."""
+        seconds, packets, bytes_ = self.delta(intervals)
+        if seconds <= 0:
+            return 0.0, 0.0
+        return packets / seconds, bytes_ * 8 / seconds
+
+
+class CounterHistory(object):
+    """Keeps a CounterSeries per (switch, counter, index)."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, width=COUNTER_WIDTH):
+        self.capacity = capacity
+        self.width = width
+        self.series = {}
+
+    def get(self, sw_name, counter_name, index):
+        key = (sw_name, counter_name, index)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = CounterSeries(self.capacity, self.width)
+        return series
+
+    def recordSnapshot(self, snapshot, timestamp, indices=None):
+        """Record a CounterPoller snapshot; indices limits which are kept."""
+        for (sw_name, counter_name), values in snapshot.items():
+            wanted = values if indices is None else indices
+            for index in wanted:
+                packet_count, byte_count = values.get(index, (0, 0))
+                self.get(sw_name, counter_name, index).record(
+                    timestamp, packet_count, byte_count)
+
+    def loss(self, ingress_key, egress_key, intervals=1):
+        """Packets that entered a tunnel but did not leave it.
+
+        Returns (ingress_packets, egress_packets, lost, loss_ratio) over the
+        last intervals samples of the two (switch, counter, index) keys.
+        """
+        _, ingress_packets, _ = self.get(*ingress_key).delta(intervals)
+        _, egress_packets, _ = self.get(*egress_key).delta(intervals)
+        lost = max(ingress_packets - egress_packets, 0)
+        ratio = float(lost) / ingress_packets if ingress_packets else 0.0
+        return ingress_packets, egress_packets, lost, ratio
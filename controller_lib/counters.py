@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from p4.v1 import p4runtime_pb2
+
+
+def readCounterArrays(sw, counter_ids, indices=None):
+    """Read several counters from sw with a single ReadRequest.
+
+    Without indices every counter is read with a wildcard index, which
+    returns the whole array. With indices (a list of ints) one entity per
+    (counter, index) is packed into the same request instead.
+    Returns {counter_id: {index: (packet_count, byte_count)}}.
+    """
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    for counter_id in counter_ids:
+        if indices is None:
+            request.entities.add().counter_entry.counter_id = counter_id
+            continue
+        for index in indices:
+            counter_entry = request.entities.add().counter_entry
+            counter_entry.counter_id = counter_id
+            counter_entry.index.index = index
+    values = dict((counter_id, {}) for counter_id in counter_ids)
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            counter = entity.counter_entry
+            values[counter.counter_id][counter.index.index] = (
+                counter.data.packet_count, counter.data.byte_count)
+    return values
+
+
+class CounterPoller(object):
+    """Polls a fixed set of counters on many switches, one RPC per switch.
+
+    The per-switch reads run concurrently; poll() returns
+    {(switch_name, counter_name): {index: (packet_count, byte_count)}}.
+    """
+
+    def __init__(self, p4info_helper, counter_names, indices=None, max_workers=None):
+        self.counter_ids = OrderedDict(
+            (name, p4info_helper.get_counters_id(name)) for name in counter_names)
+        self.indices = sorted(indices) if indices is not None else None
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _pollSwitch(self, sw):
+        values = readCounterArrays(sw, list(self.counter_ids.values()), self.indices)
+        return [((sw.name, name), values[counter_id])
+                for name, counter_id in self.counter_ids.items()]
+
+    def poll(self, switches):
+        snapshot = {}
+        for items in self._pool.map(self._pollSwitch, switches):
+            snapshot.update(items)
+        return snapshot
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Kept free of grpc/protobuf imports: a query costs a connect and one line
+
+
+def socketPath(controller_id='0'):
+    """The default control socket of a controller.
+
+    Absolute, so the controller (run from its exercise directory) and the
+    CLI (run from the repository root) agree on it; one per user and
+    controller id, so sharded controllers on one host each get their own.
+    """
+    return os.path.join(tempfile.gettempdir(),
+                        'p4runtime-controller-%d-%s.sock' % (os.getuid(), controller_id))
+
+
+DEFAULT_SOCKET = socketPath()
+
+
+def socketInUse(socket_path):
+    """True when a server answers on socket_path; a file left behind does not count."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def query(request, socket_path=DEFAULT_SOCKET, timeout=30.0):
+    """Send one request to a ControlServer and return its reply."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise IOError("No reply from %s" % socket_path)
+    return json.loads(line)
+
+
+def _value(value):
+    if isinstance(value, list):
+        return '/'.join(str(v) for v in value)
+    return str(value)
+
+
+def formatEntry(entry):
+    parts = ['%s:' % entry['table']]
+    for name, value in sorted(entry['match'].items()):
+        parts.append('%s=%s' % (name, _value(value)))
+    parts.append('->')
+    parts.append(str(entry['action']))
+    for name, value in sorted(entry['params'].items()):
+        parts.append('%s=%s' % (name, _value(value)))
+    if entry.get('priority'):
+        parts.append('priority=%d' % entry['priority'])
+    return ' '.join(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m controller_lib.ctl',
+                                     description='Query a running controller over its Unix socket')
+    parser.add_argument('--socket', help='controller socket (default: the one of --controller-id)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--controller-id', help="id of the controller to query ('daemon' for controller_lib.daemon)",
+                        type=str, action="store", required=False, default='0')
+    parser.add_argument('--json', help='print the raw JSON reply',
+                        action="store_true", default=False)
+    commands = parser.add_subparsers(dest='cmd')
+    commands.required = True
+    commands.add_parser('switches', help='list the switches')
+    dump = commands.add_parser('dump', help='dump table entries of a switch')
+    dump.add_argument('switch')
+    dump.add_argument('table', nargs='?', default=None)
+    dump.add_argument('--action', type=str, action="store", required=False, default=None)
+    dump.add_argument('--from-switch', help='read the switch instead of the shadow tables',
+                      action="store_true", default=False)
+    counter = commands.add_parser('counter', help='read a counter of a switch')
+    counter.add_argument('switch')
+    counter.add_argument('counter')
+    counter.add_argument('index', nargs='?', type=int, default=None)
+    event = commands.add_parser('event', help='report a link event, e.g. link-down s1 s2')
+    event.add_argument('event', nargs='+')
+    args = parser.parse_args(argv)
+    if args.socket is None:
+        args.socket = socketPath(args.controller_id)
+
+    request = {'cmd': args.cmd}
+    if args.cmd == 'dump':
+        request.update(switch=args.switch, table=args.table, action=args.action,
+                       source='switch' if args.from_switch else 'shadow')
+    elif args.cmd == 'counter':
+        request.update(switch=args.switch, counter=args.counter, index=args.index)
+    elif args.cmd == 'event':
+        request.update(event=' '.join(args.event))
+
+    try:
+        reply = query(request, args.socket)
+    except (IOError, OSError) as e:
+        print("Cannot reach the controller on %s: %s" % (args.socket, e), file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(reply, indent=2))
+        return 0 if reply['ok'] else 1
+    if not reply['ok']:
+        print(reply['error'], file=sys.stderr)
+        return 1
+    result = reply['result']
+    if args.cmd == 'switches':
+        for sw in result:
+            role = '' if 'master' not in sw else (' master' if sw['master'] else ' standby')
+            print("%s %s device %d%s" % (sw['name'], sw['address'], sw['device_id'], role))
+    elif args.cmd == 'dump':
+        for entry in result:
+            print(formatEntry(entry))
+    elif args.cmd == 'event':
+        print("%s: %d tunnels rerouted with %d updates on %s in %.1f ms" % (
+            result['event'], result['tunnels'], result['updates'],
+            ', '.join(result['switches']) or 'no switches', result['elapsed'] * 1000))
+        if result['unreachable']:
+            print("Unreachable tunnels: %s" % ', '.join(str(t) for t in result['unreachable']))
+        for error in result['errors']:
+            print("  Error:", error)
+        return 0 if not result['errors'] else 1
+    else:
+        for value in result:
+            print("%s %s %d: %d packets (%d bytes)" % (
+                args.switch, args.counter, value['index'], value['packets'], value['bytes']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
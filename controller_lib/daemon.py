@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import grpc
+
+from controller_lib.counters import readCounterArrays
+from controller_lib.ctl import DEFAULT_SOCKET, socketInUse, socketPath
+from controller_lib.p4info_index import indexFor
+from controller_lib.reroute import parseEvent
+from controller_lib.table_dump import decodeEntry, iterTableEntries
+
+
+class CommandError(Exception):
+    pass
+
+
+class ControlServer(object):
+    """Answers JSON-lines queries on a Unix socket from a running controller.
+
+    Each request is one JSON object on a line with a "cmd" key; each reply
+    is one line, {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+    A connection may send any number of requests. Commands:
+
+      switches                          names, addresses and device ids
+      dump     switch [table] [action]  table entries (from the shadow when
+               [source: shadow|switch]  one is given and up to date)
+      counter  switch counter [index]   packets and bytes (all indices
+                                        when index is left out)
+      event    event                    apply a link event such as
+                                        "link-down s1 s2" and reroute
+                                        (needs a Rerouter)
+
+    Queries run on the controller's open channels with its P4Info index,
+    so none of the startup work is repeated per query.
+    """
+
+    def __init__(self, p4info_helper, switches, shadow=None, mastership=None, rerouter=None):
+        self.index = indexFor(p4info_helper)
+        self.switches = dict((sw.name, sw) for sw in switches)
+        self.shadow = shadow
+        self.mastership = mastership
+        self.rerouter = rerouter
+        self.commands = {
+            'switches': self.listSwitches,
+            'dump': self.dumpTable,
+            'counter': self.readCounter,
+        }
+        if rerouter is not None:
+            self.commands['event'] = self.linkEvent
+        self._server = None
+
+    def _switch(self, request):
+        name = request.get('switch')
+        if name not in self.switches:
+            raise CommandError("Unknown switch %r (have %s)" % (name, ', '.join(sorted(self.switches))))
+        return self.switches[name]
+
+    def _lookup(self, lookup, name, kind):
+        try:
+            return lookup(name)
+        except KeyError:
+            raise CommandError("Unknown %s %r" % (kind, name))
+
+    def listSwitches(self, request):
+        result = []
+        for sw in self.switches.values():
+            info = {'name': sw.name, 'address': sw.address, 'device_id': sw.device_id}
+            if self.mastership is not None:
+                info['master'] = self.mastership.isMaster(sw)
+            result.append(info)
+        return result
+
+    def dumpTable(self, request):
+        sw = self._switch(request)
+        tables = [request['table']] if request.get('table') else None
+        actions = [request['action']] if request.get('action') else None
+        for name in tables or ():
+            self._lookup(self.index.tableId, name, 'table')
+        for name in actions or ():
+            self._lookup(self.index.actionId, name, 'action')
+        source = request.get('source', 'shadow')
+        if source == 'shadow' and self.shadow is not None and not self.shadow.isStale(sw.name):
+            table_ids = [self.index.tableId(name) for name in tables] if tables else None
+            action_ids = [self.index.actionId(name) for name in actions] if actions else None
+            entries = (decodeEntry(self.index, sw.name, entry)
+                       for entry in self.shadow.entries(sw.name, table_ids, action_ids))
+        else:
+            entries = iterTableEntries(self.index, sw, tables, actions)
+        return [entry.toDict() for entry in entries]
+
+    def readCounter(self, request):
+        sw = self._switch(request)
+        counter_id = self._lookup(self.index.counterId, request.get('counter'), 'counter')
+        index = request.get('index')
+        values = readCounterArrays(sw, [counter_id], None if index is None else [int(index)])
+        return [{'index': i, 'packets': packets, 'bytes': byte_count}
+                for i, (packets, byte_count) in sorted(values[counter_id].items())]
+
+    def linkEvent(self, request):
+        received = time.monotonic()
+        try:
+            event = parseEvent(request.get('event') or '', received)
+            result = self.rerouter.handle(event)
+        except ValueError as e:
+            raise CommandError(str(e))
+        print(result)
+        return result.toDict()
+
+    def handle(self, request):
+        try:
+            command = self.commands.get(request.get('cmd'))
+            if command is None:
+                raise CommandError("Unknown command %r (have %s)" % (
+                    request.get('cmd'), ', '.join(sorted(self.commands))))
+            return {'ok': True, 'result': command(request)}
+        except CommandError as e:
+            return {'ok': False, 'error': str(e)}
+        except grpc.RpcError as e:
+            return {'ok': False, 'error': "gRPC Error: %s (%s)" % (e.details(), e.code().name)}
+
+    def start(self, socket_path=DEFAULT_SOCKET):
+        """Serve on socket_path from a daemon thread.
+
+        Raises IOError when another process is serving on it; a socket file
+        left behind by one that exited is replaced.
+        """
+        if socketInUse(socket_path):
+            raise IOError("%s is in use by another controller" % socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        directory = os.path.dirname(socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        control = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        reply = control.handle(json.loads(line))
+                    except ValueError as e:
+                        reply = {'ok': False, 'error': "Bad request: %s" % e}
+                    self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name='control-server')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if os.path.exists(self._server.server_address):
+                os.unlink(self._server.server_address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m controller_lib.daemon',
+                                     description='Read-only P4Runtime controller daemon')
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=True)
+    parser.add_argument('--topology', help='topology file with the switch addresses',
+                        type=str, action="store", required=True)
+    parser.add_argument('--socket', help='Unix socket to serve on (ctl --controller-id daemon by default)',
+                        type=str, action="store", required=False, default=socketPath('daemon'))
+    args = parser.parse_args(argv)
+    if socketInUse(args.socket):
+        print("%s is in use by another controller" % args.socket, file=sys.stderr)
+        return 1
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../utils/'))
+    import p4runtime_lib.helper
+    from p4runtime_lib.switch import ShutdownAllSwitchConnections
+
+    from controller_lib.p4info_index import attachIndex
+    from controller_lib.topology import connectSwitches, loadTopology
+
+    p4info_helper = p4runtime_lib.helper.P4InfoHelper(args.p4info)
+    attachIndex(p4info_helper, args.p4info)
+    # Reads need no mastership, so the daemon does not arbitrate and can
+    # run next to the controller that owns the switches. The proto_dump_file
+    # logs belong to that controller: opening them here would truncate them
+    switches = list(connectSwitches(loadTopology(args.topology), proto_dump=False).values())
+    server = ControlServer(p4info_helper, switches).start(args.socket)
+    print("Serving %d switches on %s" % (len(switches), args.socket))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print(" Shutting down.")
+    server.stop()
+    ShutdownAllSwitchConnections()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
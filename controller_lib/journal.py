@@ -0,0 +1,484 @@
+import array
+import glob
+import os
+import re
+import struct
+import threading
+import zlib
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.ruleset import entryKey
+
+DEFAULT_SNAPSHOT_BYTES = 16 << 20
+
+MAGIC = b'P4RTJNL1'
+SNAPSHOT_MAGIC = b'P4RTSNP1'
+# payload length, crc32 of the payload, kind, sequence number
+_RECORD = struct.Struct('<IIBQ')
+_NAME = struct.Struct('<H')
+_TABLE = struct.Struct('<II')
+_RECORD_LENGTHS = struct.Struct('<III')
+_SEQ = struct.Struct('<Q')
+
+# Journal records
+INTENT = 1    # updates about to be written (WriteRequest)
+ACK = 2       # the Write for an intent returned; payload: rejected update indices
+UNKNOWN = 3   # the Write for an intent failed as a whole, outcome unknown
+CLEAR = 4     # the switch's tables were emptied by a pipeline push
+LOAD = 5      # the switch's tables were read back (WriteRequest of INSERTs)
+SETTLE = 6    # single entries read back (INSERT found, DELETE missing) for the intents listed
+# Snapshot records
+TABLE = 7     # one table of a switch in ShadowStore.snapshot() form
+PENDING = 8   # an intent that was not settled when the snapshot was taken
+END = 9
+
+_SEGMENT = re.compile(r'journal\.(\d+)\.log$')
+_SNAPSHOT = re.compile(r'snapshot\.(\d+)\.bin$')
+
+
+def _name(sw_name, body=b''):
+    name = sw_name.encode('utf-8')
+    return _NAME.pack(len(name)) + name + body
+
+
+def _splitName(payload):
+    length = _NAME.unpack_from(payload)[0]
+    end = _NAME.size + length
+    return payload[_NAME.size:end].decode('utf-8'), payload[end:]
+
+
+def _updates(data):
+    request = p4runtime_pb2.WriteRequest()
+    request.ParseFromString(data)
+    return list(request.updates)
+
+
+def _encodeUpdates(updates):
+    request = p4runtime_pb2.WriteRequest()
+    request.updates.extend(updates)
+    return request.SerializeToString()
+
+
+def _record(kind, seq, payload):
+    return _RECORD.pack(len(payload), zlib.crc32(payload), kind, seq) + payload
+
+
+def readRecords(path, magic):
+    """Yield (kind, seq, payload) from a journal or snapshot file.
+
+    Stops at the first torn or corrupt record: everything after a crash
+    in the middle of a write is ignored.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(magic):
+        return
+    offset = len(magic)
+    while offset + _RECORD.size <= len(data):
+        length, crc, kind, seq = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            return
+        yield kind, seq, payload
+        offset = start + length
+
+
+def _files(directory, pattern):
+    found = []
+    for path in glob.glob(os.path.join(directory, '*')):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+
+class Journal(object):
+    """Write-ahead journal of the table updates sent to the switches.
+
+    Attach it to a ShadowStore (ShadowStore(journal=...)) registered as a
+    WriteBatcher observer: every Write is preceded by an INTENT record and
+    followed by an ACK (or UNKNOWN), and shadow reloads and clears are
+    recorded too. intent() returns once its record is fsynced; concurrent
+    writers share one fsync (group commit). Acks are not waited for, as a
+    missing ack only makes its intent uncertain.
+
+    The journal is a sequence of segments in directory. Once the current
+    one grows past snapshot_bytes, a snapshot of the shadow (and of the
+    intents still pending) is written next to it, a new segment is
+    started, and older files are deleted when the snapshot is durable.
+    Recovery therefore reads one snapshot plus the records since, however
+    large the tables are.
+    """
+
+    def __init__(self, directory, snapshot_bytes=DEFAULT_SNAPSHOT_BYTES, fsync=True):
+        self.directory = directory
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync = fsync
+        self.shadow = None
+        self.generation = 0
+        self.seq = 0
+        self.syncs = 0
+        self.snapshots = 0
+        # seq -> (switch, updates) of intents that are not settled
+        self.pending = {}
+        self._ids = {}
+        self._buffer = []
+        self._synced = 0
+        self._file = None
+        self._size = 0
+        self._closing = False
+        self._checkpointing = False
+        # What stopped the writer thread (e.g. ENOSPC); raised to every writer
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _segmentPath(self, generation):
+        return os.path.join(self.directory, 'journal.%08d.log' % generation)
+
+    def _snapshotPath(self, generation):
+        return os.path.join(self.directory, 'snapshot.%08d.bin' % generation)
+
+    def _append(self, kind, payload):
+        """Queue one record for the writer thread."""
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            if self._file is None:
+                # Not recording yet (recovering) or closed
+                return 0
+            self.seq += 1
+            seq = self.seq
+            self._buffer.append(_record(kind, seq, payload))
+            self._cond.notify_all()
+        return seq
+
+    def intent(self, sw_name, updates):
+        """Record updates about to be written to sw_name; returns once on disk.
+
+        Raises the OSError that stopped the writer thread, if one did: the
+        updates must not be sent when their intent cannot be recorded.
+        """
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            if self._file is None:
+                return 0
+            self.seq += 1
+            seq = self.seq
+            self._buffer.append(_record(INTENT, seq, _name(sw_name, _encodeUpdates(updates))))
+            self.pending[seq] = (sw_name, updates)
+            self._ids[(sw_name, id(updates))] = seq
+            self._cond.notify_all()
+            while self._synced < seq and not self._closing and self._error is None:
+                self._cond.wait()
+            if self._synced < seq and self._error is not None:
+                raise self._error
+        return seq
+
+    def ack(self, sw_name, updates, errors):
+        """errors: the rejected UpdateErrors, or None when the outcome is unknown."""
+        with self._cond:
+            intent = self._ids.pop((sw_name, id(updates)), None)
+            if intent is None:
+                return
+            if errors is not None:
+                # An unknown outcome stays pending until it is settled
+                self.pending.pop(intent, None)
+        if errors is None:
+            self._append(UNKNOWN, _name(sw_name, _SEQ.pack(intent)))
+            return
+        positions = dict((id(update), i) for i, update in enumerate(updates))
+        rejected = array.array('I', sorted(positions[id(e.update)] for e in errors))
+        self._append(ACK, _name(sw_name, _SEQ.pack(intent) + rejected.tobytes()))
+
+    def _dropPending(self, sw_name):
+        with self._cond:
+            for seq in [seq for seq, (name, _) in self.pending.items() if name == sw_name]:
+                del self.pending[seq]
+
+    def cleared(self, sw_name):
+        self._dropPending(sw_name)
+        self._append(CLEAR, _name(sw_name))
+
+    def loaded(self, sw_name, entries):
+        # A full read settles everything that was uncertain on the switch
+        self._dropPending(sw_name)
+        updates = [p4runtime_pb2.Update(type=p4runtime_pb2.Update.INSERT) for _ in entries]
+        for update, entry in zip(updates, entries):
+            update.entity.table_entry.CopyFrom(entry)
+        self._append(LOAD, _name(sw_name, _encodeUpdates(updates)))
+
+    def settled(self, sw_name, updates, intents):
+        with self._cond:
+            for seq in intents:
+                self.pending.pop(seq, None)
+        body = struct.pack('<I%dQ' % len(intents), len(intents), *intents) + _encodeUpdates(updates)
+        self._append(SETTLE, _name(sw_name, body))
+
+    def uncertain(self):
+        """{switch: [(seq, updates)]} of the intents whose outcome is not known."""
+        result = {}
+        with self._cond:
+            for seq, (sw_name, updates) in sorted(self.pending.items()):
+                if (sw_name, id(updates)) not in self._ids:
+                    result.setdefault(sw_name, []).append((seq, updates))
+        return result
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _run(self):
+        f = self._file
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closing:
+                    self._cond.wait()
+                if not self._buffer and self._closing:
+                    break
+                records, self._buffer = self._buffer, []
+                last = self.seq
+            try:
+                for record in records:
+                    if isinstance(record, tuple):
+                        # Segment switch queued by checkpoint()
+                        self._sync(f)
+                        f.close()
+                        f = self._file = record[1]
+                        self._size = 0
+                        continue
+                    f.write(record)
+                    self._size += len(record)
+                self._sync(f)
+            except (IOError, OSError) as e:
+                # Nothing more can be recorded: fail the writers instead of
+                # leaving them waiting for a sync that never comes
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                break
+            self.syncs += 1
+            with self._cond:
+                self._synced = last
+                self._cond.notify_all()
+                start = (self._size >= self.snapshot_bytes and not self._checkpointing
+                         and not self._closing)
+                if start:
+                    self._checkpointing = True
+            if start:
+                thread = threading.Thread(target=self.checkpoint, name='journal-snapshot')
+                thread.daemon = True
+                thread.start()
+        try:
+            f.close()
+        except (IOError, OSError):
+            # After a failed write its buffer cannot be flushed either
+            if self._error is None:
+                raise
+        self._file = None
+
+    def _openSegment(self, generation):
+        f = open(self._segmentPath(generation), 'wb')
+        f.write(MAGIC)
+        return f
+
+    def checkpoint(self):
+        """Snapshot the shadow and move on to a new segment."""
+        # The shadow lock keeps the snapshot and the segment switch atomic
+        # with respect to ACK/LOAD/CLEAR/SETTLE, which are appended under it
+        with self.shadow._lock:
+            state = self.shadow.snapshot()
+            with self._cond:
+                self.generation += 1
+                generation = self.generation
+                pending = sorted(self.pending.items())
+                self._buffer.append(('segment', self._openSegment(generation)))
+                self._cond.notify_all()
+        try:
+            self._writeSnapshot(generation, state, pending)
+        finally:
+            with self._cond:
+                self._checkpointing = False
+        self._prune(generation)
+
+    def _prune(self, generation):
+        # Only once the snapshot is durable are the files it replaces dropped
+        for old, path in _files(self.directory, _SEGMENT) + _files(self.directory, _SNAPSHOT):
+            if old < generation:
+                os.unlink(path)
+
+    def _writeSnapshot(self, generation, state, pending):
+        path = self._snapshotPath(generation)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb', buffering=1 << 20) as f:
+            f.write(SNAPSHOT_MAGIC)
+            for sw_name, tables in state:
+                for table_id, default, records in tables:
+                    parts = [_TABLE.pack(table_id, len(default or b'')), default or b'']
+                    for key, action, data in records:
+                        parts.append(_RECORD_LENGTHS.pack(len(key), len(action), len(data)))
+                        parts.extend((key, action, data))
+                    f.write(_record(TABLE, 0, _name(sw_name, b''.join(parts))))
+                if not tables:
+                    f.write(_record(TABLE, 0, _name(sw_name)))
+            for seq, (sw_name, updates) in pending:
+                f.write(_record(PENDING, seq, _name(sw_name, _encodeUpdates(updates))))
+            f.write(_record(END, 0, b''))
+            self._sync(f)
+        os.rename(tmp_path, path)
+        self.snapshots += 1
+
+    def _loadSnapshot(self, path, shadow):
+        tables = {}
+        complete = False
+        for kind, seq, payload in readRecords(path, SNAPSHOT_MAGIC):
+            if kind == TABLE:
+                sw_name, body = _splitName(payload)
+                sw_tables = tables.setdefault(sw_name, [])
+                if not body:
+                    continue
+                table_id, default_length = _TABLE.unpack_from(body)
+                offset = _TABLE.size
+                default = body[offset:offset + default_length] or None
+                offset += default_length
+                records = []
+                while offset < len(body):
+                    key_length, action_length, data_length = _RECORD_LENGTHS.unpack_from(body, offset)
+                    offset += _RECORD_LENGTHS.size
+                    key = body[offset:offset + key_length]
+                    offset += key_length
+                    action = body[offset:offset + action_length]
+                    offset += action_length
+                    records.append((key, action, body[offset:offset + data_length]))
+                    offset += data_length
+                sw_tables.append((table_id, default, records))
+            elif kind == PENDING:
+                sw_name, body = _splitName(payload)
+                self.pending[seq] = (sw_name, _updates(body))
+                self.seq = max(self.seq, seq)
+            elif kind == END:
+                complete = True
+        if not complete:
+            self.pending = {}
+            return False
+        for sw_name, sw_tables in tables.items():
+            shadow.restore(sw_name, sw_tables)
+        return True
+
+    def _replay(self, path, shadow):
+        records = 0
+        for kind, seq, payload in readRecords(path, MAGIC):
+            records += 1
+            self.seq = max(self.seq, seq)
+            sw_name, body = _splitName(payload)
+            if kind == INTENT:
+                self.pending[seq] = (sw_name, _updates(body))
+            elif kind == ACK:
+                intent = _SEQ.unpack_from(body)[0]
+                rejected = array.array('I')
+                rejected.frombytes(body[_SEQ.size:])
+                entry = self.pending.pop(intent, None)
+                if entry is not None:
+                    skip = set(rejected)
+                    shadow.applyUpdates(sw_name, [u for i, u in enumerate(entry[1]) if i not in skip])
+            elif kind == UNKNOWN:
+                pass
+            elif kind == CLEAR:
+                self._dropPending(sw_name)
+                shadow.clear(sw_name)
+            elif kind == LOAD:
+                self._dropPending(sw_name)
+                shadow.load(sw_name, [u.entity.table_entry for u in _updates(body)])
+            elif kind == SETTLE:
+                count = struct.unpack_from('<I', body)[0]
+                for intent in struct.unpack_from('<%dQ' % count, body, 4):
+                    self.pending.pop(intent, None)
+                shadow.applyUpdates(sw_name, _updates(body[4 + 8 * count:]))
+        return records
+
+    def recover(self):
+        """Rebuild the attached shadow from the newest snapshot and the records after it.
+
+        Then start recording in a new segment (and snapshot the recovered
+        state into it). Returns the number of journal records replayed; the
+        intents whose outcome is unknown are left in uncertain() for
+        settleUncertain().
+        """
+        shadow = self.shadow
+        snapshots = _files(self.directory, _SNAPSHOT)
+        start = 0
+        for generation, path in reversed(snapshots):
+            if self._loadSnapshot(path, shadow):
+                start = generation
+                break
+        records = 0
+        segments = _files(self.directory, _SEGMENT)
+        for generation, path in segments:
+            if generation >= start:
+                records += self._replay(path, shadow)
+        # The recovered state (and the intents still uncertain) become the
+        # snapshot of a fresh segment
+        self.generation = max([start] + [g for g, _ in segments + snapshots]) + 1
+        self._writeSnapshot(self.generation, shadow.snapshot(), sorted(self.pending.items()))
+        self._prune(self.generation)
+        self._file = self._openSegment(self.generation)
+        self._thread = threading.Thread(target=self._run, name='journal')
+        self._thread.daemon = True
+        self._thread.start()
+        return records
+
+    def close(self):
+        """Write out and fsync everything queued, then stop."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._file = None
+
+
+def _readEntry(sw, entry):
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    query = request.entities.add().table_entry
+    query.CopyFrom(entry)
+    query.ClearField('action')
+    try:
+        for response in sw.client_stub.Read(request):
+            for entity in response.entities:
+                return entity.table_entry
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.NOT_FOUND:
+            raise
+    return None
+
+
+def settleUncertain(sw, shadow, journal):
+    """Read back just the entries of sw touched by uncertain intents.
+
+    Returns the number of entries read.
+    """
+    intents = journal.uncertain().get(sw.name, [])
+    if not intents:
+        return 0
+    keys = {}
+    for _, updates in intents:
+        for update in updates:
+            entry = update.entity.table_entry
+            if update.entity.HasField('table_entry') and not entry.is_default_action:
+                keys[entryKey(entry)] = entry
+    found, missing = [], []
+    for entry in keys.values():
+        current = _readEntry(sw, entry)
+        if current is None:
+            missing.append(entry)
+        else:
+            found.append(current)
+    shadow.settle(sw.name, found, missing, [seq for seq, _ in intents])
+    return len(keys)
@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+from p4.v1 import p4runtime_pb2_grpc
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Read RPCs are labelled after the p4runtime_lib call that issues them
+_READ_NAMES = {
+    'table_entry': 'ReadTableEntries',
+    'counter_entry': 'ReadCounters',
+}
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for n, v in zip(names, values))
+
+
+class MetricsRegistry(object):
+    """Per-switch RPC metrics and free-form gauges, rendered in the
+    Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+        self.sent_bytes = {}
+        self.received_bytes = {}
+        self.gauges = {}
+        self.gauge_help = {}
+
+    def observeRpc(self, switch, rpc, seconds, code, sent, received):
+        key = (switch, rpc)
+        with self.lock:
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(seconds)
+            self.sent_bytes[key] = self.sent_bytes.get(key, 0) + sent
+            self.received_bytes[key] = self.received_bytes.get(key, 0) + received
+            if code is not None and code != grpc.StatusCode.OK:
+                error_key = (switch, rpc, code.name)
+                self.errors[error_key] = self.errors.get(error_key, 0) + 1
+
+    def setGauge(self, name, help_text, labels, value):
+        """labels is a tuple of (name, value) pairs."""
+        with self.lock:
+            self.gauge_help[name] = help_text
+            self.gauges[(name, labels)] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP p4rt_rpc_duration_seconds P4Runtime RPC latency')
+            lines.append('# TYPE p4rt_rpc_duration_seconds histogram')
+            for (switch, rpc), h in sorted(self.latency.items()):
+                labels = _labels(('switch', 'rpc'), (switch, rpc))
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('p4rt_rpc_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+                lines.append('p4rt_rpc_duration_seconds_sum{%s} %f' % (labels, h.total))
+                lines.append('p4rt_rpc_duration_seconds_count{%s} %d' % (labels, h.count))
+            lines.append('# HELP p4rt_rpc_errors_total Failed P4Runtime RPCs by status code')
+            lines.append('# TYPE p4rt_rpc_errors_total counter')
+            for (switch, rpc, code), count in sorted(self.errors.items()):
+                lines.append('p4rt_rpc_errors_total{%s} %d' % (
+                    _labels(('switch', 'rpc', 'code'), (switch, rpc, code)), count))
+            for name, values, help_text in (
+                    ('p4rt_rpc_sent_bytes_total', self.sent_bytes, 'Serialized request bytes'),
+                    ('p4rt_rpc_received_bytes_total', self.received_bytes, 'Serialized response bytes')):
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s counter' % name)
+                for (switch, rpc), value in sorted(values.items()):
+                    lines.append('%s{%s} %d' % (name, _labels(('switch', 'rpc'), (switch, rpc)), value))
+            by_name = {}
+            for (name, labels), value in self.gauges.items():
+                by_name.setdefault(name, []).append((labels, value))
+            for name in sorted(by_name):
+                lines.append('# HELP %s %s' % (name, self.gauge_help[name]))
+                lines.append('# TYPE %s gauge' % name)
+                for labels, value in sorted(by_name[name]):
+                    lines.append('%s{%s} %s' % (name, _labels([l[0] for l in labels], [l[1] for l in labels]),
+                                                repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+def _messageSize(message):
+    if isinstance(message, bytes):
+        return len(message)
+    return message.ByteSize()
+
+
+def _rpcName(method, request):
+    rpc = method.rsplit('/', 1)[-1]
+    if rpc == 'Read' and len(request.entities):
+        return _READ_NAMES.get(request.entities[0].WhichOneof('entity'), rpc)
+    return rpc
+
+
+class MetricsInterceptor(grpc.UnaryUnaryClientInterceptor,
+                         grpc.UnaryStreamClientInterceptor):
+    """Records latency, status code and payload bytes of every unary and
+    server-streaming RPC on a switch channel."""
+
+    def __init__(self, registry, switch_name):
+        self.registry = registry
+        self.switch_name = switch_name
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        rpc = _rpcName(client_call_details.method, request)
+        sent = _messageSize(request)
+        start = time.perf_counter()
+        outcome = continuation(client_call_details, request)
+
+        def done(call):
+            elapsed = time.perf_counter() - start
+            received = 0
+            code = call.code()
+            if code == grpc.StatusCode.OK:
+                received = _messageSize(call.result())
+            self.registry.observeRpc(self.switch_name, rpc, elapsed, code, sent, received)
+
+        outcome.add_done_callback(done)
+        return outcome
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        rpc = _rpcName(client_call_details.method, request)
+        sent = _messageSize(request)
+        start = time.perf_counter()
+        responses = continuation(client_call_details, request)
+        return _MeteredStream(responses, self.registry, self.switch_name, rpc, start, sent)
+
+
+class _MeteredStream(object):
+    """Wraps a response iterator; the RPC is recorded when it is exhausted."""
+
+    def __init__(self, responses, registry, switch_name, rpc, start, sent):
+        self._responses = responses
+        self._registry = registry
+        self._switch_name = switch_name
+        self._rpc = rpc
+        self._start = start
+        self._sent = sent
+        self._received = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._responses)
+        except StopIteration:
+            self._finish(grpc.StatusCode.OK)
+            raise
+        except grpc.RpcError as e:
+            self._finish(e.code())
+            raise
+        self._received += response.ByteSize()
+        return response
+
+    def _finish(self, code):
+        if not self._done:
+            self._done = True
+            self._registry.observeRpc(self._switch_name, self._rpc,
+                                      time.perf_counter() - self._start,
+                                      code, self._sent, self._received)
+
+    def __getattr__(self, name):
+        return getattr(self._responses, name)
+
+
+def instrumentSwitch(sw, registry):
+    """Route sw's RPCs through a MetricsInterceptor and time arbitration.
+
+    Must be called before the first RPC. The StreamChannel opened by the
+    connection is left alone; MasterArbitrationUpdate is timed around the
+    call instead. Managed connections keep the interceptor across reconnects.
+    """
+    interceptor = MetricsInterceptor(registry, sw.name)
+    if hasattr(sw, 'addInterceptor'):
+        sw.addInterceptor(interceptor)
+    else:
+        sw.channel = grpc.intercept_channel(sw.channel, interceptor)
+        sw.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(sw.channel)
+    arbitrate = sw.MasterArbitrationUpdate
+
+    def MasterArbitrationUpdate(*args, **kwargs):
+        start = time.perf_counter()
+        code = grpc.StatusCode.OK
+        try:
+            return arbitrate(*args, **kwargs)
+        except grpc.RpcError as e:
+            code = e.code()
+            raise
+        finally:
+            registry.observeRpc(sw.name, 'MasterArbitrationUpdate',
+                                time.perf_counter() - start, code, 0, 0)
+
+    sw.MasterArbitrationUpdate = MasterArbitrationUpdate
+
+
+def startMetricsServer(registry, port, host='127.0.0.1'):
+    """Serve registry.render() on http://host:port/metrics in the background."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+from types import MappingProxyType
+
+INDEX_VERSION = 2
+
+
+def _frozen(mapping):
+    return MappingProxyType(dict(mapping))
+
+
+def _pairs(mapping):
+    # JSON object keys are strings; IDs are kept as ints in [id, value] pairs
+    return [[key, value] for key, value in mapping.items()]
+
+
+def _nestedPairs(mapping):
+    return [[key, _pairs(value)] for key, value in mapping.items()]
+
+
+def _nestedDict(pairs):
+    return dict((key, dict(value)) for key, value in pairs)
+
+
+class P4InfoIndex(object):
+    """Read-only ID/name lookup tables for one P4Info.
+
+    P4InfoHelper resolves names by scanning the P4Info on every call; this
+    index is built once and answers each lookup with a dict access. Match
+    fields and action params are keyed by table/action ID so that decoding an
+    entry never needs a name lookup first.
+    """
+
+    __slots__ = ('digest', 'table_names', 'table_ids', 'match_field_names',
+                 'action_names', 'action_ids', 'action_param_names',
+                 'counter_names', 'counter_ids')
+
+    def __init__(self, digest, tables, match_fields, actions, action_params, counters):
+        self.digest = digest
+        self.table_names = _frozen(tables)
+        self.table_ids = _frozen((name, id_) for id_, name in tables.items())
+        self.match_field_names = _frozen(
+            (table_id, _frozen(fields)) for table_id, fields in match_fields.items())
+        self.action_names = _frozen(actions)
+        self.action_ids = _frozen((name, id_) for id_, name in actions.items())
+        self.action_param_names = _frozen(
+            (action_id, _frozen(params)) for action_id, params in action_params.items())
+        self.counter_names = _frozen(counters)
+        self.counter_ids = _frozen((name, id_) for id_, name in counters.items())
+
+    @classmethod
+    def fromP4Info(cls, p4info, digest=None):
+        if digest is None:
+            digest = p4infoDigest(p4info)
+        tables = dict((t.preamble.id, t.preamble.name) for t in p4info.tables)
+        match_fields = dict(
+            (t.preamble.id, dict((mf.id, mf.name) for mf in t.match_fields))
+            for t in p4info.tables)
+        actions = dict((a.preamble.id, a.preamble.name) for a in p4info.actions)
+        action_params = dict(
+            (a.preamble.id, dict((p.id, p.name) for p in a.params))
+            for a in p4info.actions)
+        counters = dict((c.preamble.id, c.preamble.name) for c in p4info.counters)
+        return cls(digest, tables, match_fields, actions, action_params, counters)
+
+    def tableName(self, table_id):
+        return self.table_names[table_id]
+
+    def tableId(self, table_name):
+        return self.table_ids[table_name]
+
+    def matchFieldName(self, table_id, field_id):
+        return self.match_field_names[table_id][field_id]
+
+    def actionName(self, action_id):
+        return self.action_names[action_id]
+
+    def actionId(self, action_name):
+        return self.action_ids[action_name]
+
+    def actionParamName(self, action_id, param_id):
+        return self.action_param_names[action_id][param_id]
+
+    def counterId(self, counter_name):
+        return self.counter_ids[counter_name]
+
+    def toJson(self):
+        return json.dumps({
+            'version': INDEX_VERSION, 'digest': self.digest,
+            'tables': _pairs(self.table_names),
+            'match_fields': _nestedPairs(self.match_field_names),
+            'actions': _pairs(self.action_names),
+            'action_params': _nestedPairs(self.action_param_names),
+            'counters': _pairs(self.counter_names)})
+
+    @classmethod
+    def fromJson(cls, text):
+        state = json.loads(text)
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError("unsupported P4Info index version %r" % (state.get('version'),))
+        return cls(state['digest'], dict(state['tables']), _nestedDict(state['match_fields']),
+                   dict(state['actions']), _nestedDict(state['action_params']),
+                   dict(state['counters']))
+
+
+def p4infoDigest(p4info):
+    return hashlib.sha256(p4info.SerializeToString(deterministic=True)).hexdigest()
+
+
+def loadIndex(p4info, p4info_file_path=None):
+    """Build the index for p4info, using <p4info_file_path>.index as a cache.
+
+    The cache is only used when its digest matches p4info; otherwise the
+    index is rebuilt and the cache rewritten (best effort).
+    """
+    digest = p4infoDigest(p4info)
+    if p4info_file_path is None:
+        return P4InfoIndex.fromP4Info(p4info, digest)
+    cache_path = p4info_file_path + '.index'
+    try:
+        with open(cache_path) as f:
+            index = P4InfoIndex.fromJson(f.read())
+        if index.digest == digest:
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    index = P4InfoIndex.fromP4Info(p4info, digest)
+    try:
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(index.toJson())
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        pass
+    return index
+
+
+def attachIndex(p4info_helper, p4info_file_path=None):
+    """Build (or load) the index for a P4InfoHelper and remember it there."""
+    p4info_helper.p4info_index = loadIndex(p4info_helper.p4info, p4info_file_path)
+    return p4info_helper.p4info_index
+
+
+def indexFor(p4info_helper):
+    index = getattr(p4info_helper, 'p4info_index', None)
+    if index is None:
+        index = attachIndex(p4info_helper)
+    return index
@@ -0,0 +1,185 @@
+from collections import deque
+
+MAX_TUNNEL_ID = 0xffff
+
+TUNNEL_INGRESS_TABLE = "MyIngress.ipv4_lpm"
+TUNNEL_TABLE = "MyIngress.myTunnel_exact"
+TUNNEL_FIELD = "hdr.myTunnel.dst_id"
+
+
+class PathEngine(object):
+    """Shortest paths over the "links" section of a topology.
+
+    Links are {"a", "a_port", "b", "b_port"}. The first query towards a
+    destination runs one BFS from it, which yields the next hop of every
+    switch at once; it is cached until invalidate(). All-pairs paths for N
+    switches therefore cost N BFS runs. Ties are broken by switch name, so
+    the same topology always gives the same paths.
+    """
+
+    def __init__(self, links=()):
+        self.ports = {}
+        for link in links:
+            self.addLink(link['a'], link['a_port'], link['b'], link['b_port'])
+
+    def addLink(self, a, a_port, b, b_port):
+        self.ports.setdefault(a, {})[b] = a_port
+        self.ports.setdefault(b, {})[a] = b_port
+        self.invalidate()
+
+    def removeLink(self, a, b):
+        self.ports.get(a, {}).pop(b, None)
+        self.ports.get(b, {}).pop(a, None)
+        self.invalidate()
+
+    def invalidate(self):
+        self._trees = {}
+        self._neighbours = dict((sw, sorted(ports)) for sw, ports in self.ports.items())
+
+    def switches(self):
+        return sorted(self.ports)
+
+    def tree(self, dst):
+        """{switch: next hop towards dst} for every switch that can reach dst."""
+        tree = self._trees.get(dst)
+        if tree is None:
+            tree = {dst: None}
+            queue = deque([dst])
+            neighbours = self._neighbours
+            while queue:
+                current = queue.popleft()
+                for neighbour in neighbours.get(current, ()):
+                    if neighbour not in tree:
+                        tree[neighbour] = current
+                        queue.append(neighbour)
+            self._trees[dst] = tree
+        return tree
+
+    def nextHop(self, src, dst):
+        """First switch after src on a shortest path to dst (None if unreachable)."""
+        return self.tree(dst).get(src) if src != dst else None
+
+    def path(self, src, dst):
+        """[src, ..., dst], or None if dst cannot be reached."""
+        tree = self.tree(dst)
+        if src not in tree:
+            return None
+        path = [src]
+        while path[-1] != dst:
+            path.append(tree[path[-1]])
+        return path
+
+    def port(self, sw, neighbour):
+        return self.ports[sw][neighbour]
+
+
+class TunnelIdAllocator(object):
+    """Hands out tunnel ids from first..last, one bit per id."""
+
+    def __init__(self, first=1, last=MAX_TUNNEL_ID):
+        if not 0 <= first <= last:
+            raise ValueError("Bad tunnel id range %d..%d" % (first, last))
+        self.first = first
+        self.last = last
+        self._bits = bytearray((last - first) // 8 + 1)
+        self._cursor = 0
+        self.used = 0
+
+    def _offset(self, tunnel_id):
+        if not self.first <= tunnel_id <= self.last:
+            raise ValueError("Tunnel id %d outside %d..%d" % (tunnel_id, self.first, self.last))
+        return tunnel_id - self.first
+
+    def isUsed(self, tunnel_id):
+        offset = self._offset(tunnel_id)
+        return bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+
+    def reserve(self, tunnel_id):
+        """Mark a specific id (e.g. one given in the topology) as taken."""
+        if self.isUsed(tunnel_id):
+            raise ValueError("Tunnel id %d is already in use" % tunnel_id)
+        offset = self._offset(tunnel_id)
+        self._bits[offset >> 3] |= 1 << (offset & 7)
+        self.used += 1
+
+    def allocate(self):
+        size = self.last - self.first + 1
+        # Whole bytes at a time from the cursor, wrapping around once
+        nbytes = len(self._bits)
+        start = self._cursor >> 3
+        for i in range(nbytes):
+            byte_index = (start + i) % nbytes
+            byte = self._bits[byte_index]
+            if byte == 0xff:
+                continue
+            for bit in range(8):
+                offset = (byte_index << 3) | bit
+                if offset < size and not byte & (1 << bit):
+                    self._bits[byte_index] = byte | (1 << bit)
+                    self._cursor = offset + 1
+                    self.used += 1
+                    return self.first + offset
+        raise ValueError("No tunnel ids left in %d..%d" % (self.first, self.last))
+
+    def free(self, tunnel_id):
+        offset = self._offset(tunnel_id)
+        if self._bits[offset >> 3] & (1 << (offset & 7)):
+            self._bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+            self.used -= 1
+
+
+def meshTunnels(engine, hosts, allocator):
+    """One tunnel from every switch to every host on another switch.
+
+    hosts is the topology's "hosts" mapping ({"ip", "mac", "switch",
+    "port"}). Tunnels come out in a fixed order (host name, then ingress
+    switch), so ids are stable for a given topology. Destinations that
+    cannot be reached get no tunnel.
+    """
+    tunnels = []
+    for host_name in sorted(hosts):
+        host = hosts[host_name]
+        egress = host['switch']
+        tree = engine.tree(egress)
+        for ingress in engine.switches():
+            if ingress == egress or ingress not in tree:
+                continue
+            tunnels.append({
+                "ingress": ingress, "egress": egress, "tunnel_id": allocator.allocate(),
+                "dst_eth_addr": host['mac'], "dst_ip_addr": host['ip'],
+                "switch_to_host_port": host['port'],
+            })
+    return tunnels
+
+
+def tunnelPathRules(engine, tunnel):
+    """(switch name, rule) pairs for a tunnel along its shortest path.
+
+    The ingress switch encapsulates, every switch but the last forwards on
+    the tunnel id towards the next hop (transit), and the egress switch
+    decapsulates to the host.
+    """
+    tunnel_id = tunnel['tunnel_id']
+    path = engine.path(tunnel['ingress'], tunnel['egress'])
+    if path is None:
+        raise ValueError("No path from %s to %s" % (tunnel['ingress'], tunnel['egress']))
+    rules = [(path[0], {
+        "table": TUNNEL_INGRESS_TABLE,
+        "match": {"hdr.ipv4.dstAddr": [tunnel['dst_ip_addr'], 32]},
+        "action": "MyIngress.myTunnel_ingress",
+        "params": {"dst_id": tunnel_id},
+    })]
+    for sw, next_sw in zip(path, path[1:]):
+        rules.append((sw, {
+            "table": TUNNEL_TABLE,
+            "match": {TUNNEL_FIELD: tunnel_id},
+            "action": "MyIngress.myTunnel_forward",
+            "params": {"port": engine.port(sw, next_sw)},
+        }))
+    rules.append((path[-1], {
+        "table": TUNNEL_TABLE,
+        "match": {TUNNEL_FIELD: tunnel_id},
+        "action": "MyIngress.myTunnel_egress",
+        "params": {"dstAddr": tunnel['dst_eth_addr'], "port": tunnel['switch_to_host_port']},
+    }))
+    return rules
@@ -0,0 +1,165 @@
+import hashlib
+import time
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import setElectionId
+
+
+SET_PIPELINE_METHOD = '/p4.v1.P4Runtime/SetForwardingPipelineConfig'
+
+
+def _cookie(p4info, device_data):
+    digest = hashlib.sha256()
+    digest.update(p4info.SerializeToString(deterministic=True))
+    digest.update(device_data)
+    return int.from_bytes(digest.digest()[:8], 'big')
+
+
+def pipelineCookie(p4info, bmv2_json_file_path):
+    """64-bit cookie identifying a (p4info, bmv2 JSON) pair."""
+    with open(bmv2_json_file_path, 'rb') as f:
+        return _cookie(p4info, f.read())
+
+
+class PreparedPipeline(object):
+    """A (p4info, bmv2 JSON) pair read and serialized once for every switch.
+
+    The JSON is read into one bytes buffer and the config part of the
+    SetForwardingPipelineConfigRequest (p4info, device config, cookie) is
+    serialized once. A push only serializes the per-switch header (device
+    id, election id, action) and prepends it: protobuf merges concatenated
+    messages, so the result is the full request. It is sent through a
+    bytes-in unary callable on the switch channel, so nothing is parsed or
+    re-serialized on the way out.
+    """
+
+    def __init__(self, p4info, bmv2_json_file_path):
+        with open(bmv2_json_file_path, 'rb') as f:
+            self.device_data = f.read()
+        self.cookie = _cookie(p4info, self.device_data)
+        self.p4info = p4info
+        self._config = None
+
+    def _configBytes(self):
+        if self._config is None:
+            # Same device config as Bmv2SwitchConnection.buildDeviceConfig
+            from p4.tmp import p4config_pb2
+
+            device_config = p4config_pb2.P4DeviceConfig()
+            device_config.reassign = True
+            device_config.device_data = self.device_data
+            request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+            request.config.p4info.CopyFrom(self.p4info)
+            request.config.p4_device_config = device_config.SerializeToString()
+            request.config.cookie.cookie = self.cookie
+            self._config = request.SerializeToString()
+        return self._config
+
+    def requestBytes(self, sw):
+        header = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+        header.device_id = sw.device_id
+        setElectionId(header.election_id, sw)
+        header.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+        return header.SerializeToString() + self._configBytes()
+
+    def _callable(self, sw):
+        return sw.channel.unary_unary(
+            SET_PIPELINE_METHOD, request_serializer=None,
+            response_deserializer=p4runtime_pb2.SetForwardingPipelineConfigResponse.FromString)
+
+    def push(self, sw):
+        self.pushAll([sw])
+
+    def pushAll(self, switches):
+        """Push to every switch with the uploads in flight at the same time.
+
+        Managed connections get one reconnect-and-retry for an UNAVAILABLE
+        push. Raises the first error once every push has finished.
+        """
+        calls = [(sw, getattr(sw, 'generation', 0), self._callable(sw).future(self.requestBytes(sw)))
+                 for sw in switches]
+        error = None
+        for sw, generation, call in calls:
+            try:
+                try:
+                    call.result()
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.UNAVAILABLE or not hasattr(sw, 'recover'):
+                        raise
+                    sw.recover(generation, 0, time.monotonic() + sw.reconnect_timeout)
+                    self._callable(sw)(self.requestBytes(sw))
+            except grpc.RpcError as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+
+def getPipelineCookie(sw):
+    """Cookie of the pipeline currently on sw, or None if it has none."""
+    request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+    request.device_id = sw.device_id
+    request.response_type = p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+    try:
+        response = sw.client_stub.GetForwardingPipelineConfig(request)
+    except grpc.RpcError as e:
+        if e.code() in (grpc.StatusCode.FAILED_PRECONDITION, grpc.StatusCode.NOT_FOUND):
+            return None
+        raise
+    if not response.config.HasField('cookie'):
+        return None
+    return response.config.cookie.cookie
+
+
+def setPipelineConfig(sw, p4info, bmv2_json_file_path, cookie):
+    """SetForwardingPipelineConfig, tagging the config with cookie."""
+    device_config = sw.buildDeviceConfig(bmv2_json_file_path=bmv2_json_file_path)
+    request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+    request.device_id = sw.device_id
+    setElectionId(request.election_id, sw)
+    config = request.config
+    config.p4info.CopyFrom(p4info)
+    config.p4_device_config = device_config.SerializeToString()
+    config.cookie.cookie = cookie
+    request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+    sw.client_stub.SetForwardingPipelineConfig(request)
+
+
+def ensurePipeline(sw, p4info, bmv2_json_file_path, warm=False, cookie=None, prepared=None):
+    """Push the pipeline to sw unless warm is set and it is already there.
+
+    Returns True when the pipeline was pushed (and the tables were wiped),
+    False when the switch already runs a pipeline with the same cookie and
+    its table state was left untouched. With a PreparedPipeline for the
+    same pair, nothing is read or serialized again.
+    """
+    if prepared is not None:
+        cookie = prepared.cookie
+    elif cookie is None:
+        cookie = pipelineCookie(p4info, bmv2_json_file_path)
+    if warm and getPipelineCookie(sw) == cookie:
+        return False
+    if prepared is not None:
+        prepared.push(sw)
+    else:
+        setPipelineConfig(sw, p4info, bmv2_json_file_path, cookie)
+    return True
+
+
+def ensurePipelines(switches, prepared, warm=False):
+    """ensurePipeline for several switches, with the pushes overlapping.
+
+    Returns {switch name: pushed}.
+    """
+    stale = [sw for sw in switches if not warm or getPipelineCookie(sw) != prepared.cookie]
+    prepared.pushAll(stale)
+    pushed = set(sw.name for sw in stale)
+    return dict((sw.name, sw.name in pushed) for sw in switches)
+
+
+def printPipelineStatus(sw, pushed):
+    if pushed:
+        print("Installed P4 Program using SetForwardingPipelineConfig on %s" % sw.name)
+    else:
+        print("P4 Program unchanged on %s, reconciling rules in place" % sw.name)
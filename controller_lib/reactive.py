@@ -0,0 +1,139 @@
+import asyncio
+import threading
+from collections import deque
+
+import grpc
+
+from controller_lib.batch import DEFAULT_BATCH_SIZE, WriteBatcher
+from controller_lib.ruleset import entryKey
+
+DEFAULT_MAX_DELAY = 0.001
+DEFAULT_MAX_WRITES = 4
+DEFAULT_QUEUE_SIZE = 4096
+
+
+class LatencyRecorder(object):
+    """Keeps the last capacity samples for percentile reporting."""
+
+    def __init__(self, capacity=100000):
+        self.samples = deque(maxlen=capacity)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentiles(self, fractions=(0.5, 0.9, 0.99)):
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return [0.0] * len(fractions)
+        return [ordered[min(int(len(ordered) * f), len(ordered) - 1)] for f in fractions]
+
+
+class CoalescingInstaller(object):
+    """Batches table writes issued one flow at a time from asyncio code.
+
+    install() queues an entry and returns once the Write carrying it has
+    completed. Entries that arrive within max_delay of the first queued
+    one, up to batch_size, share one WriteRequest per switch. Concurrent
+    installs of the same key share one update, and keys already installed
+    return at once, until forget() (or a reconnect of a watch()ed switch)
+    drops them. The queue holds at most maxsize entries and install()
+    waits while it is full. At most max_writes batches are on the wire.
+    observers are passed on to the WriteBatchers.
+    """
+
+    def __init__(self, loop, executor=None, batch_size=DEFAULT_BATCH_SIZE,
+                 max_delay=DEFAULT_MAX_DELAY, maxsize=DEFAULT_QUEUE_SIZE,
+                 max_writes=DEFAULT_MAX_WRITES, observers=()):
+        self.loop = loop
+        self.observers = observers
+        self.executor = executor
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(maxsize)
+        self.writes = asyncio.Semaphore(max_writes)
+        self.installed = set()
+        self.inflight = {}
+        self.batches = 0
+
+    async def install(self, sw, table_entry):
+        """Returns None on success or the UpdateError the switch reported."""
+        key = (sw.name, entryKey(table_entry))
+        if key in self.installed:
+            return None
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = self.loop.create_future()
+            await self.queue.put((sw, key, table_entry, future))
+        return await asyncio.shield(future)
+
+    def forget(self, sw, table_entry=None):
+        """Write table_entry again on its next install(); all of sw's by default."""
+        if table_entry is not None:
+            self.installed.discard((sw.name, entryKey(table_entry)))
+        else:
+            self.installed = set(key for key in self.installed if key[0] != sw.name)
+
+    def watch(self, sw):
+        """forget() sw's entries whenever its connection is re-established.
+
+        A switch that comes back may have lost them (restart, new pipeline).
+        """
+        sw.reconnect_callbacks.append(
+            lambda sw: self.loop.call_soon_threadsafe(self.forget, sw))
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.writes.acquire()
+            self.loop.create_task(self._write(batch))
+
+    async def _write(self, batch):
+        try:
+            by_switch = {}
+            for item in batch:
+                by_switch.setdefault(item[0].name, []).append(item)
+            await asyncio.gather(*[self._writeSwitch(items) for items in by_switch.values()])
+            self.batches += 1
+        finally:
+            self.writes.release()
+
+    async def _writeSwitch(self, items):
+        sw = items[0][0]
+        batcher = WriteBatcher(self.batch_size, self.observers)
+        for _, _, table_entry, _ in items:
+            batcher.add(sw, table_entry)
+        try:
+            errors = await self.loop.run_in_executor(self.executor, batcher.flushSwitch, sw)
+        except grpc.RpcError as e:
+            for _, key, _, future in items:
+                del self.inflight[key]
+                self.installed.discard(key)
+                future.set_exception(e)
+            return
+        rejected = dict(((sw.name, entryKey(error.update.entity.table_entry)), error)
+                        for error in errors if error.code != grpc.StatusCode.ALREADY_EXISTS)
+        for _, key, _, future in items:
+            del self.inflight[key]
+            error = rejected.get(key)
+            if error is None:
+                self.installed.add(key)
+            else:
+                self.installed.discard(key)
+            future.set_result(error)
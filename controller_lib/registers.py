@@ -0,0 +1,188 @@
+import math
+import time
+from collections import OrderedDict
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import DEFAULT_BATCH_SIZE, writeUpdates
+
+DEFAULT_BLOOM_REGISTERS = ('MyIngress.bloom_filter_1', 'MyIngress.bloom_filter_2')
+DEFAULT_MAX_FPR = 0.01
+
+
+def registerSize(p4info, register_id):
+    for register in p4info.registers:
+        if register.preamble.id == register_id:
+            return register.size
+    raise AttributeError("Could not find register with id %d" % register_id)
+
+
+def readRegisterArrays(sw, register_ids):
+    """Read whole register arrays from sw with a single wildcard ReadRequest.
+
+    Returns {register_id: {index: value}}, values decoded as unsigned ints.
+    """
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    for register_id in register_ids:
+        request.entities.add().register_entry.register_id = register_id
+    values = dict((register_id, {}) for register_id in register_ids)
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            register = entity.register_entry
+            values[register.register_id][register.index.index] = int.from_bytes(
+                register.data.bitstring, 'big')
+    return values
+
+
+def buildRegisterUpdate(register_id, index=None, value=0):
+    """A MODIFY of one register cell, or of every cell when index is None."""
+    update = p4runtime_pb2.Update()
+    update.type = p4runtime_pb2.Update.MODIFY
+    register = update.entity.register_entry
+    register.register_id = register_id
+    if index is not None:
+        register.index.index = index
+    register.data.bitstring = value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big')
+    return update
+
+
+class BloomFilterStats(object):
+    """Occupancy of the k single-hash bit arrays of one bloom filter.
+
+    Each array is indexed by its own hash, so a lookup is a false positive
+    with probability equal to the product of the fill ratios.
+    """
+
+    __slots__ = ('switch', 'registers', 'sizes', 'set_cells')
+
+    def __init__(self, switch, registers, sizes, set_cells):
+        self.switch = switch
+        self.registers = registers
+        self.sizes = sizes
+        self.set_cells = set_cells
+
+    @property
+    def fill(self):
+        return [float(s) / m if m else 0.0 for s, m in zip(self.set_cells, self.sizes)]
+
+    @property
+    def false_positive_rate(self):
+        rate = 1.0
+        for fill in self.fill:
+            rate *= fill
+        return rate
+
+    @property
+    def estimated_flows(self):
+        """Flows inserted since the last reset, averaged over the arrays."""
+        estimates = []
+        for fill, m in zip(self.fill, self.sizes):
+            estimates.append(float('inf') if fill >= 1.0 else -m * math.log(1.0 - fill))
+        return sum(estimates) / len(estimates) if estimates else 0.0
+
+    def __str__(self):
+        return "%s: bloom filter %s full, ~%.0f flows, est. FPR %.2f%%" % (
+            self.switch, ' / '.join('%.1f%%' % (f * 100) for f in self.fill),
+            self.estimated_flows, self.false_positive_rate * 100)
+
+
+class BloomFilterReset(object):
+    """One reset of a switch's bloom filter by BloomFilterManager.check()."""
+
+    __slots__ = ('switch', 'reason', 'updates', 'wildcard', 'errors')
+
+    def __init__(self, switch, reason, updates, wildcard, errors):
+        self.switch = switch
+        self.reason = reason
+        self.updates = updates
+        self.wildcard = wildcard
+        self.errors = errors
+
+    def __str__(self):
+        text = "%s: bloom filter reset (%s), %d %s" % (
+            self.switch, self.reason, self.updates,
+            'wildcard writes' if self.wildcard else 'per-index writes')
+        for error in self.errors:
+            text += "\n  Rejected update: %s" % error
+        return text
+
+
+class BloomFilterManager(object):
+    """Monitors and ages the firewall's connection-tracking bloom filter.
+
+    check() reads all arrays of the filter in one RPC and resets them
+    together once the estimated false-positive rate exceeds max_fpr, or
+    reset_interval seconds after the previous reset (0 disables aging).
+    Resets use one wildcard MODIFY per array; switches that reject it get
+    per-index writes of just the cells that are set.
+    """
+
+    def __init__(self, p4info_helper, register_names=DEFAULT_BLOOM_REGISTERS,
+                 max_fpr=DEFAULT_MAX_FPR, reset_interval=0, batch_size=DEFAULT_BATCH_SIZE):
+        self.register_ids = OrderedDict(
+            (name, p4info_helper.get_registers_id(name)) for name in register_names)
+        self.sizes = [registerSize(p4info_helper.p4info, register_id)
+                      for register_id in self.register_ids.values()]
+        self.max_fpr = max_fpr
+        self.reset_interval = reset_interval
+        self.batch_size = batch_size
+        self.last_reset = {}
+        self.wildcard_writes = {}
+
+    def read(self, sw):
+        """Returns (BloomFilterStats, {register_id: {index: value}})."""
+        values = readRegisterArrays(sw, list(self.register_ids.values()))
+        set_cells = [sum(1 for value in values[register_id].values() if value)
+                     for register_id in self.register_ids.values()]
+        stats = BloomFilterStats(sw.name, list(self.register_ids), self.sizes, set_cells)
+        return stats, values
+
+    def _wildcardReset(self, sw):
+        updates = [buildRegisterUpdate(register_id) for register_id in self.register_ids.values()]
+        try:
+            return not writeUpdates(sw, updates)
+        except grpc.RpcError as e:
+            if e.code() not in (grpc.StatusCode.UNIMPLEMENTED, grpc.StatusCode.INVALID_ARGUMENT,
+                                grpc.StatusCode.UNKNOWN):
+                raise
+            return False
+
+    def reset(self, sw, values):
+        """Clear every array; values is the last read, used for the per-index fallback.
+
+        Returns (number of Update messages needed, UpdateErrors).
+        """
+        if self.wildcard_writes.get(sw.name, True):
+            if self._wildcardReset(sw):
+                self.wildcard_writes[sw.name] = True
+                return len(self.register_ids), []
+            self.wildcard_writes[sw.name] = False
+        updates = [buildRegisterUpdate(register_id, index)
+                   for register_id in self.register_ids.values()
+                   for index, value in sorted(values[register_id].items()) if value]
+        errors = []
+        for start in range(0, len(updates), self.batch_size):
+            errors.extend(writeUpdates(sw, updates[start:start + self.batch_size]))
+        return len(updates), errors
+
+    def check(self, sw, now=None):
+        """Read the filter on sw and reset it if due.
+
+        Returns (BloomFilterStats, BloomFilterReset), the latter None when
+        the filter was left alone.
+        """
+        now = time.monotonic() if now is None else now
+        last = self.last_reset.setdefault(sw.name, now)
+        stats, values = self.read(sw)
+        reason = None
+        if stats.false_positive_rate > self.max_fpr:
+            reason = "FPR %.2f%% > %.2f%%" % (stats.false_positive_rate * 100, self.max_fpr * 100)
+        elif self.reset_interval and now - last >= self.reset_interval:
+            reason = "%ds since last reset" % (now - last)
+        if reason is None:
+            return stats, None
+        count, errors = self.reset(sw, values)
+        self.last_reset[sw.name] = now
+        return stats, BloomFilterReset(sw.name, reason, count, self.wildcard_writes[sw.name], errors)
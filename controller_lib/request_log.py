@@ -0,0 +1,232 @@
+import argparse
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+import grpc
+from google.protobuf import text_format
+from p4.v1 import p4runtime_pb2
+
+MAGIC = b'P4RTLOG1'
+DEFAULT_MAX_BYTES = 64 << 20
+DEFAULT_BACKUPS = 4
+DEFAULT_QUEUE_SIZE = 65536
+# payload length, wall-clock timestamp, method index
+_RECORD = struct.Struct('<IdB')
+
+METHODS = ('Write', 'Read', 'SetForwardingPipelineConfig', 'GetForwardingPipelineConfig',
+           'Capabilities')
+_METHOD_INDEX = dict((name, i) for i, name in enumerate(METHODS))
+_REQUEST_TYPES = {
+    'Write': p4runtime_pb2.WriteRequest,
+    'Read': p4runtime_pb2.ReadRequest,
+    'SetForwardingPipelineConfig': p4runtime_pb2.SetForwardingPipelineConfigRequest,
+    'GetForwardingPipelineConfig': p4runtime_pb2.GetForwardingPipelineConfigRequest,
+    'Capabilities': p4runtime_pb2.CapabilitiesRequest,
+}
+# 'writes' keeps only the RPCs that change switch state
+LEVELS = {
+    'all': frozenset(METHODS),
+    'writes': frozenset(('Write', 'SetForwardingPipelineConfig')),
+    'none': frozenset(),
+}
+
+
+class RequestLog(object):
+    """Records P4Runtime requests to a binary log from a background thread.
+
+    log() only puts the request on a bounded queue; serialization and file
+    I/O happen on the writer thread. When the queue is full the request is
+    dropped and counted in .dropped rather than stalling the caller.
+
+    The file starts with MAGIC, followed by one record per request: a
+    _RECORD header (payload length, time.time(), index into METHODS) and
+    the serialized request. Once the file grows past max_bytes it is
+    rotated to path.1, path.1 to path.2, ... keeping backups old files.
+    A log left by an earlier run is rotated the same way on startup.
+    level picks the methods that are recorded (see LEVELS), and only every
+    sample_every-th of those is kept.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS,
+                 level='all', sample_every=1, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.methods = LEVELS[level]
+        self.sample_every = max(1, sample_every)
+        self.queue = queue.Queue(queue_size)
+        self.seen = 0
+        self.dropped = 0
+        self.written = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The previous run's log is the one needed after a crash: keep it
+        if os.path.exists(path) and os.path.getsize(path) > len(MAGIC):
+            self._shiftBackups()
+        self._file = self._openNew()
+        self._thread = threading.Thread(target=self._run, name='request-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _openNew(self):
+        f = open(self.path, 'wb', buffering=1 << 20)
+        f.write(MAGIC)
+        return f
+
+    def log(self, method, request):
+        if method not in self.methods:
+            return
+        self.seen += 1
+        if self.seen % self.sample_every:
+            return
+        try:
+            self.queue.put_nowait((time.time(), method, request))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(item)
+            # Flush only when idle, so bursts are written in large chunks
+            if self.queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def _write(self, item):
+        timestamp, method, request = item
+        # PreparedPipeline sends already serialized requests
+        payload = request if isinstance(request, bytes) else request.SerializeToString()
+        self._file.write(_RECORD.pack(len(payload), timestamp, _METHOD_INDEX[method]))
+        self._file.write(payload)
+        self.written += 1
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._shiftBackups()
+        self._file = self._openNew()
+
+    def _shiftBackups(self):
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                source = '%s.%d' % (self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, '%s.%d' % (self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+
+    def close(self):
+        """Write out everything queued so far and stop the writer."""
+        self.queue.put(None)
+        self._thread.join()
+
+
+class RequestLogInterceptor(grpc.UnaryUnaryClientInterceptor,
+                            grpc.UnaryStreamClientInterceptor):
+    """Hands every unary request to a RequestLog before sending it."""
+
+    def __init__(self, request_log):
+        self.request_log = request_log
+
+    def _log(self, client_call_details, request):
+        self.request_log.log(client_call_details.method.rsplit('/', 1)[-1], request)
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        self._log(client_call_details, request)
+        return continuation(client_call_details, request)
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        self._log(client_call_details, request)
+        return continuation(client_call_details, request)
+
+
+def logFiles(path):
+    """path and its rotated backups, oldest first."""
+    backups = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        backups.append('%s.%d' % (path, i))
+        i += 1
+    return backups[::-1] + [path]
+
+
+def readRecords(path):
+    """Yield (timestamp, method, request) from one log file.
+
+    A record cut short (the writer was killed mid-write) ends the file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a P4Runtime request log" % path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            length, timestamp, method_index = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            method = METHODS[method_index]
+            yield timestamp, method, _REQUEST_TYPES[method].FromString(payload)
+
+
+def _printSummary(counts):
+    for method in METHODS:
+        if method in counts:
+            requests, updates = counts[method]
+            print("%-28s %8d requests %10d updates" % (method, requests, updates))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m controller_lib.request_log',
+                                     description='Decode binary P4Runtime request logs')
+    parser.add_argument('logs', nargs='+', help='log files (rotated backups are read too)')
+    parser.add_argument('--method', help='only this RPC (e.g. Write)',
+                        type=str, action="append", required=False, default=None)
+    parser.add_argument('--since', help='only requests at or after this Unix time',
+                        type=float, action="store", required=False, default=None)
+    parser.add_argument('--until', help='only requests before this Unix time',
+                        type=float, action="store", required=False, default=None)
+    parser.add_argument('--limit', help='stop after this many requests per log',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('--summary', help='print request and update counts instead of requests',
+                        action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    for log in args.logs:
+        counts = {}
+        shown = 0
+        for timestamp, method, request in (record for path in logFiles(log)
+                                           for record in readRecords(path)):
+            if args.method and method not in args.method:
+                continue
+            if args.since is not None and timestamp < args.since:
+                continue
+            if args.until is not None and timestamp >= args.until:
+                continue
+            if args.limit and shown >= args.limit:
+                break
+            shown += 1
+            if args.summary:
+                requests, updates = counts.get(method, (0, 0))
+                counts[method] = (requests + 1, updates + len(getattr(request, 'updates', ())))
+                continue
+            print("# %s %.6f %s" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                                    timestamp, method))
+            print(text_format.MessageToString(request))
+        if args.summary:
+            print("%s:" % log)
+            _printSummary(counts)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
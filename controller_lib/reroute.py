@@ -0,0 +1,408 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import DEFAULT_BATCH_SIZE, WriteBatcher, buildUpdate
+from controller_lib.bringup import describeError
+from controller_lib.paths import TUNNEL_FIELD, TUNNEL_TABLE, tunnelPathRules
+from controller_lib.reactive import LatencyRecorder
+from controller_lib.ruleset import buildRuleEntry, entryKey
+
+EVENT_KINDS = ('link-down', 'link-up', 'port-down', 'port-up', 'switch-down', 'switch-up')
+
+
+class LinkEvent(object):
+    """A topology change: kind is one of EVENT_KINDS.
+
+    "link-down s1 s2", "port-down s1 2" and "switch-down s3" (and their
+    -up counterparts) are the text forms used in event files and on the
+    control socket. received is the monotonic time the event was read.
+    """
+
+    __slots__ = ('kind', 'args', 'received')
+
+    def __init__(self, kind, args, received=None):
+        self.kind = kind
+        self.args = tuple(args)
+        self.received = time.monotonic() if received is None else received
+
+    def __str__(self):
+        return ' '.join((self.kind,) + tuple(str(a) for a in self.args))
+
+
+def parseEvent(line, received=None):
+    words = line.split()
+    if not words or words[0] not in EVENT_KINDS:
+        raise ValueError("Unknown event %r (have %s)" % (line.strip(), ', '.join(EVENT_KINDS)))
+    kind = words[0]
+    expected = 1 if kind.startswith('switch') else 2
+    if len(words) != expected + 1:
+        raise ValueError("%s takes %d arguments" % (kind, expected))
+    args = words[1:]
+    if kind.startswith('port'):
+        args = [args[0], int(args[1])]
+    return LinkEvent(kind, args, received)
+
+
+class RepairResult(object):
+    """What one event changed and how long the repair took."""
+
+    __slots__ = ('event', 'tunnels', 'updates', 'switches', 'unreachable', 'errors', 'elapsed')
+
+    def __init__(self, event, tunnels, updates, switches, unreachable, errors, elapsed):
+        self.event = event
+        self.tunnels = tunnels
+        self.updates = updates
+        self.switches = switches
+        self.unreachable = unreachable
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def toDict(self):
+        return {'event': str(self.event), 'tunnels': self.tunnels, 'updates': self.updates,
+                'switches': self.switches, 'unreachable': self.unreachable,
+                'errors': [str(e) for e in self.errors], 'elapsed': self.elapsed}
+
+    def __str__(self):
+        text = "%s: rerouted %d tunnels with %d updates on %d switches in %.1f ms" % (
+            self.event, self.tunnels, self.updates, len(self.switches), self.elapsed * 1000)
+        if self.unreachable:
+            text += ", %d unreachable" % len(self.unreachable)
+        if self.errors:
+            text += ", %d errors" % len(self.errors)
+        return text
+
+
+def _linkKey(a, b):
+    return (a, b) if a <= b else (b, a)
+
+
+def _pathLinks(path):
+    return [_linkKey(a, b) for a, b in zip(path, path[1:])] if path else []
+
+
+class Rerouter(object):
+    """Moves tunnels off failed links with the fewest table writes.
+
+    Only the myTunnel_exact entries along a tunnel's path depend on the
+    path (the ipv4_lpm entry on the ingress switch only names the tunnel
+    id), so a reroute is: INSERT forwarding on the switches the new path
+    adds, MODIFY the port where the paths diverge, DELETE what the old path
+    left behind. A link or switch going down only recomputes the tunnels
+    that crossed it; one coming back recomputes all of them (one cached BFS
+    per destination) and rewrites only those whose path changed.
+
+    Updates go out make-before-break: all INSERTs first, then MODIFYs from
+    the egress end towards the ingress, then DELETEs, each step written to
+    every switch concurrently and completed before the next starts. A
+    tunnel with no path left keeps its entries until one comes back.
+    Switches that are down get no updates: the entries a moved tunnel had
+    on them are forgotten, and the resync when the switch reconnects
+    installs desired.
+
+    switches returns {name: connection} of the switches this controller may
+    write (e.g. the ones it is master of); every controller sharing a
+    topology computes the same paths and writes its own part. desired, the
+    compiled {switch: [TableEntry]} the controller installs on (re)sync, is
+    kept in step with the new paths.
+    """
+
+    def __init__(self, p4info_helper, engine, tunnels, links, switches, desired=None,
+                 batch_size=DEFAULT_BATCH_SIZE, observers=(), registry=None):
+        self.p4info_helper = p4info_helper
+        self.engine = engine
+        self.tunnels = dict((t['tunnel_id'], t) for t in tunnels if 'switch_to_switch_port' not in t)
+        self.links = OrderedDict((_linkKey(l['a'], l['b']), l) for l in links)
+        self.switches = switches
+        self.desired = desired
+        self.batch_size = batch_size
+        self.observers = list(observers)
+        self.registry = registry
+        self.down_links = set()
+        self.down_switches = set()
+        self.repairs = LatencyRecorder()
+        self._desired_index = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        # Forwarding entries per tunnel as installed: {tunnel id: {switch: rule}}
+        self.installed = {}
+        self._paths = {}
+        self._by_link = {}
+        self._retry = set()
+        for tunnel_id, tunnel in self.tunnels.items():
+            self._setInstalled(tunnel_id, self._pathForwarding(tunnel),
+                               engine.path(tunnel['ingress'], tunnel['egress']))
+
+    def _entry(self, rule):
+        # A tunnel only ever has a few distinct forwarding rules; compile each once
+        key = (rule['action'], rule['match'][TUNNEL_FIELD], tuple(sorted(rule['params'].items())))
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = buildRuleEntry(self.p4info_helper, rule)
+        return entry
+
+    def _pathForwarding(self, tunnel):
+        return OrderedDict((sw, rule) for sw, rule in tunnelPathRules(self.engine, tunnel)
+                           if rule['table'] == TUNNEL_TABLE)
+
+    def _setInstalled(self, tunnel_id, rules, path):
+        for link in self._paths.get(tunnel_id, ()):
+            self._by_link.get(link, set()).discard(tunnel_id)
+        self._paths[tunnel_id] = links = _pathLinks(path)
+        for link in links:
+            self._by_link.setdefault(link, set()).add(tunnel_id)
+        self.installed[tunnel_id] = rules
+
+    def _linkUp(self, key):
+        a, b = key
+        return key not in self.down_links and a not in self.down_switches and b not in self.down_switches
+
+    def _apply(self, event):
+        """Update the link state; returns the links that went down, or None if some came up."""
+        kind, args = event.kind, event.args
+        if kind.startswith('switch'):
+            keys = [key for key in self.links if args[0] in key]
+        elif kind.startswith('port'):
+            sw, port = args
+            keys = [key for key, l in self.links.items()
+                    if (l['a'], l['a_port']) == (sw, port) or (l['b'], l['b_port']) == (sw, port)]
+        else:
+            keys = [_linkKey(*args)]
+        for key in keys:
+            if key not in self.links:
+                raise ValueError("Unknown link %s-%s" % key)
+        if not keys and not kind.startswith('switch'):
+            raise ValueError("No link on %s port %d" % tuple(args))
+
+        was_up = dict((key, self._linkUp(key)) for key in keys)
+        down = kind.endswith('down')
+        if kind.startswith('switch'):
+            if down:
+                self.down_switches.add(args[0])
+            else:
+                self.down_switches.discard(args[0])
+        else:
+            for key in keys:
+                if down:
+                    self.down_links.add(key)
+                else:
+                    self.down_links.discard(key)
+        changed = [key for key in keys if was_up[key] != self._linkUp(key)]
+        for key in changed:
+            link = self.links[key]
+            if self._linkUp(key):
+                self.engine.addLink(link['a'], link['a_port'], link['b'], link['b_port'])
+            else:
+                self.engine.removeLink(link['a'], link['b'])
+        if not down:
+            return None if changed else []
+        return changed
+
+    def _plan(self, tunnel_ids):
+        """Updates per step for the tunnels whose path changed."""
+        inserts, modifies, deletes = [], [], []
+        moved, unreachable = {}, []
+        for tunnel_id in tunnel_ids:
+            tunnel = self.tunnels[tunnel_id]
+            path = self.engine.path(tunnel['ingress'], tunnel['egress'])
+            if path is None:
+                unreachable.append(tunnel_id)
+                continue
+            old = self.installed[tunnel_id]
+            if _pathLinks(path) == self._paths[tunnel_id]:
+                continue
+            new = self._pathForwarding(tunnel)
+            moved[tunnel_id] = (new, path)
+            distance = dict((sw, len(path) - i) for i, sw in enumerate(path))
+            for sw, rule in new.items():
+                if sw not in old:
+                    inserts.append((tunnel_id, sw, rule, p4runtime_pb2.Update.INSERT))
+                elif old[sw] != rule:
+                    modifies.append((distance[sw], tunnel_id, sw, rule))
+            for sw, rule in old.items():
+                # A switch that is down would only time out
+                if sw not in new and sw not in self.down_switches:
+                    deletes.append((tunnel_id, sw, rule, p4runtime_pb2.Update.DELETE))
+        steps = [inserts]
+        for level in sorted(set(m[0] for m in modifies)):
+            steps.append([(tunnel_id, sw, rule, p4runtime_pb2.Update.MODIFY)
+                          for d, tunnel_id, sw, rule in modifies if d == level])
+        steps.append(deletes)
+        return [step for step in steps if step], moved, unreachable
+
+    def _writeSwitch(self, sw, updates):
+        batcher = WriteBatcher(self.batch_size, self.observers)
+        for update in updates:
+            batcher.addUpdate(sw, update)
+        try:
+            rejected = batcher.flushSwitch(sw)
+            # A switch that was down may come back with its old entries
+            stale = [e for e in rejected if e.update.type == p4runtime_pb2.Update.INSERT
+                     and e.code == grpc.StatusCode.ALREADY_EXISTS]
+            if not stale:
+                return rejected, None
+            inserts = {}
+            for error in stale:
+                update = buildUpdate(error.update.entity.table_entry, p4runtime_pb2.Update.MODIFY)
+                inserts[id(update)] = error.update
+                batcher.addUpdate(sw, update)
+            retried = batcher.flushSwitch(sw)
+            for error in retried:
+                error.update = inserts[id(error.update)]
+            return [e for e in rejected if e not in stale] + retried, None
+        except grpc.RpcError as e:
+            return None, e
+
+    def _write(self, step, switches):
+        """Write one step to every switch at once; returns the failed (tunnel, switch) pairs."""
+        by_switch = OrderedDict()
+        for tunnel_id, sw_name, rule, update_type in step:
+            if sw_name not in switches or sw_name in self.down_switches:
+                continue
+            update = buildUpdate(self._entry(rule), update_type)
+            by_switch.setdefault(sw_name, []).append((tunnel_id, update))
+        futures = [(sw_name, items, self._pool.submit(self._writeSwitch, switches[sw_name],
+                                                       [update for _, update in items]))
+                   for sw_name, items in by_switch.items()]
+        failed, errors = set(), []
+        for sw_name, items, future in futures:
+            rejected, error = future.result()
+            if error is not None:
+                errors.append("%s: %s" % (sw_name, describeError(error)))
+                failed.update((tunnel_id, sw_name) for tunnel_id, _ in items)
+                continue
+            errors.extend(rejected)
+            rejected_ids = set(id(e.update) for e in rejected)
+            failed.update((tunnel_id, sw_name) for tunnel_id, update in items
+                          if id(update) in rejected_ids)
+        return by_switch, failed, errors
+
+    def handle(self, event):
+        """Apply event and reroute; returns a RepairResult."""
+        with self._lock:
+            down = self._apply(event)
+            if down is None:
+                tunnel_ids = sorted(self.tunnels)
+            else:
+                # Tunnels left half-moved by a failed write are tried again
+                tunnel_ids = sorted(self._retry.union(*[self._by_link.get(key, ()) for key in down]))
+            steps, moved, unreachable = self._plan(tunnel_ids)
+
+            switches = self.switches()
+            touched, errors, updates = set(), [], 0
+            done = dict((tunnel_id, OrderedDict(self.installed[tunnel_id])) for tunnel_id in moved)
+            for step in steps:
+                by_switch, failed, step_errors = self._write(step, switches)
+                touched.update(by_switch)
+                updates += sum(len(items) for items in by_switch.values())
+                for tunnel_id, sw_name, rule, update_type in step:
+                    # Switches of other controllers are written by them
+                    if (tunnel_id, sw_name) in failed:
+                        continue
+                    if update_type == p4runtime_pb2.Update.DELETE:
+                        done[tunnel_id].pop(sw_name, None)
+                    else:
+                        done[tunnel_id][sw_name] = rule
+                if step_errors:
+                    # Never break the old path while the new one is incomplete
+                    errors.extend(step_errors)
+                    break
+            elapsed = time.monotonic() - event.received
+
+            self._updateDesired(moved)
+            for tunnel_id, (new, path) in moved.items():
+                rules = done[tunnel_id]
+                for sw_name in self.down_switches:
+                    rules.pop(sw_name, None)
+                self._setInstalled(tunnel_id, rules, path if not errors else
+                                   self._installedPath(self.tunnels[tunnel_id], rules))
+            self._retry = set(moved) if errors else set()
+
+        result = RepairResult(event, len(moved), updates, sorted(touched),
+                              unreachable, errors, elapsed)
+        self.repairs.record(elapsed)
+        if self.registry is not None:
+            self.registry.setGauge('p4rt_reroute_last_repair_seconds',
+                                   'Time from a link event to the last reroute write', (), elapsed)
+            self.registry.setGauge('p4rt_reroute_unreachable_tunnels',
+                                   'Tunnels without a path after the last link event', (), len(unreachable))
+        return result
+
+    def _installedPath(self, tunnel, rules):
+        # Follow the forwarding entries that are actually in place
+        ports = self.engine.ports
+        path = [tunnel['ingress']]
+        while path[-1] != tunnel['egress'] and path[-1] in rules and len(path) <= len(rules):
+            port = rules[path[-1]]['params']['port']
+            next_sw = [n for n, p in ports.get(path[-1], {}).items() if p == port]
+            if not next_sw:
+                break
+            path.append(next_sw[0])
+        return path
+
+    def _desiredIndex(self, sw_name):
+        index = self._desired_index.get(sw_name)
+        if index is None:
+            index = self._desired_index[sw_name] = OrderedDict(
+                (entryKey(entry), entry) for entry in self.desired.get(sw_name, ()))
+        return index
+
+    def _updateDesired(self, moved):
+        # Resyncs install the new paths even where a write did not get through
+        if self.desired is None:
+            return
+        changed = set()
+        for tunnel_id, (new, path) in moved.items():
+            old = self.installed[tunnel_id]
+            for sw_name in set(old) | set(new):
+                index = self._desiredIndex(sw_name)
+                if sw_name in new:
+                    entry = self._entry(new[sw_name])
+                    index[entryKey(entry)] = entry
+                else:
+                    index.pop(entryKey(self._entry(old[sw_name])), None)
+                changed.add(sw_name)
+        for sw_name in changed:
+            self.desired[sw_name] = list(self._desired_index[sw_name].values())
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def followEvents(path, handler, interval=0.05):
+    """Call handler(line, received) for every line appended to path.
+
+    The file is read from the start, so a restarted controller replays
+    the link state it describes. Runs on a daemon thread.
+    """
+    def run():
+        while not os.path.exists(path):
+            time.sleep(interval)
+        with open(path) as f:
+            partial = ''
+            while True:
+                line = f.readline()
+                if not line:
+                    time.sleep(interval)
+                    continue
+                partial += line
+                if not partial.endswith('\n'):
+                    continue
+                line, partial = partial, ''
+                if line.strip() and not line.lstrip().startswith('#'):
+                    handler(line, time.monotonic())
+
+    thread = threading.Thread(target=run, name='link-events')
+    thread.daemon = True
+    thread.start()
+    return thread
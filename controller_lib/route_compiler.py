@@ -0,0 +1,232 @@
+import socket
+import struct
+
+LPM_TABLE = "MyIngress.ipv4_lpm"
+LPM_FIELD = "hdr.ipv4.dstAddr"
+
+_UNSET = object()
+_MIXED = object()
+
+
+def ipToInt(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def intToIp(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+class _Node(object):
+    __slots__ = ('children', 'route', 'dirty', 'resolved_for', 'resolved',
+                 'emitted_for', 'own', 'collapsed')
+
+    def __init__(self):
+        self.children = [None, None]
+        self.route = None
+        self.dirty = True
+        self.resolved_for = _UNSET
+        self.resolved = None
+        self.emitted_for = _UNSET
+        self.own = None
+        self.collapsed = False
+
+
+class RouteCompiler(object):
+    """Compiles IPv4 routes into an equivalent, smaller LPM entry set.
+
+    Routes map a prefix to a hashable action (anything comparable with ==,
+    e.g. (action_name, params)); addresses without a route fall through to
+    the table's default action. The compiled set gives every address the
+    same action as the input but:
+
+    * sibling prefixes that fully cover their parent with the same action
+      are merged into the parent, recursively;
+    * prefixes whose action equals that of the closest covering prefix are
+      dropped.
+
+    Sub-trees are never merged across uncovered address space, since that
+    would change what hits the default action. After setRoute/removeRoute,
+    update() recomputes only the nodes on the changed path and returns the
+    entry-level difference to the previous compilation.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.compiled = {}
+
+    def _path(self, prefix, prefix_len, create):
+        node = self.root
+        path = [node]
+        for depth in range(prefix_len):
+            bit = (prefix >> (31 - depth)) & 1
+            child = node.children[bit]
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[bit] = _Node()
+            node = child
+            path.append(node)
+        return path
+
+    @staticmethod
+    def _normalize(ip, prefix_len):
+        prefix = ipToInt(ip) if isinstance(ip, str) else ip
+        mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+        return prefix & mask
+
+    def setRoute(self, ip, prefix_len, action):
+        if action is None:
+            raise ValueError("use removeRoute() to withdraw a route")
+        path = self._path(self._normalize(ip, prefix_len), prefix_len, True)
+        path[-1].route = action
+        self._invalidate(path)
+
+    def removeRoute(self, ip, prefix_len):
+        path = self._path(self._normalize(ip, prefix_len), prefix_len, False)
+        if path is None or path[-1].route is None:
+            return
+        path[-1].route = None
+        self._invalidate(path)
+
+    @staticmethod
+    def _invalidate(path):
+        for node in path:
+            node.dirty = True
+            node.resolved_for = _UNSET
+
+    def _resolve(self, node, default):
+        """The single action covering all of node's space, or _MIXED."""
+        if not node.dirty and node.resolved_for is default:
+            return node.resolved
+        effective = node.route if node.route is not None else default
+        left, right = node.children
+        if left is None and right is None:
+            result = effective
+        else:
+            l = self._resolve(left, effective) if left is not None else effective
+            r = self._resolve(right, effective) if right is not None else effective
+            result = l if l is not _MIXED and l == r else _MIXED
+        node.resolved_for = default
+        node.resolved = result
+        return result
+
+    def _clear(self, node, prefix, prefix_len, changes):
+        """Withdraw everything node and its descendants emitted."""
+        if node.own is not None:
+            self._change(changes, (prefix, prefix_len), node.own, None)
+            node.own = None
+        node.emitted_for = _UNSET
+        node.collapsed = False
+        for bit, child in enumerate(node.children):
+            if child is not None:
+                self._clear(child, prefix | (bit << (31 - prefix_len)), prefix_len + 1, changes)
+
+    @staticmethod
+    def _change(changes, key, old, new):
+        if key in changes:
+            old = changes[key][0]
+        changes[key] = (old, new)
+
+    def _emit(self, node, default, prefix, prefix_len, changes):
+        # default is also the action of the closest emitted covering entry
+        if not node.dirty and node.emitted_for is default:
+            return
+        resolved = self._resolve(node, default)
+        was_collapsed = node.collapsed
+        if resolved is not _MIXED:
+            own = resolved if resolved != default else None
+        else:
+            own = node.route if node.route is not None and node.route != default else None
+        if own != node.own:
+            self._change(changes, (prefix, prefix_len), node.own, own)
+        node.own = own
+        node.collapsed = resolved is not _MIXED
+        node.emitted_for = default
+        node.dirty = False
+        if node.collapsed:
+            if not was_collapsed:
+                for bit, child in enumerate(node.children):
+                    if child is not None:
+                        self._clear(child, prefix | (bit << (31 - prefix_len)),
+                                    prefix_len + 1, changes)
+            return
+        effective = node.route if node.route is not None else default
+        for bit, child in enumerate(node.children):
+            if child is not None:
+                self._emit(child, effective, prefix | (bit << (31 - prefix_len)),
+                           prefix_len + 1, changes)
+
+    def update(self):
+        """Recompile and return (inserts, modifies, deletes).
+
+        inserts and modifies are lists of ((prefix, prefix_len), action),
+        deletes a list of (prefix, prefix_len) keys.
+        """
+        changes = {}
+        self._emit(self.root, None, 0, 0, changes)
+        inserts, modifies, deletes = [], [], []
+        for key, (old, new) in sorted(changes.items()):
+            if old == new:
+                continue
+            if new is None:
+                deletes.append(key)
+                del self.compiled[key]
+            elif old is None:
+                inserts.append((key, new))
+                self.compiled[key] = new
+            else:
+                modifies.append((key, new))
+                self.compiled[key] = new
+        return inserts, modifies, deletes
+
+    def compile(self):
+        """Bring the compilation up to date and return {(prefix, len): action}."""
+        self.update()
+        return dict(self.compiled)
+
+
+def _ruleAction(rule):
+    return (rule['action'], tuple(sorted(rule.get('params', {}).items())))
+
+
+def aggregateLpmRules(rules, table=LPM_TABLE, field=LPM_FIELD):
+    """Replace the lpm rules of one table in a rule list by their compiled form.
+
+    Other rules are kept as they are, in front of the compiled entries.
+    """
+    compiler = RouteCompiler()
+    others = []
+    for rule in rules:
+        match = rule.get('match') or {}
+        if rule.get('table') != table or set(match) != set([field]) or rule.get('default_action'):
+            others.append(rule)
+            continue
+        ip, prefix_len = match[field]
+        compiler.setRoute(ip, prefix_len, _ruleAction(rule))
+    compiled = []
+    for (prefix, prefix_len), (action, params) in sorted(compiler.compile().items()):
+        compiled.append({
+            "table": table,
+            "match": {field: [intToIp(prefix), prefix_len]},
+            "action": action,
+            "params": dict(params),
+        })
+    return others + compiled
+
+
+def aggregateRuleSets(rule_sets, table=LPM_TABLE, field=LPM_FIELD):
+    """aggregateLpmRules() for every switch of a {switch: [rule]} mapping."""
+    aggregated = type(rule_sets)()
+    for sw_name, rules in rule_sets.items():
+        aggregated[sw_name] = aggregateLpmRules(rules, table, field)
+    return aggregated
+
+
+def aggregationReport(rule_sets, aggregated, table=LPM_TABLE):
+    """One line per switch: routes in table before and after aggregation."""
+    lines = []
+    for sw_name, rules in rule_sets.items():
+        before = sum(1 for rule in rules if rule.get('table') == table)
+        after = sum(1 for rule in aggregated[sw_name] if rule.get('table') == table)
+        lines.append("%s: %s %d routes -> %d entries" % (sw_name, table, before, after))
+    return lines
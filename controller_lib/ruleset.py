@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import struct
+
+from google.protobuf.message import DecodeError
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import buildUpdate
+
+CACHE_VERSION = 2
+# Cache record header: switch name length, ReadResponse length
+_CACHE_RECORD = struct.Struct('<HQ')
+
+
+def buildRuleEntry(p4info_helper, rule):
+    """Build a TableEntry from one rule of a topology file."""
+    match_fields = None
+    if rule.get('match'):
+        # JSON has no tuples; lpm/ternary/range values come in as lists
+        match_fields = dict(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in rule['match'].items())
+    return p4info_helper.buildTableEntry(
+        table_name=rule['table'],
+        match_fields=match_fields,
+        default_action=rule.get('default_action', False),
+        action_name=rule.get('action'),
+        action_params=rule.get('params'),
+        priority=rule.get('priority'))
+
+
+def compileRules(p4info_helper, rules):
+    """Compile {switch: [rule]} into {switch: [TableEntry]}."""
+    return dict((sw_name, [buildRuleEntry(p4info_helper, rule) for rule in sw_rules])
+                for sw_name, sw_rules in rules.items())
+
+
+def ruleSetDigest(p4info, rules):
+    digest = hashlib.sha256()
+    digest.update(b'%d\0' % CACHE_VERSION)
+    digest.update(json.dumps(rules, sort_keys=True).encode('utf-8'))
+    digest.update(p4info.SerializeToString(deterministic=True))
+    return digest.hexdigest()
+
+
+def compileRulesCached(p4info_helper, rules, cache_dir):
+    """compileRules() with an on-disk cache keyed by the rules and p4info.
+
+    Compiled entries are stored as one serialized ReadResponse per switch, so
+    a cache hit costs a single protobuf parse instead of buildTableEntry per
+    rule. The file is a sequence of _CACHE_RECORD headers, each followed by
+    the switch name and the ReadResponse; nothing in it is executed, and a
+    file that does not parse is compiled again.
+    """
+    path = os.path.join(cache_dir, ruleSetDigest(p4info_helper.p4info, rules) + '.bin')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            compiled = _parseCache(f.read())
+        if compiled is not None:
+            return compiled
+
+    compiled = compileRules(p4info_helper, rules)
+    chunks = []
+    for sw_name, entries in compiled.items():
+        response = p4runtime_pb2.ReadResponse()
+        for entry in entries:
+            response.entities.add().table_entry.CopyFrom(entry)
+        name = sw_name.encode('utf-8')
+        data = response.SerializeToString()
+        chunks += [_CACHE_RECORD.pack(len(name), len(data)), name, data]
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(chunks))
+    os.rename(tmp_path, path)
+    return compiled
+
+
+def _parseCache(data):
+    compiled = {}
+    offset = 0
+    try:
+        while offset < len(data):
+            name_length, length = _CACHE_RECORD.unpack_from(data, offset)
+            offset += _CACHE_RECORD.size
+            name = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            if offset + length > len(data):
+                return None
+            response = p4runtime_pb2.ReadResponse()
+            response.ParseFromString(data[offset:offset + length])
+            offset += length
+            compiled[name] = [entity.table_entry for entity in response.entities]
+    except (struct.error, UnicodeDecodeError, DecodeError):
+        return None
+    return compiled
+
+
+def _canonical(value):
+    # Servers may return byte strings with leading zeros stripped
+    return value.lstrip(b'\x00') or b'\x00'
+
+
+def entryKey(entry):
+    """Identity of a table entry: table, match and priority."""
+    fields = []
+    for m in entry.match:
+        kind = m.WhichOneof('field_match_type')
+        if kind == 'exact':
+            fields.append((m.field_id, _canonical(m.exact.value)))
+        elif kind == 'lpm':
+            fields.append((m.field_id, _canonical(m.lpm.value), m.lpm.prefix_len))
+        elif kind == 'ternary':
+            fields.append((m.field_id, _canonical(m.ternary.value), _canonical(m.ternary.mask)))
+        elif kind == 'range':
+            fields.append((m.field_id, _canonical(m.range.low), _canonical(m.range.high)))
+        else:
+            fields.append((m.field_id, m.SerializeToString()))
+    fields.sort()
+    return (entry.table_id, entry.is_default_action, tuple(fields), entry.priority)
+
+
+def actionKey(entry):
+    action = entry.action.action
+    return (action.action_id,
+            tuple(sorted((p.param_id, _canonical(p.value)) for p in action.params)))
+
+
+def diffEntries(desired, current):
+    """Updates that turn the current entries into the desired ones.
+
+    Deletes come first so that capacity is freed before inserts. Default
+    entries are never returned by a wildcard read, so desired ones are always
+    (re)written with MODIFY.
+    """
+    current_by_key = dict((entryKey(e), e) for e in current)
+    deletes, modifies, inserts = [], [], []
+    seen = set()
+    for entry in desired:
+        key = entryKey(entry)
+        seen.add(key)
+        if entry.is_default_action:
+            modifies.append(buildUpdate(entry, p4runtime_pb2.Update.MODIFY))
+            continue
+        existing = current_by_key.get(key)
+        if existing is None:
+            inserts.append(buildUpdate(entry, p4runtime_pb2.Update.INSERT))
+        elif actionKey(existing) != actionKey(entry):
+            modifies.append(buildUpdate(entry, p4runtime_pb2.Update.MODIFY))
+    for key, entry in current_by_key.items():
+        if key not in seen and not entry.is_default_action:
+            deletes.append(buildUpdate(entry, p4runtime_pb2.Update.DELETE))
+    return deletes, modifies, inserts
+
+
+def readCurrentEntries(sw):
+    entries = []
+    for response in sw.ReadTableEntries():
+        for entity in response.entities:
+            entries.append(entity.table_entry)
+    return entries
+
+
+def reconcileSwitch(sw, desired, batcher, current=None, shadow=None):
+    """Queue on batcher the updates that bring sw to the desired entries.
+
+    current defaults to a wildcard ReadTableEntries of the switch, or to the
+    ShadowStore shadow when given (read back once if it is stale); an
+    explicit current=[] also resets the shadow. Returns (inserts, modifies,
+    deletes) counts.
+    """
+    if shadow is not None and current is None:
+        if shadow.isStale(sw.name):
+            shadow.sync(sw)
+        deletes, modifies, inserts = shadow.diff(sw.name, desired)
+    else:
+        if current is None:
+            current = readCurrentEntries(sw)
+        elif shadow is not None:
+            if current:
+                shadow.load(sw.name, current)
+            else:
+                shadow.clear(sw.name)
+        deletes, modifies, inserts = diffEntries(desired, current)
+    for update in deletes + modifies + inserts:
+        batcher.addUpdate(sw, update)
+    return len(inserts), len(modifies), len(deletes)
+
+
+class InstallResult(object):
+    """What installRuleSet() wrote to one switch."""
+
+    __slots__ = ('switch', 'inserts', 'modifies', 'deletes', 'errors')
+
+    def __init__(self, switch, inserts, modifies, deletes, errors):
+        self.switch = switch
+        self.inserts = inserts
+        self.modifies = modifies
+        self.deletes = deletes
+        self.errors = errors
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __str__(self):
+        text = "%s: %d inserted, %d modified, %d deleted, %d rejected" % (
+            self.switch, self.inserts, self.modifies, self.deletes, len(self.errors))
+        for error in self.errors:
+            text += "\n  Rejected update: %s" % error
+        return text
+
+
+def installRuleSet(sw, desired, batcher, current=None, shadow=None):
+    """Reconcile sw against desired and write the difference right away.
+
+    Returns an InstallResult; the UpdateErrors are in its errors.
+    """
+    inserts, modifies, deletes = reconcileSwitch(sw, desired, batcher, current, shadow)
+    errors = batcher.flushSwitch(sw)
+    return InstallResult(sw.name, inserts, modifies, deletes, errors)
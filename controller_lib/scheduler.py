@@ -0,0 +1,270 @@
+import heapq
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import (DEFAULT_BATCH_SIZE, UpdateError, backoffDelay, buildUpdate, parseWriteErrors,
+                                  setElectionId)
+from controller_lib.p4info_index import indexFor
+
+# The switch agent is overloaded or gone: slow down and send the update again
+BACKPRESSURE_CODES = (grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.UNAVAILABLE)
+DEFAULT_MAX_WINDOW = 16
+DEFAULT_MAX_RETRIES = 8
+# A write slower than this many times the base latency counts as congestion
+LATENCY_FACTOR = 2.0
+# How fast the base latency follows writes that are slower than it
+BASE_DRIFT = 0.01
+
+PRIORITY_DEFAULT = 0
+PRIORITY_CRITICAL = 1
+PRIORITY_BULK = 2
+CRITICAL_TABLES = ('MyIngress.check_ports',)
+# Within a priority: free table space before using it
+_TYPE_ORDER = {
+    p4runtime_pb2.Update.DELETE: 0,
+    p4runtime_pb2.Update.MODIFY: 1,
+    p4runtime_pb2.Update.INSERT: 2,
+}
+
+
+def tablePriorities(p4info_helper, names=CRITICAL_TABLES, priority=PRIORITY_CRITICAL):
+    """{table id: priority} for the tables of names that the program has."""
+    index = indexFor(p4info_helper)
+    priorities = {}
+    for name in names:
+        try:
+            priorities[index.tableId(name)] = priority
+        except KeyError:
+            pass
+    return priorities
+
+
+def _benignReplay(update, code):
+    # An update whose first attempt had an unknown outcome may already be in
+    return ((update.type == p4runtime_pb2.Update.INSERT and code == grpc.StatusCode.ALREADY_EXISTS) or
+            (update.type == p4runtime_pb2.Update.DELETE and code == grpc.StatusCode.NOT_FOUND))
+
+
+class WindowState(object):
+    """AIMD congestion window of one switch: WriteRequests allowed in flight."""
+
+    __slots__ = ('window', 'max_window', 'base_latency', 'last_decrease',
+                 'writes', 'retries', 'backoffs')
+
+    def __init__(self, max_window=DEFAULT_MAX_WINDOW):
+        self.window = 1.0
+        self.max_window = max_window
+        self.base_latency = None
+        self.last_decrease = 0.0
+        self.writes = 0
+        self.retries = 0
+        self.backoffs = 0
+
+    def onWrite(self, latency):
+        self.writes += 1
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            self.base_latency += (latency - self.base_latency) * BASE_DRIFT
+        if latency > self.base_latency * LATENCY_FACTOR:
+            self.decrease()
+        else:
+            # One more write in flight per window's worth of fast writes
+            self.window = min(self.max_window, self.window + 1.0 / self.window)
+
+    def decrease(self):
+        now = time.monotonic()
+        # Once per round trip: the writes already in flight saw the same congestion
+        if now - self.last_decrease < (self.base_latency or 0.0) * LATENCY_FACTOR:
+            return
+        self.window = max(1.0, self.window / 2)
+        self.last_decrease = now
+
+    def __str__(self):
+        return "window %.1f, %d writes, %d retried updates, %d backoffs" % (
+            self.window, self.writes, self.retries, self.backoffs)
+
+
+class _Item(object):
+    __slots__ = ('update', 'attempts', 'unknown')
+
+    def __init__(self, update):
+        self.update = update
+        self.attempts = 0
+        # A previous attempt failed with an unknown outcome
+        self.unknown = False
+
+
+class WriteScheduler(object):
+    """A WriteBatcher that orders writes by priority and paces them per switch.
+
+    Updates are queued with a priority (lower goes first). By default
+    default entries go first, then the tables in priorities (see
+    tablePriorities), then everything else. Within a priority DELETEs go
+    before MODIFYs before INSERTs, so inserts do not find a table still
+    full of entries that are about to go. Each WriteRequest holds one
+    priority and update type, and the next is not sent while an earlier
+    one is in flight.
+
+    Up to window WriteRequests per switch are in flight at once. The
+    window grows by one per window's worth of writes that complete near
+    the base latency. It halves, at most once per round trip, on slow
+    writes and on WriteRequests that fail as a whole with
+    RESOURCE_EXHAUSTED/UNAVAILABLE. Their updates are queued again, after a
+    jittered backoff, up to max_retries times. Updates rejected one by one
+    (a full table included) and other failures are returned or raised as
+    by WriteBatcher, and observers are notified the same way.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, observers=(), priorities=None,
+                 max_window=DEFAULT_MAX_WINDOW, max_retries=DEFAULT_MAX_RETRIES):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.batch_size = batch_size
+        self.observers = list(observers)
+        self.priorities = priorities or {}
+        self.max_window = max_window
+        self.max_retries = max_retries
+        self.state = {}
+        self._pending = {}
+        self._seq = 0
+
+    def priority(self, update):
+        entry = update.entity.table_entry
+        if entry.is_default_action:
+            return PRIORITY_DEFAULT
+        return self.priorities.get(entry.table_id, PRIORITY_BULK)
+
+    def add(self, sw, table_entry, update_type=None, priority=None):
+        self.addUpdate(sw, buildUpdate(table_entry, update_type), priority)
+
+    def addUpdate(self, sw, update, priority=None):
+        if sw.name not in self._pending:
+            self._pending[sw.name] = (sw, [])
+        if priority is None:
+            priority = self.priority(update)
+        # seq keeps the order updates were added within a priority and type
+        self._seq += 1
+        stage = (priority, _TYPE_ORDER.get(update.type, 1))
+        heapq.heappush(self._pending[sw.name][1], (stage, self._seq, _Item(update)))
+
+    def pending(self, sw=None):
+        if sw is not None:
+            return len(self._pending.get(sw.name, (None, ()))[1])
+        return sum(len(items) for _, items in self._pending.values())
+
+    def switches(self):
+        return [sw for sw, _ in self._pending.values()]
+
+    def _send(self, sw, chunk, done):
+        request = p4runtime_pb2.WriteRequest()
+        request.device_id = sw.device_id
+        setElectionId(request.election_id, sw)
+        updates = [item.update for _, _, item in chunk]
+        request.updates.extend(updates)
+        for observer in self.observers:
+            observer.beforeWrite(sw, updates)
+        # .future() bypasses the retries of managed connections; they are done here
+        call = sw.client_stub.Write.future(request)
+        context = (chunk, updates, time.monotonic(), getattr(sw, 'generation', 0))
+        call.add_done_callback(lambda call: done.put((call, context)))
+
+    def flushSwitch(self, sw):
+        """Write every queued update for sw; returns the rejected ones."""
+        _, heap = self._pending.pop(sw.name, (sw, []))
+        state = self.state.get(sw.name)
+        if state is None:
+            state = self.state[sw.name] = WindowState(self.max_window)
+        done = queue.Queue()
+        inflight = {}
+        errors = []
+        fatal = None
+        resume_at = 0.0
+        # Backpressure replies in a row; the backoff grows with it
+        streak = 0
+        while heap or inflight:
+            while (heap and fatal is None and len(inflight) < int(state.window)
+                   and time.monotonic() >= resume_at
+                   and (not inflight or min(inflight.values()) >= heap[0][0])):
+                stage = heap[0][0]
+                chunk = []
+                while heap and heap[0][0] == stage and len(chunk) < self.batch_size:
+                    chunk.append(heapq.heappop(heap))
+                self._send(sw, chunk, done)
+                inflight[id(chunk)] = stage
+            if not inflight:
+                if heap and fatal is None:
+                    time.sleep(max(0.0, resume_at - time.monotonic()))
+                    continue
+                break
+
+            call, (chunk, updates, start, generation) = done.get()
+            del inflight[id(chunk)]
+            try:
+                call.result()
+                chunk_errors = []
+            except grpc.RpcError as e:
+                chunk_errors = parseWriteErrors(e, sw.name, updates)
+                if chunk_errors is None:
+                    for observer in self.observers:
+                        observer.afterWrite(sw, updates, None)
+                    if e.code() not in BACKPRESSURE_CODES:
+                        fatal = fatal or e
+                        continue
+                    state.backoffs += 1
+                    state.decrease()
+                    resume_at = time.monotonic() + backoffDelay(streak)
+                    streak += 1
+                    if e.code() == grpc.StatusCode.UNAVAILABLE and hasattr(sw, 'recover'):
+                        try:
+                            sw.recover(generation, 0, time.monotonic() + sw.reconnect_timeout)
+                        except grpc.RpcError as recover_error:
+                            fatal = fatal or recover_error
+                            continue
+                    for stage, seq, item in chunk:
+                        item.unknown = True
+                        self._retry(heap, stage, seq, item, e.code(), errors, sw, state)
+                    continue
+            state.onWrite(time.monotonic() - start)
+            # The switch processed the request, so the agent is keeping up
+            streak = 0
+
+            by_update = dict((id(error.update), error) for error in chunk_errors)
+            rejected = []
+            for _, _, item in chunk:
+                error = by_update.get(id(item.update))
+                if error is None or (item.unknown and _benignReplay(item.update, error.code)):
+                    continue
+                # Per update, RESOURCE_EXHAUSTED means the table is full: final
+                rejected.append(error)
+                errors.append(error)
+            for observer in self.observers:
+                observer.afterWrite(sw, updates, rejected)
+        if fatal is not None:
+            raise fatal
+        return errors
+
+    def _retry(self, heap, stage, seq, item, code, errors, sw, state):
+        item.attempts += 1
+        if item.attempts > self.max_retries:
+            errors.append(UpdateError(sw.name, item.update, code,
+                                      "gave up after %d attempts" % item.attempts))
+            return
+        state.retries += 1
+        heapq.heappush(heap, (stage, seq, item))
+
+    def flush(self):
+        """flushSwitch for every switch, all switches at once."""
+        switches = self.switches()
+        if not switches:
+            return []
+        with ThreadPoolExecutor(max_workers=len(switches)) as pool:
+            futures = [pool.submit(self.flushSwitch, sw) for sw in switches]
+        errors = []
+        for future in futures:
+            errors.extend(future.result())
+        return errors
@@ -0,0 +1,356 @@
+import struct
+import threading
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import buildUpdate
+from controller_lib.ruleset import actionKey, entryKey, readCurrentEntries
+
+_INT = struct.Struct('>q')
+_LEN = struct.Struct('>I')
+# packKey(actionKey(...)) starts with '(' + length + 'i', then the action id
+_ACTION_ID_OFFSET = 1 + _LEN.size + 1
+
+
+def _pack(value, out):
+    if isinstance(value, tuple):
+        out.append(b'(')
+        out.append(_LEN.pack(len(value)))
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, bytes):
+        out.append(b'b')
+        out.append(_LEN.pack(len(value)))
+        out.append(value)
+    else:
+        out.append(b'i')
+        out.append(_INT.pack(value))
+
+
+def packKey(key):
+    """entryKey/actionKey tuples as one bytes object (a fraction of the memory)."""
+    out = []
+    _pack(key, out)
+    return b''.join(out)
+
+
+class _Entry(object):
+    __slots__ = ('action', 'data')
+
+    def __init__(self, action, data):
+        # action: packed actionKey, compared without parsing data
+        self.action = action
+        # data: the serialized TableEntry
+        self.data = data
+
+
+class ShadowTable(object):
+    """The entries of one table on one switch, indexed by action id."""
+
+    __slots__ = ('entries', 'by_action', 'default')
+
+    def __init__(self):
+        self.entries = {}
+        self.by_action = {}
+        self.default = None
+
+    def put(self, key, action_id, record):
+        old = self.entries.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self.entries[key] = record
+        self.by_action.setdefault(action_id, set()).add(key)
+
+    def remove(self, key):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self._unindex(key, old)
+
+    def _unindex(self, key, record):
+        action_id = _INT.unpack_from(record.action, _ACTION_ID_OFFSET)[0]
+        keys = self.by_action.get(action_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_action[action_id]
+
+
+class AuditResult(object):
+    __slots__ = ('switch', 'missing', 'unexpected', 'mismatched')
+
+    def __init__(self, switch, missing, unexpected, mismatched):
+        self.switch = switch
+        self.missing = missing
+        self.unexpected = unexpected
+        self.mismatched = mismatched
+
+    @property
+    def clean(self):
+        return not (self.missing or self.unexpected or self.mismatched)
+
+    def __str__(self):
+        return "%s: %d missing on switch, %d unexpected, %d with a different action" % (
+            self.switch, self.missing, self.unexpected, self.mismatched)
+
+
+class ShadowStore(object):
+    """What this controller has written to each switch, kept in memory.
+
+    Register it as a WriteBatcher observer and every accepted update is
+    applied to the shadow once its Write returns; rejected updates are not.
+    A Write whose outcome is unknown (the RPC failed as a whole) marks the
+    switch stale, and so does never having read it: stale switches are
+    read back once by sync() before the shadow is used for them again.
+
+    Entries are kept as serialized TableEntry bytes under a packed entryKey,
+    per switch and table, with an index by action id. tables limits the
+    shadow to those table ids. With a Journal, every change is also
+    appended to it so the shadow survives a restart (see Journal.recover).
+    """
+
+    def __init__(self, tables=None, journal=None):
+        self.tables = frozenset(tables) if tables is not None else None
+        self.journal = journal
+        if journal is not None:
+            journal.shadow = self
+        self._switches = {}
+        self._stale = set()
+        self._known = set()
+        self._versions = {}
+        self._lock = threading.RLock()
+
+    def _table(self, sw_name, table_id):
+        tables = self._switches.setdefault(sw_name, {})
+        table = tables.get(table_id)
+        if table is None:
+            table = tables[table_id] = ShadowTable()
+        return table
+
+    def _apply(self, sw_name, update_type, entry):
+        if self.tables is not None and entry.table_id not in self.tables:
+            return
+        table = self._table(sw_name, entry.table_id)
+        if entry.is_default_action:
+            table.default = None if update_type == p4runtime_pb2.Update.DELETE else entry.SerializeToString()
+            return
+        key = packKey(entryKey(entry))
+        if update_type == p4runtime_pb2.Update.DELETE:
+            table.remove(key)
+        else:
+            table.put(key, entry.action.action.action_id,
+                      _Entry(packKey(actionKey(entry)), entry.SerializeToString()))
+
+    def beforeWrite(self, sw, updates):
+        if self.journal is not None:
+            # Write-ahead: the intent is on disk before the switch sees it
+            self.journal.intent(sw.name, updates)
+
+    def afterWrite(self, sw, updates, errors):
+        """errors is the list of rejected updates, or None if the outcome is unknown."""
+        with self._lock:
+            self._versions[sw.name] = self._versions.get(sw.name, 0) + 1
+            if self.journal is not None:
+                self.journal.ack(sw.name, updates, errors)
+            if errors is None:
+                self._stale.add(sw.name)
+                return
+            self.applyUpdates(sw.name, updates, errors)
+
+    def applyUpdates(self, sw_name, updates, errors=()):
+        """Apply the updates that are not in errors, without journaling them."""
+        with self._lock:
+            rejected = set(id(error.update) for error in errors)
+            for update in updates:
+                if id(update) not in rejected and update.entity.HasField('table_entry'):
+                    self._apply(sw_name, update.type, update.entity.table_entry)
+
+    def load(self, sw_name, entries):
+        """Replace the shadow of sw_name with entries (e.g. from a Read)."""
+        entries = list(entries)
+        with self._lock:
+            if self.journal is not None:
+                self.journal.loaded(sw_name, entries)
+            defaults = dict((table_id, table.default)
+                            for table_id, table in self._switches.get(sw_name, {}).items())
+            self._switches[sw_name] = {}
+            # Wildcard reads do not return default entries; keep what we wrote
+            for table_id, default in defaults.items():
+                if default is not None:
+                    self._table(sw_name, table_id).default = default
+            for entry in entries:
+                self._apply(sw_name, p4runtime_pb2.Update.INSERT, entry)
+            self._known.add(sw_name)
+            self._stale.discard(sw_name)
+
+    def clear(self, sw_name):
+        """The switch is known to be empty (a pipeline was just pushed)."""
+        with self._lock:
+            if self.journal is not None:
+                self.journal.cleared(sw_name)
+            self._switches[sw_name] = {}
+            self._known.add(sw_name)
+            self._stale.discard(sw_name)
+
+    def settle(self, sw_name, found, missing, intents=()):
+        """Record single entries read back from sw_name.
+
+        found are entries the switch has, missing ones it does not; intents
+        are the journal sequence numbers this resolves.
+        """
+        updates = [buildUpdate(entry, p4runtime_pb2.Update.INSERT) for entry in found]
+        updates.extend(buildUpdate(entry, p4runtime_pb2.Update.DELETE) for entry in missing)
+        with self._lock:
+            self._versions[sw_name] = self._versions.get(sw_name, 0) + 1
+            if self.journal is not None:
+                self.journal.settled(sw_name, updates, intents)
+            self.applyUpdates(sw_name, updates)
+
+    def snapshot(self):
+        """[(switch, [(table id, default, [(key, action, data)])])] of every known switch.
+
+        The records are shared, not copied: they are immutable bytes.
+        """
+        with self._lock:
+            return [(sw_name, [(table_id, table.default,
+                                [(key, record.action, record.data)
+                                 for key, record in table.entries.items()])
+                               for table_id, table in self._switches.get(sw_name, {}).items()])
+                    for sw_name in sorted(self._known)]
+
+    def restore(self, sw_name, tables):
+        """Rebuild sw_name from snapshot() records without parsing any entry."""
+        with self._lock:
+            self._switches[sw_name] = {}
+            for table_id, default, records in tables:
+                table = self._table(sw_name, table_id)
+                table.default = default
+                for key, action, data in records:
+                    table.put(key, _INT.unpack_from(action, _ACTION_ID_OFFSET)[0], _Entry(action, data))
+            self._known.add(sw_name)
+            self._stale.discard(sw_name)
+
+    def isStale(self, sw_name):
+        return sw_name not in self._known or sw_name in self._stale
+
+    def sync(self, sw):
+        """Read sw once to (re)build its shadow."""
+        self.load(sw.name, readCurrentEntries(sw))
+
+    def count(self, sw_name, table_id=None):
+        tables = self._switches.get(sw_name, {})
+        if table_id is not None:
+            table = tables.get(table_id)
+            return len(table.entries) if table is not None else 0
+        return sum(len(table.entries) for table in tables.values())
+
+    def entries(self, sw_name, table_ids=None, action_ids=None):
+        """Yield the shadow TableEntry messages of sw_name, parsed lazily."""
+        with self._lock:
+            tables = self._switches.get(sw_name, {})
+            selected = []
+            for table_id in (table_ids if table_ids is not None else list(tables)):
+                table = tables.get(table_id)
+                if table is None:
+                    continue
+                if action_ids is None:
+                    selected.extend(record.data for record in table.entries.values())
+                else:
+                    for action_id in action_ids:
+                        selected.extend(table.entries[key].data
+                                        for key in table.by_action.get(action_id, ()))
+        for data in selected:
+            yield p4runtime_pb2.TableEntry.FromString(data)
+
+    def diff(self, sw_name, desired):
+        """diffEntries(desired, <entries on sw>) computed against the shadow."""
+        with self._lock:
+            tables = self._switches.get(sw_name, {})
+            deletes, modifies, inserts = [], [], []
+            seen = {}
+            for entry in desired:
+                if entry.is_default_action:
+                    modifies.append(buildUpdate(entry, p4runtime_pb2.Update.MODIFY))
+                    continue
+                key = packKey(entryKey(entry))
+                seen.setdefault(entry.table_id, set()).add(key)
+                table = tables.get(entry.table_id)
+                record = table.entries.get(key) if table is not None else None
+                if record is None:
+                    inserts.append(buildUpdate(entry, p4runtime_pb2.Update.INSERT))
+                elif record.action != packKey(actionKey(entry)):
+                    modifies.append(buildUpdate(entry, p4runtime_pb2.Update.MODIFY))
+            for table_id, table in tables.items():
+                keep = seen.get(table_id, ())
+                for key, record in table.entries.items():
+                    if key not in keep:
+                        deletes.append(buildUpdate(p4runtime_pb2.TableEntry.FromString(record.data),
+                                                   p4runtime_pb2.Update.DELETE))
+        return deletes, modifies, inserts
+
+    def audit(self, sw, repair=True):
+        """Compare the shadow of sw with a full read of the switch.
+
+        Returns an AuditResult, or None when writes to sw completed during
+        the read (the comparison would be meaningless). With repair the
+        shadow is replaced by what the switch reported.
+        """
+        version = self._versions.get(sw.name, 0)
+        current = readCurrentEntries(sw)
+        with self._lock:
+            if self._versions.get(sw.name, 0) != version:
+                return None
+            on_switch = {}
+            for entry in current:
+                if self.tables is None or entry.table_id in self.tables:
+                    on_switch[(entry.table_id, packKey(entryKey(entry)))] = packKey(actionKey(entry))
+            missing = mismatched = 0
+            for table_id, table in self._switches.get(sw.name, {}).items():
+                for key, record in table.entries.items():
+                    action = on_switch.pop((table_id, key), None)
+                    if action is None:
+                        missing += 1
+                    elif action != record.action:
+                        mismatched += 1
+            result = AuditResult(sw.name, missing, len(on_switch), mismatched)
+            if repair and not result.clean:
+                self.load(sw.name, current)
+        return result
+
+
+class ShadowAuditor(object):
+    """Audits every switch against the shadow every interval seconds on a
+    daemon thread, printing any discrepancy found. switches may also be a
+    callable returning the switches to audit on each round."""
+
+    def __init__(self, shadow, switches, interval, repair=True):
+        self.shadow = shadow
+        self.switches = switches if callable(switches) else list(switches)
+        self.interval = interval
+        self.repair = repair
+        self.results = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='shadow-audit')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            switches = self.switches() if callable(self.switches) else self.switches
+            for sw in switches:
+                try:
+                    result = self.shadow.audit(sw, self.repair)
+                except grpc.RpcError as e:
+                    print("%s: shadow audit failed: %s (%s)" % (sw.name, e.details(), e.code().name))
+                    continue
+                if result is None:
+                    continue
+                self.results[sw.name] = result
+                if not result.clean:
+                    print("Shadow audit %s" % result)
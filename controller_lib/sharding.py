@@ -0,0 +1,154 @@
+import bisect
+import hashlib
+import threading
+
+import grpc
+from google.rpc import code_pb2
+
+DEFAULT_REPLICAS = 160
+DEFAULT_STANDBYS = 1
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def parseControllers(value):
+    """'3' -> ['0', '1', '2']; 'a,b,c' -> ['a', 'b', 'c']."""
+    value = str(value)
+    if value.isdigit():
+        return [str(i) for i in range(int(value))]
+    return [member.strip() for member in value.split(',') if member.strip()]
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto members, replicas points per member.
+
+    Adding or removing a controller only moves the switches whose nearest
+    points belonged to it.
+    """
+
+    def __init__(self, members, replicas=DEFAULT_REPLICAS):
+        if not members:
+            raise ValueError("HashRing needs at least one member")
+        points = sorted((_hash('%s#%d' % (member, i)), member)
+                        for member in members for i in range(replicas))
+        self.members = list(members)
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owners(self, key, count=None):
+        """The first count distinct members clockwise from key (all by default)."""
+        count = len(self.members) if count is None else min(count, len(self.members))
+        owners = []
+        i = bisect.bisect(self._hashes, _hash(key))
+        while len(owners) < count:
+            member = self._owners[i % len(self._owners)]
+            if member not in owners:
+                owners.append(member)
+            i += 1
+        return owners
+
+
+class ShardMap(object):
+    """This controller's view of how switches are split between controllers.
+
+    Each switch ranks every controller by the ring: rank 0 is its primary,
+    ranks 1..standbys stand by for it and the rest leave it alone. Election
+    ids follow the ranking (the primary's is highest), so when the primary
+    goes away the switch itself promotes the next controller.
+    """
+
+    def __init__(self, controllers, controller_id, standbys=DEFAULT_STANDBYS,
+                 replicas=DEFAULT_REPLICAS):
+        controllers = [str(c) for c in controllers]
+        controller_id = str(controller_id)
+        if controller_id not in controllers:
+            raise ValueError("Controller %s is not one of %s" % (controller_id, ', '.join(controllers)))
+        self.controllers = controllers
+        self.controller_id = controller_id
+        self.standbys = standbys
+        self.ring = HashRing(controllers, replicas)
+
+    def rank(self, sw_name):
+        return self.ring.owners(sw_name).index(self.controller_id)
+
+    def electionId(self, sw_name):
+        """(high, low) election id of this controller for sw_name."""
+        return (0, len(self.controllers) - self.rank(sw_name))
+
+    def isLocal(self, sw_name):
+        """True when this controller is primary or standby for sw_name."""
+        return self.rank(sw_name) <= self.standbys
+
+    def localSwitches(self, sw_names):
+        return [name for name in sw_names if self.isLocal(name)]
+
+    def primarySwitches(self, sw_names):
+        return [name for name in sw_names if self.rank(name) == 0]
+
+
+def isMaster(arbitration_response):
+    """Whether a StreamMessageResponse carrying arbitration names us master.
+
+    The master gets OK, every other controller ALREADY_EXISTS.
+    """
+    if arbitration_response is None:
+        return False
+    return arbitration_response.arbitration.status.code == code_pb2.OK
+
+
+class Mastership(object):
+    """Which switches this controller is currently master of.
+
+    on_change(sw, is_master) runs on a watcher thread whenever the switch
+    reports a different master, e.g. to take over a failed primary's
+    switches. Call watch() after MasterArbitrationUpdate.
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self._masters = set()
+        self._lock = threading.Lock()
+
+    def update(self, sw, is_master):
+        """Record the state; returns True when it changed."""
+        with self._lock:
+            if (sw.name in self._masters) == is_master:
+                return False
+            if is_master:
+                self._masters.add(sw.name)
+            else:
+                self._masters.discard(sw.name)
+        return True
+
+    def isMaster(self, sw):
+        return sw.name in self._masters
+
+    def masters(self, switches):
+        return [sw for sw in switches if sw.name in self._masters]
+
+    def _changed(self, sw, is_master):
+        if self.update(sw, is_master) and self.on_change is not None:
+            self.on_change(sw, is_master)
+
+    def watch(self, sw):
+        """Follow arbitration updates on sw's StreamChannel."""
+        if hasattr(sw, 'reconnect_callbacks'):
+            # A reconnect re-arbitrates before handing over the new stream
+            sw.reconnect_callbacks.append(
+                lambda sw: self._changed(sw, isMaster(sw.last_arbitration)))
+        thread = threading.Thread(target=self._watch, args=(sw,), name='mastership-%s' % sw.name)
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, sw):
+        responses = sw.streamResponses() if hasattr(sw, 'streamResponses') else sw.stream_msg_resp
+        try:
+            for response in responses:
+                if response.WhichOneof('update') == 'arbitration':
+                    self._changed(sw, isMaster(response))
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                print("%s: StreamChannel closed: %s (%s)" % (sw.name, e.details(), e.code().name))
+        self._changed(sw, False)
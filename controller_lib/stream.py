@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+DEFAULT_QUEUE_SIZE = 4096
+
+
+def packetMetadataIds(p4info, header_name):
+    """{metadata name: (id, bitwidth)} of a @controller_header."""
+    for header in p4info.controller_packet_metadata:
+        if header.preamble.name == header_name:
+            return OrderedDict((m.name, (m.id, m.bitwidth)) for m in header.metadata)
+    raise AttributeError("Could not find controller header '%s'" % header_name)
+
+
+class PacketIO(object):
+    """Decodes packet-in metadata and sends packet-outs for one P4Info."""
+
+    def __init__(self, p4info, packet_in='packet_in', packet_out='packet_out'):
+        self.in_names = dict((metadata_id, name) for name, (metadata_id, _)
+                             in packetMetadataIds(p4info, packet_in).items())
+        self.out_ids = packetMetadataIds(p4info, packet_out)
+
+    def decode(self, packet):
+        return dict((self.in_names.get(m.metadata_id, m.metadata_id), int.from_bytes(m.value, 'big'))
+                    for m in packet.metadata)
+
+    def buildPacketOut(self, payload, **metadata):
+        """Fields not given (e.g. padding) are sent as 0."""
+        unknown = set(metadata) - set(self.out_ids)
+        if unknown:
+            raise KeyError("Unknown packet_out metadata: %s" % ', '.join(sorted(unknown)))
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.packet.payload = payload
+        for name, (metadata_id, bitwidth) in self.out_ids.items():
+            m = request.packet.metadata.add()
+            m.metadata_id = metadata_id
+            m.value = metadata.get(name, 0).to_bytes((bitwidth + 7) // 8, 'big')
+        return request
+
+    def send(self, sw, payload, **metadata):
+        # requests_stream feeds the StreamChannel opened by the connection
+        sw.requests_stream.put(self.buildPacketOut(payload, **metadata))
+
+
+class StreamDispatcher(object):
+    """Reads the StreamChannel of several switches and dispatches on asyncio.
+
+    One thread per switch drains its stream_msg_resp iterator (start it
+    after MasterArbitrationUpdate, which consumes the first response) and
+    hands (sw, message, arrival time) to the event loop. Handlers are
+    registered per StreamMessageResponse kind ('packet', 'arbitration',
+    'digest', 'idle_timeout_notification', 'error') and may be coroutine
+    functions; run() awaits them in arrival order.
+
+    At most maxsize messages wait for the loop. When it falls behind the
+    reader threads block, and gRPC flow control pushes back on the switch.
+    """
+
+    def __init__(self, loop, maxsize=DEFAULT_QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.handlers = {}
+        self.received = {}
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._active = 0
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def attach(self, sw):
+        self._active += 1
+        thread = threading.Thread(target=self._read, args=(sw,), name='stream-%s' % sw.name)
+        thread.daemon = True
+        thread.start()
+
+    def _post(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is gone (controller shutting down)
+            return False
+        return True
+
+    def _read(self, sw):
+        # Managed connections hand over the new stream after a reconnect
+        responses = sw.streamResponses() if hasattr(sw, 'streamResponses') else sw.stream_msg_resp
+        try:
+            for response in responses:
+                self._slots.acquire()
+                if not self._post((sw, response, time.perf_counter())):
+                    return
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                print("%s: StreamChannel closed: %s (%s)" % (sw.name, e.details(), e.code().name))
+        # None marks the end of this switch's stream
+        self._post((sw, None, time.perf_counter()))
+
+    async def run(self):
+        """Dispatch until every attached stream has ended."""
+        while self._active:
+            sw, response, arrival = await self.queue.get()
+            if response is None:
+                self._active -= 1
+                continue
+            self._slots.release()
+            kind = response.WhichOneof('update')
+            self.received[kind] = self.received.get(kind, 0) + 1
+            handler = self.handlers.get(kind)
+            if handler is None:
+                continue
+            result = handler(sw, getattr(response, kind), arrival)
+            if asyncio.iscoroutine(result):
+                await result
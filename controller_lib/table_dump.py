@@ -0,0 +1,272 @@
+import argparse
+import binascii
+import csv
+import json
+import os
+import struct
+import sys
+
+from p4.v1 import p4runtime_pb2
+
+WRITE_BUFFER_SIZE = 1 << 20
+BINARY_MAGIC = b'P4TE\x01\n'
+_LENGTH = struct.Struct('>I')
+
+
+class DecodedEntry(object):
+    """A table entry with table, field, action and param names resolved."""
+
+    __slots__ = ('switch', 'table', 'match', 'action', 'params', 'priority', 'raw')
+
+    def __init__(self, switch, table, match, action, params, priority, raw):
+        self.switch = switch
+        self.table = table
+        self.match = match
+        self.action = action
+        self.params = params
+        self.priority = priority
+        self.raw = raw
+
+    def toDict(self):
+        return {
+            'switch': self.switch,
+            'table': self.table,
+            'match': dict((name, _jsonValue(value)) for name, value in self.match),
+            'action': self.action,
+            'params': dict((name, _jsonValue(value)) for name, value in self.params),
+            'priority': self.priority,
+        }
+
+
+def _jsonValue(value):
+    if isinstance(value, bytes):
+        return binascii.hexlify(value).decode('ascii')
+    if isinstance(value, tuple):
+        return [_jsonValue(v) for v in value]
+    return value
+
+
+def matchFieldValue(m):
+    kind = m.WhichOneof('field_match_type')
+    if kind == 'exact':
+        return m.exact.value
+    if kind == 'lpm':
+        return (m.lpm.value, m.lpm.prefix_len)
+    if kind == 'ternary':
+        return (m.ternary.value, m.ternary.mask)
+    if kind == 'range':
+        return (m.range.low, m.range.high)
+    if kind == 'optional':
+        return m.optional.value
+    raise ValueError("Unsupported match type %r" % kind)
+
+
+def decodeEntry(index, sw_name, entry):
+    table_id = entry.table_id
+    action = entry.action.action
+    return DecodedEntry(
+        sw_name,
+        index.tableName(table_id),
+        [(index.matchFieldName(table_id, m.field_id), matchFieldValue(m)) for m in entry.match],
+        index.actionName(action.action_id) if action.action_id else None,
+        [(index.actionParamName(action.action_id, p.param_id), p.value) for p in action.params],
+        entry.priority,
+        entry)
+
+
+def readRawEntries(sw, table_id=0):
+    """Stream TableEntry messages from sw (table_id 0 reads every table)."""
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    request.entities.add().table_entry.table_id = table_id
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            yield entity.table_entry
+
+
+def iterTableEntries(index, sw, tables=None, actions=None):
+    """Lazily yield DecodedEntry objects as Read responses arrive.
+
+    tables restricts the read on the switch side (one Read per table);
+    actions is applied before decoding, so entries that are filtered out
+    never pay for name resolution.
+    """
+    table_ids = [index.tableId(name) for name in tables] if tables else [0]
+    action_ids = set(index.actionId(name) for name in actions) if actions else None
+    for table_id in table_ids:
+        for entry in readRawEntries(sw, table_id):
+            if action_ids is not None and entry.action.action.action_id not in action_ids:
+                continue
+            yield decodeEntry(index, sw.name, entry)
+
+
+def formatEntry(entry):
+    """The one-line text form printed by readTableRules."""
+    parts = ['%s: ' % entry.table]
+    for name, value in entry.match:
+        parts.append(name)
+        parts.append('%r' % (value,))
+    parts.append('->')
+    parts.append(entry.action)
+    for name, value in entry.params:
+        parts.append(name)
+        parts.append('%r' % value)
+    return ' '.join(parts) + ' \n'
+
+
+class JsonLinesSink(object):
+    extension = 'jsonl'
+
+    def __init__(self, path):
+        self.file = open(path, 'w', buffering=WRITE_BUFFER_SIZE)
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry.toDict(), separators=(',', ':')))
+        self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+class CsvSink(object):
+    extension = 'csv'
+    columns = ('switch', 'table', 'match', 'action', 'params', 'priority')
+
+    def __init__(self, path):
+        self.file = open(path, 'w', buffering=WRITE_BUFFER_SIZE, newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write(self, entry):
+        row = entry.toDict()
+        self.writer.writerow((
+            row['switch'], row['table'],
+            ';'.join('%s=%s' % (k, _csvValue(v)) for k, v in row['match'].items()),
+            row['action'],
+            ';'.join('%s=%s' % (k, _csvValue(v)) for k, v in row['params'].items()),
+            row['priority']))
+
+    def close(self):
+        self.file.close()
+
+
+def _csvValue(value):
+    if isinstance(value, list):
+        return '/'.join(str(v) for v in value)
+    return value
+
+
+class BinarySink(object):
+    """Length-prefixed serialized TableEntry records.
+
+    Names are not stored; decode with readBinaryDump() and the P4Info the
+    dump was taken with.
+    """
+
+    extension = 'bin'
+
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.file.write(BINARY_MAGIC)
+
+    def write(self, entry):
+        data = entry.raw.SerializeToString()
+        self.file.write(_LENGTH.pack(len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+SINKS = {
+    'jsonl': JsonLinesSink,
+    'csv': CsvSink,
+    'bin': BinarySink,
+}
+
+
+def readBinaryDump(path):
+    """Yield the TableEntry records written by BinarySink."""
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("%s is not a binary table dump" % path)
+        while True:
+            header = f.read(_LENGTH.size)
+            if not header:
+                return
+            entry = p4runtime_pb2.TableEntry()
+            entry.ParseFromString(f.read(_LENGTH.unpack(header)[0]))
+            yield entry
+
+
+def dumpTables(index, sw, sink, tables=None, actions=None):
+    """Stream the entries of sw into sink; returns how many were written."""
+    count = 0
+    for entry in iterTableEntries(index, sw, tables, actions):
+        sink.write(entry)
+        count += 1
+    return count
+
+
+class _ReadOnlySwitch(object):
+    """Just enough of a switch connection to issue Read RPCs."""
+
+    def __init__(self, name, address, device_id):
+        import grpc
+        from p4.v1 import p4runtime_pb2_grpc
+
+        self.name = name
+        self.device_id = device_id
+        self.channel = grpc.insecure_channel(address)
+        self.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+
+
+def main():
+    from google.protobuf import text_format
+    from p4.config.v1 import p4info_pb2
+
+    from controller_lib.p4info_index import loadIndex
+    from controller_lib.topology import loadTopology
+
+    parser = argparse.ArgumentParser(description='Dump P4Runtime table entries')
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=True)
+    parser.add_argument('--topology', help='topology file with switch addresses',
+                        type=str, action="store", required=True)
+    parser.add_argument('--switch', help='switch to dump (repeatable, default all)',
+                        type=str, action="append")
+    parser.add_argument('--table', help='only dump this table (repeatable)',
+                        type=str, action="append")
+    parser.add_argument('--action', help='only dump entries using this action (repeatable)',
+                        type=str, action="append")
+    parser.add_argument('--format', help='output format', choices=sorted(SINKS),
+                        default='jsonl')
+    parser.add_argument('--output-dir', help='directory for <switch>.<format> files',
+                        type=str, action="store", default='.')
+    args = parser.parse_args()
+
+    p4info = p4info_pb2.P4Info()
+    with open(args.p4info) as f:
+        text_format.Merge(f.read(), p4info)
+    index = loadIndex(p4info, args.p4info)
+    topology = loadTopology(args.topology)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    for name, settings in topology['switches'].items():
+        if args.switch and name not in args.switch:
+            continue
+        sw = _ReadOnlySwitch(name, settings['address'], settings['device_id'])
+        sink_class = SINKS[args.format]
+        path = os.path.join(args.output_dir, '%s.%s' % (name, sink_class.extension))
+        sink = sink_class(path)
+        try:
+            count = dumpTables(index, sw, sink, args.table, args.action)
+        finally:
+            sink.close()
+            sw.channel.close()
+        sys.stderr.write("%s: %d entries -> %s\n" % (name, count, path))
+
+
+if __name__ == '__main__':
+    main()
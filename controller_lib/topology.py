@@ -0,0 +1,70 @@
+import json
+import os
+from collections import OrderedDict
+
+
+def loadTopology(path):
+    """Load a topology/rule-set file (JSON, or YAML when PyYAML is installed).
+
+    The file has a "switches" mapping of switch name to connection settings
+    (address, device_id, proto_dump_file[, request_log]) and a "rules"
+    mapping of switch name to a list of table entries, each given as
+    {"table", "match", "action", "params"[, "priority"][, "default_action"]}.
+    Exercises may add their own sections (e.g. "tunnels").
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            import yaml
+            topology = yaml.safe_load(f)
+        else:
+            topology = json.load(f, object_pairs_hook=OrderedDict)
+    topology.setdefault('switches', OrderedDict())
+    topology.setdefault('rules', OrderedDict())
+    return topology
+
+
+def logPath(path, suffix=None):
+    """path with suffix before its extension: logs/s1.txt -> logs/s1.<suffix>.txt"""
+    if not suffix:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, suffix, ext)
+
+
+def connectSwitches(topology, names=None, managed=True, election_ids=None, proto_dump=True,
+                    log_suffix=None):
+    """Open a connection for every switch (or just names).
+
+    With managed (the default) these are ManagedSwitchConnections, which
+    keep their channel alive and reconnect on their own; otherwise plain
+    Bmv2SwitchConnections. election_ids maps switch names to the (high, low)
+    election id to arbitrate with (managed connections only). Without
+    proto_dump the switches' proto_dump_file settings are ignored; with
+    log_suffix they get it before their extension, so that controllers
+    connected to the same switch keep separate logs.
+    """
+    if managed:
+        from controller_lib.connection import ManagedSwitchConnection as connection_class
+    else:
+        from p4runtime_lib.bmv2 import Bmv2SwitchConnection as connection_class
+
+    switches = OrderedDict()
+    for name, settings in topology['switches'].items():
+        if names is not None and name not in names:
+            continue
+        options = {}
+        if managed and 'request_log' in settings:
+            # RequestLog options for a .bin proto_dump_file (max_bytes, level, ...)
+            options['request_log'] = settings['request_log']
+        if election_ids is not None and name in election_ids:
+            options['election_id'] = election_ids[name]
+        proto_dump_file = settings.get('proto_dump_file') if proto_dump else None
+        if proto_dump_file is not None:
+            proto_dump_file = logPath(proto_dump_file, log_suffix)
+        switches[name] = connection_class(
+            name=name,
+            address=settings['address'],
+            device_id=settings['device_id'],
+            proto_dump_file=proto_dump_file,
+            **options)
+    return switches
@@ -0,0 +1,336 @@
+import os
+import re
+import struct
+
+import numpy as np
+
+from controller_lib.counter_history import COUNTER_WIDTH
+
+MAGIC = b'P4TSDB01'
+# magic, width (indices per row), rollup flag, row count, row capacity
+_HEADER = struct.Struct('<8sIIQQ')
+_COUNT_OFFSET = 16
+_PAGE = 4096
+_INITIAL_ROWS = 1024
+# Rows past retention are only compacted away once they are this share of the file
+COMPACT_FRACTION = 0.25
+
+# name, seconds per row (0 for raw samples), retention in seconds
+DEFAULT_LEVELS = (
+    ('raw', 0, 2 * 86400),
+    ('1m', 60, 30 * 86400),
+    ('1h', 3600, 730 * 86400),
+)
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def rowDtype(width, rollup):
+    """One row per sample (or rollup period) with a column per counter index.
+
+    packets and bytes are running totals, corrected for counter wraps and
+    resets, so traffic between two rows is a subtraction. Rollup rows are
+    stamped with the start of their period, hold the totals at its last
+    sample and the peak rates seen within it.
+    """
+    fields = [('time', '<f8'), ('packets', '<u8', (width,)), ('bytes', '<u8', (width,))]
+    if rollup:
+        fields += [('peak_pps', '<f4', (width,)), ('peak_bps', '<f4', (width,))]
+    return np.dtype(fields)
+
+
+def _dataOffset(width):
+    return -(-(_HEADER.size + 4 * width) // _PAGE) * _PAGE
+
+
+def _searchTime(times, timestamp):
+    # bisect_left over a strided view without copying it
+    lo, hi = 0, len(times)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[mid] < timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class SeriesFile(object):
+    """Fixed-width rows of one counter at one resolution, memory-mapped.
+
+    The file is a header page (the counter indices of the columns) followed
+    by rows of rowDtype(). It grows by doubling; rows() and range() are views
+    into the mapping, not copies. Replacing the file (compaction, new
+    indices) writes a new one and renames it over, so views handed out
+    before keep reading the old contents.
+    """
+
+    def __init__(self, path, indices=None, rollup=False):
+        self.path = path
+        if os.path.exists(path):
+            self._map()
+            if indices is not None and list(indices) != list(self.indices):
+                self.setIndices(indices)
+        else:
+            if indices is None:
+                raise ValueError("%s does not exist and no indices were given" % path)
+            self._create(path, list(indices), rollup, _INITIAL_ROWS)
+            self._map()
+
+    @staticmethod
+    def _create(path, indices, rollup, capacity, rows=None):
+        width = len(indices)
+        offset = _dataOffset(width)
+        dtype = rowDtype(width, rollup)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, width, int(rollup), 0 if rows is None else len(rows), capacity))
+            f.write(np.asarray(indices, dtype='<u4').tobytes())
+            f.truncate(offset + capacity * dtype.itemsize)
+            if rows is not None:
+                f.seek(offset)
+                f.write(rows.tobytes())
+        os.replace(tmp_path, path)
+
+    def _map(self):
+        with open(self.path, 'rb') as f:
+            magic, width, rollup, count, capacity = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a counter series file" % self.path)
+        self.rollup = bool(rollup)
+        self.dtype = rowDtype(width, self.rollup)
+        self.capacity = capacity
+        self._mm = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        self.indices = np.ndarray((width,), '<u4', buffer=self._mm, offset=_HEADER.size)
+        self._count = np.ndarray((1,), '<u8', buffer=self._mm, offset=_COUNT_OFFSET)
+        self._rows = np.ndarray((capacity,), self.dtype, buffer=self._mm, offset=_dataOffset(width))
+        self.column = dict((int(index), i) for i, index in enumerate(self.indices))
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    def rows(self):
+        return self._rows[:self.count]
+
+    def last(self):
+        count = self.count
+        return self._rows[count - 1] if count else None
+
+    def range(self, start=None, end=None):
+        """Rows with start <= time < end, as a view."""
+        rows = self.rows()
+        times = rows['time']
+        lo = 0 if start is None else _searchTime(times, start)
+        hi = len(rows) if end is None else _searchTime(times, end)
+        return rows[lo:hi]
+
+    def append(self, row):
+        """Append one row given as a dict of field arrays (or a 1-row array)."""
+        count = self.count
+        if count == self.capacity:
+            self._grow()
+        target = self._rows[count]
+        for name in self.dtype.names:
+            target[name] = row[name]
+        self._count[0] = count + 1
+
+    def _grow(self):
+        self._mm.flush()
+        capacity = self.capacity * 2
+        with open(self.path, 'r+b') as f:
+            f.truncate(_dataOffset(len(self.indices)) + capacity * self.dtype.itemsize)
+            f.seek(_HEADER.size - 8)
+            f.write(struct.pack('<Q', capacity))
+        self._map()
+
+    def _rewrite(self, indices, rows):
+        capacity = max(_INITIAL_ROWS, 1 << max(0, len(rows) - 1).bit_length())
+        self._create(self.path, indices, self.rollup, capacity, rows)
+        self._map()
+
+    def compact(self, before):
+        """Drop the rows older than before (when there are enough of them)."""
+        count = self.count
+        expired = _searchTime(self.rows()['time'], before)
+        if not expired or expired < count * COMPACT_FRACTION:
+            return 0
+        self._rewrite(list(self.indices), np.ascontiguousarray(self._rows[expired:count]))
+        return expired
+
+    def setIndices(self, indices):
+        """Switch to new columns, keeping the history of the indices that stay
+        (and of the ones that go, which stop changing)."""
+        old = [int(i) for i in self.indices]
+        merged = old + [int(i) for i in indices if int(i) not in self.column]
+        dtype = rowDtype(len(merged), self.rollup)
+        rows = np.zeros(self.count, dtype)
+        current = self.rows()
+        rows['time'] = current['time']
+        for name in dtype.names[1:]:
+            rows[name][:, :len(old)] = current[name]
+        self._rewrite(merged, rows)
+
+    def flush(self):
+        self._mm.flush()
+
+
+class _Rollup(object):
+    __slots__ = ('period', 'bucket', 'peak_pps', 'peak_bps', 'packets', 'bytes')
+
+    def __init__(self, period, width):
+        self.period = period
+        self.bucket = None
+        self.peak_pps = np.zeros(width, '<f4')
+        self.peak_bps = np.zeros(width, '<f4')
+        self.packets = None
+        self.bytes = None
+
+
+class _CounterState(object):
+    """Running totals and open rollup periods of one (switch, counter)."""
+
+    __slots__ = ('files', 'indices', 'positions', 'time', 'raw_packets', 'raw_bytes',
+                 'packets', 'bytes', 'rollups')
+
+
+def counterDeltas(previous, current, width=COUNTER_WIDTH):
+    """counter_history.counterDelta() over arrays of uint64 readings."""
+    mask = np.uint64((1 << width) - 1)
+    delta = (current - previous) & mask
+    # A drop of less than half the range is a reset: the reading is the delta
+    reset = (current < previous) & (((previous - current) & mask) <= np.uint64(1 << (width - 1)))
+    delta[reset] = current[reset]
+    return delta
+
+
+class CounterStore(object):
+    """Counter samples on local disk, one directory per switch and counter.
+
+    Each counter has a SeriesFile per level (DEFAULT_LEVELS: raw samples,
+    1 minute and 1 hour rollups). Rollups are produced as the samples come
+    in. A level's rows older than its retention are compacted away once
+    they make up a good share of the file, so the cost is spread over the
+    appends. Queries return views of the mapped files; nothing is loaded
+    into memory up front.
+
+    After a restart totals continue from the last row on disk, and the
+    traffic between the last sample before and the first after is lost.
+    """
+
+    def __init__(self, directory, levels=DEFAULT_LEVELS, width=COUNTER_WIDTH):
+        self.directory = directory
+        self.levels = levels
+        self.width = width
+        self._counters = {}
+
+    def _dir(self, sw_name, counter_name):
+        return os.path.join(self.directory, _UNSAFE.sub('_', sw_name), _UNSAFE.sub('_', counter_name))
+
+    def _state(self, sw_name, counter_name, indices):
+        key = (sw_name, counter_name)
+        state = self._counters.get(key)
+        if state is not None and list(state.indices) == list(indices):
+            return state
+        directory = self._dir(sw_name, counter_name)
+        os.makedirs(directory, exist_ok=True)
+        state = _CounterState()
+        state.files = [SeriesFile(os.path.join(directory, '%s.tsdb' % name), indices, rollup=bool(period))
+                       for name, period, _ in self.levels]
+        raw = state.files[0]
+        state.indices = list(indices)
+        # Columns in the file may include indices that are no longer sampled
+        state.positions = np.array([raw.column[int(i)] for i in indices], dtype=np.intp)
+        width = len(raw.indices)
+        last = raw.last()
+        state.time = None
+        state.raw_packets = state.raw_bytes = None
+        state.packets = np.array(last['packets']) if last is not None else np.zeros(width, '<u8')
+        state.bytes = np.array(last['bytes']) if last is not None else np.zeros(width, '<u8')
+        state.rollups = [_Rollup(period, width) for _, period, _ in self.levels[1:]]
+        self._counters[key] = state
+        return state
+
+    def record(self, sw_name, counter_name, timestamp, values, indices):
+        """Append one sample: values is {index: (packets, bytes)} as read."""
+        state = self._state(sw_name, counter_name, indices)
+        packets = np.array([values.get(i, (0, 0))[0] for i in indices], dtype='<u8')
+        bytes_ = np.array([values.get(i, (0, 0))[1] for i in indices], dtype='<u8')
+        pos = state.positions
+        d_packets = np.zeros(len(state.packets), '<u8')
+        d_bytes = np.zeros(len(state.bytes), '<u8')
+        if state.raw_packets is not None:
+            d_packets[pos] = counterDeltas(state.raw_packets, packets, self.width)
+            d_bytes[pos] = counterDeltas(state.raw_bytes, bytes_, self.width)
+        elapsed = timestamp - state.time if state.time is not None else 0.0
+        state.raw_packets, state.raw_bytes, state.time = packets, bytes_, timestamp
+        state.packets += d_packets
+        state.bytes += d_bytes
+        state.files[0].append({'time': timestamp, 'packets': state.packets, 'bytes': state.bytes})
+
+        for rollup, series, (_, _, retention) in zip(state.rollups, state.files[1:], self.levels[1:]):
+            bucket = timestamp - timestamp % rollup.period
+            if rollup.bucket is not None and bucket != rollup.bucket:
+                series.append({'time': rollup.bucket, 'packets': rollup.packets, 'bytes': rollup.bytes,
+                               'peak_pps': rollup.peak_pps, 'peak_bps': rollup.peak_bps})
+                rollup.peak_pps[:] = 0
+                rollup.peak_bps[:] = 0
+                series.compact(timestamp - retention)
+            rollup.bucket = bucket
+            rollup.packets = state.packets.copy()
+            rollup.bytes = state.bytes.copy()
+            if elapsed > 0:
+                np.maximum(rollup.peak_pps, d_packets / elapsed, out=rollup.peak_pps, casting='unsafe')
+                np.maximum(rollup.peak_bps, d_bytes * 8.0 / elapsed, out=rollup.peak_bps, casting='unsafe')
+        state.files[0].compact(timestamp - self.levels[0][2])
+
+    def recordSnapshot(self, snapshot, timestamp, indices):
+        """Record a CounterPoller snapshot.
+
+        indices is {(switch, counter): [index]} of the indices to keep; the
+        counters it does not name are skipped.
+        """
+        for key, values in snapshot.items():
+            if indices.get(key):
+                self.record(key[0], key[1], timestamp, values, indices[key])
+
+    def _file(self, sw_name, counter_name, level):
+        names = [name for name, _, _ in self.levels]
+        if level not in names:
+            raise ValueError("Unknown level %r (have %s)" % (level, ', '.join(names)))
+        state = self._counters.get((sw_name, counter_name))
+        if state is not None:
+            return state.files[names.index(level)]
+        path = os.path.join(self._dir(sw_name, counter_name), '%s.tsdb' % level)
+        if not os.path.exists(path):
+            raise KeyError("No %s samples of %s on %s" % (level, counter_name, sw_name))
+        return SeriesFile(path)
+
+    def query(self, sw_name, counter_name, start=None, end=None, level='raw'):
+        """Rows with start <= time < end as a structured array view.
+
+        Returns (indices, rows): column j of rows['packets'] belongs to
+        counter index indices[j].
+        """
+        series = self._file(sw_name, counter_name, level)
+        return series.indices, series.range(start, end)
+
+    def series(self, sw_name, counter_name, index, start=None, end=None, level='raw'):
+        """(times, packets, bytes) of one counter index, all strided views."""
+        series = self._file(sw_name, counter_name, level)
+        rows = series.range(start, end)
+        column = series.column[index]
+        return rows['time'], rows['packets'][:, column], rows['bytes'][:, column]
+
+    def flush(self):
+        for state in self._counters.values():
+            for series in state.files:
+                series.flush()
+
+
+def rates(times, totals):
+    """Per-interval rates from a series of running totals (len - 1 values)."""
+    elapsed = np.diff(times)
+    delta = np.diff(totals).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(elapsed > 0, delta / elapsed, 0.0)
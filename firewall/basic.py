@@ -8,46 +8,38 @@ from time import sleep
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
-import p4runtime_lib.bmv2
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
 
-def writeTunnelRules(p4info_helper, ingress_sw,port,dst_eth_addr, dst_ip_addr):
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": (dst_ip_addr,32)
-        },
-        action_name="MyIngress.ipv4_forward",
-        action_params={
-            "dstAddr": dst_eth_addr,
-            "port": port
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed egress tunnel rule on %s" % ingress_sw.name)
-    print(dst_eth_addr,port)
-
-
-def readTableRules(p4info_helper, sw):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.batch import DEFAULT_BATCH_SIZE, batchSizeArg
+from controller_lib.bringup import bringUpSwitches, printBringUpSummary
+from controller_lib.p4info_index import attachIndex, indexFor
+from controller_lib.pipeline import PreparedPipeline, ensurePipeline, printPipelineStatus
+from controller_lib.route_compiler import aggregateRuleSets, aggregationReport
+from controller_lib.ruleset import compileRulesCached, installRuleSet
+from controller_lib.scheduler import WriteScheduler, tablePriorities
+from controller_lib.shadow import ShadowStore
+from controller_lib.sharding import ShardMap, isMaster, parseControllers
+from controller_lib.table_dump import decodeEntry, formatEntry, iterTableEntries
+from controller_lib.topology import connectSwitches, loadTopology
+
+DEFAULT_CACHE_DIR = './build/rules-cache'
+
+def readTableRules(p4info_helper, sw, shadow=None):
   
+    index = indexFor(p4info_helper)
     print('\n----- Reading tables rules for %s -----' % sw.name)
-    for response in sw.ReadTableEntries():
-        for entity in response.entities:
-            entry = entity.table_entry
-            table_name = p4info_helper.get_tables_name(entry.table_id)
-            print('%s: ' % table_name, end=' ')
-            for m in entry.match:
-                print(p4info_helper.get_match_field_name(table_name, m.field_id), end=' ')
-                print('%r' % (p4info_helper.get_match_field_value(m),), end=' ')
-            action = entry.action.action
-            action_name = p4info_helper.get_actions_name(action.action_id)
-            print('->', action_name, end=' ')
-            for p in action.params:
-                print(p4info_helper.get_action_param_name(action_name, p.param_id), end=' ')
-                print('%r' % p.value, end=' ')
-            print()
+    # From the shadow when there is one, otherwise decoded as Read responses
+    # stream in; one stdout write each
+    if shadow is not None:
+        entries = (decodeEntry(index, sw.name, e) for e in shadow.entries(sw.name))
+    else:
+        entries = iterTableEntries(index, sw)
+    for entry in entries:
+        sys.stdout.write(formatEntry(entry))
+    sys.stdout.flush()
 
 def printCounter(p4info_helper, sw, counter_name, index):
     for response in sw.ReadCounters(p4info_helper.get_counters_id(counter_name), index):
@@ -65,75 +57,52 @@ def printGrpcError(e):
     traceback = sys.exc_info()[2]
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, topology_file_path,
+         batch_size=DEFAULT_BATCH_SIZE, cache_dir=DEFAULT_CACHE_DIR, warm_restart=False,
+         aggregate_routes=False, controller_id='0', controllers='1'):
     # Instantiate a P4Runtime helper from the p4info file
     p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    attachIndex(p4info_helper, p4info_file_path)
+    # Everything written is mirrored in memory; reads and diffs use it
+    shadow = ShadowStore()
+    # check_ports rules and default entries go out before bulk routes, paced
+    # to what each switch accepts and retried on RESOURCE_EXHAUSTED
+    batcher = WriteScheduler(batch_size, observers=[shadow],
+                             priorities=tablePriorities(p4info_helper))
+    topology = loadTopology(topology_file_path)
+    rules = topology['rules']
+    if aggregate_routes:
+        # Merge/drop redundant ipv4_lpm routes before they are compiled
+        aggregated = aggregateRuleSets(rules)
+        for line in aggregationReport(rules, aggregated):
+            print(line)
+        rules = aggregated
+    desired = compileRulesCached(p4info_helper, rules, cache_dir)
+    # The bmv2 JSON is read and serialized once for every switch
+    prepared = PreparedPipeline(p4info_helper.p4info, bmv2_file_path)
+
+    # With several controllers each one installs only its own shard
+    shard = ShardMap(parseControllers(controllers), controller_id, standbys=0)
+    primary = shard.primarySwitches(topology['switches'])
+    election_ids = dict((name, shard.electionId(name)) for name in primary)
 
     try:
-        s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s2',
-            address='127.0.0.1:50052',
-            device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
-        s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s3',
-            address='127.0.0.1:50053',
-            device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        s4 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s4',
-            address='127.0.0.1:50054',
-            device_id=3,
-            proto_dump_file='logs/s4-p4runtime-requests.txt')
-
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-        s4.MasterArbitrationUpdate()
-
-
-
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-        s4.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s4")
-
-
-
-        writeTunnelRules(p4info_helper, ingress_sw=s2, port=4,dst_eth_addr="08:00:00:00:03:00", dst_ip_addr="10.0.1.1")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s2, port=3,dst_eth_addr="08:00:00:00:04:00", dst_ip_addr="10.0.2.2")
+        switches = list(connectSwitches(topology, primary, election_ids=election_ids).values())
 
-        writeTunnelRules(p4info_helper, ingress_sw=s2, port=1,dst_eth_addr="08:00:00:00:03:33", dst_ip_addr="10.0.3.3")
+        def setupSwitch(sw):
+            if not isMaster(sw.MasterArbitrationUpdate()):
+                raise RuntimeError("another controller is master of %s" % sw.name)
+            pushed = ensurePipeline(sw, p4info_helper.p4info, bmv2_file_path,
+                                    warm=warm_restart, prepared=prepared)
+            printPipelineStatus(sw, pushed)
+            print(installRuleSet(sw, desired.get(sw.name, []), batcher,
+                                 current=[] if pushed else None, shadow=shadow))
 
-        writeTunnelRules(p4info_helper, ingress_sw=s2, port=2,dst_eth_addr="08:00:00:00:04:44", dst_ip_addr="10.0.4.4")
+        # One worker per switch; the verification read waits for all of them
+        ready = printBringUpSummary(bringUpSwitches(switches, setupSwitch))
 
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, port=1,dst_eth_addr="08:00:00:00:01:00", dst_ip_addr="10.0.1.1")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, port=1,dst_eth_addr="08:00:00:00:01:00", dst_ip_addr="10.0.2.2")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, port=2,dst_eth_addr="08:00:00:00:02:00", dst_ip_addr="10.0.3.3")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, port=2,dst_eth_addr="08:00:00:00:02:00", dst_ip_addr="10.0.4.4")
-
-
-        writeTunnelRules(p4info_helper, ingress_sw=s4, port=2,dst_eth_addr="08:00:00:00:01:00", dst_ip_addr="10.0.1.1")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s4, port=2,dst_eth_addr="08:00:00:00:01:00", dst_ip_addr="10.0.2.2")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s4, port=1,dst_eth_addr="08:00:00:00:02:00", dst_ip_addr="10.0.3.3")
-
-        writeTunnelRules(p4info_helper, ingress_sw=s4, port=1,dst_eth_addr="08:00:00:00:02:00", dst_ip_addr="10.0.4.4")
-
-        readTableRules(p4info_helper, s2)
-        readTableRules(p4info_helper, s3)
-        readTableRules(p4info_helper, s4)
-            
+        for sw in ready:
+            readTableRules(p4info_helper, sw, shadow)
 
     except KeyboardInterrupt:
         print(" Shutting down.")
@@ -150,6 +119,23 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/basic.json')
+    parser.add_argument('--topology', help='topology/rule-set file (JSON or YAML)',
+                        type=str, action="store", required=False,
+                        default='./basic-topology.json')
+    parser.add_argument('--batch-size', help='max updates per WriteRequest (1 for one per entry)',
+                        type=batchSizeArg, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--rules-cache', help='directory for compiled rule sets',
+                        type=str, action="store", required=False,
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--warm-restart', help='keep the running pipeline and its rules when unchanged',
+                        action="store_true", default=False)
+    parser.add_argument('--aggregate-routes', help='merge redundant ipv4_lpm routes before installing',
+                        action="store_true", default=False)
+    parser.add_argument('--controller-id', help='id of this controller among --controllers',
+                        type=str, action="store", required=False, default='0')
+    parser.add_argument('--controllers', help='number of controllers, or their ids separated by commas',
+                        type=str, action="store", required=False, default='1')
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -160,4 +146,9 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topology):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topology)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topology, args.batch_size, args.rules_cache,
+         args.warm_restart, args.aggregate_routes, args.controller_id, args.controllers)
@@ -10,212 +10,37 @@ from time import sleep
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
-import p4runtime_lib.bmv2
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
 
-def writeTunnelRules(p4info_helper, ingress_sw,port,dst_eth_addr, dst_ip_addr):
-
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": (dst_ip_addr,32)
-        },
-        action_name="MyIngress.ipv4_forward",
-        action_params={
-            "dstAddr": dst_eth_addr,
-            "port": port
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-    print(dst_eth_addr,port)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": ("10.0.2.2",32)
-        },
-        action_name="MyIngress.ipv4_forward",
-        action_params={
-            "dstAddr": "08:00:00:00:02:22",
-            "port": 2
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-    print(dst_eth_addr,port)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": ("10.0.3.3",32)
-        },
-        action_name="MyIngress.ipv4_forward",
-        action_params={
-            "dstAddr": "08:00:00:00:03:00",
-            "port": 3
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-    print(dst_eth_addr,port)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": ("10.0.4.4",32)
-        },
-        action_name="MyIngress.ipv4_forward",
-        action_params={
-            "dstAddr": "08:00:00:00:04:00",
-            "port": 4
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-    print(dst_eth_addr,port)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 1,
-            "standard_metadata.egress_spec": 3
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 0
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-   
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 2,
-            "standard_metadata.egress_spec": 3
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 0
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 1,
-            "standard_metadata.egress_spec": 4
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 0
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 2,
-            "standard_metadata.egress_spec": 4
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 0
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 3,
-            "standard_metadata.egress_spec": 1
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 1
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-    
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 3,
-            "standard_metadata.egress_spec": 2
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 1
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 4,
-            "standard_metadata.egress_spec": 1
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 1
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.check_ports",
-        match_fields={
-            "standard_metadata.ingress_port": 4,
-            "standard_metadata.egress_spec": 2
-        },
-        action_name="MyIngress.set_direction",
-        action_params={
-            "dir": 1
-        })
-
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-
-
-    
-
-
-def readTableRules(p4info_helper, sw):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.batch import DEFAULT_BATCH_SIZE, batchSizeArg
+from controller_lib.p4info_index import attachIndex, indexFor
+from controller_lib.pipeline import PreparedPipeline, ensurePipelines, printPipelineStatus
+from controller_lib.registers import DEFAULT_BLOOM_REGISTERS, DEFAULT_MAX_FPR, BloomFilterManager
+from controller_lib.route_compiler import aggregateRuleSets, aggregationReport
+from controller_lib.ruleset import compileRulesCached, installRuleSet
+from controller_lib.scheduler import WriteScheduler, tablePriorities
+from controller_lib.shadow import ShadowStore
+from controller_lib.table_dump import decodeEntry, formatEntry, iterTableEntries
+from controller_lib.topology import connectSwitches, loadTopology
+
+DEFAULT_CACHE_DIR = './build/rules-cache'
+
+def readTableRules(p4info_helper, sw, shadow=None):
   
+    index = indexFor(p4info_helper)
     print('\n----- Reading tables rules for %s -----' % sw.name)
-    for response in sw.ReadTableEntries():
-        for entity in response.entities:
-            entry = entity.table_entry
-            # TODO For extra credit, you can use the p4info_helper to translate
-            #      the IDs in the entry to names
-            table_name = p4info_helper.get_tables_name(entry.table_id)
-            print('%s: ' % table_name, end=' ')
-            for m in entry.match:
-                print(p4info_helper.get_match_field_name(table_name, m.field_id), end=' ')
-                print('%r' % (p4info_helper.get_match_field_value(m),), end=' ')
-            action = entry.action.action
-            action_name = p4info_helper.get_actions_name(action.action_id)
-            print('->', action_name, end=' ')
-            for p in action.params:
-                print(p4info_helper.get_action_param_name(action_name, p.param_id), end=' ')
-                print('%r' % p.value, end=' ')
-            print()
+    # From the shadow when there is one, otherwise decoded as Read responses
+    # stream in; one stdout write each
+    if shadow is not None:
+        entries = (decodeEntry(index, sw.name, e) for e in shadow.entries(sw.name))
+    else:
+        entries = iterTableEntries(index, sw)
+    for entry in entries:
+        sys.stdout.write(formatEntry(entry))
+    sys.stdout.flush()
 
 def printCounter(p4info_helper, sw, counter_name, index):
     for response in sw.ReadCounters(p4info_helper.get_counters_id(counter_name), index):
@@ -233,34 +58,61 @@ def printGrpcError(e):
     traceback = sys.exc_info()[2]
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, topology_file_path,
+         batch_size=DEFAULT_BATCH_SIZE, cache_dir=DEFAULT_CACHE_DIR, warm_restart=False,
+         aggregate_routes=False, bloom_monitor=0, bloom_max_fpr=DEFAULT_MAX_FPR,
+         bloom_reset_interval=0, bloom_registers=DEFAULT_BLOOM_REGISTERS):
     # Instantiate a P4Runtime helper from the p4info file
     p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    attachIndex(p4info_helper, p4info_file_path)
+    # Everything written is mirrored in memory; reads and diffs use it
+    shadow = ShadowStore()
+    # check_ports rules and default entries go out before bulk routes, paced
+    # to what each switch accepts and retried on RESOURCE_EXHAUSTED
+    batcher = WriteScheduler(batch_size, observers=[shadow],
+                             priorities=tablePriorities(p4info_helper))
+    topology = loadTopology(topology_file_path)
+    rules = topology['rules']
+    if aggregate_routes:
+        # Merge/drop redundant ipv4_lpm routes before they are compiled
+        aggregated = aggregateRuleSets(rules)
+        for line in aggregationReport(rules, aggregated):
+            print(line)
+        rules = aggregated
+    desired = compileRulesCached(p4info_helper, rules, cache_dir)
+    # The bmv2 JSON is read and serialized once for every switch
+    prepared = PreparedPipeline(p4info_helper.p4info, bmv2_file_path)
 
     try:
-        s1 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s1',
-            address='127.0.0.1:50051',
-            device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
-        
-
-        s1.MasterArbitrationUpdate()
-
-
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-
+        switches = list(connectSwitches(topology).values())
 
-        writeTunnelRules(p4info_helper, ingress_sw=s1, port=1,dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1")
+        for sw in switches:
+            sw.MasterArbitrationUpdate()
 
+        # One upload per switch, all in flight at once
+        pushed = ensurePipelines(switches, prepared, warm=warm_restart)
+        for sw in switches:
+            printPipelineStatus(sw, pushed[sw.name])
 
+            print(installRuleSet(sw, desired.get(sw.name, []), batcher,
+                                 current=[] if pushed[sw.name] else None, shadow=shadow))
 
         # TODO Uncomment the following two lines to read table entries from s1 and s2
-        readTableRules(p4info_helper, s1)
-        
-            
+        for sw in switches:
+            readTableRules(p4info_helper, sw, shadow)
+
+        # Keep the connection-tracking filters from saturating
+        if bloom_monitor:
+            manager = BloomFilterManager(p4info_helper, bloom_registers, bloom_max_fpr,
+                                         bloom_reset_interval, batch_size)
+            while True:
+                print('\n----- Checking bloom filters -----')
+                for sw in switches:
+                    stats, reset = manager.check(sw)
+                    print(stats)
+                    if reset is not None:
+                        print(reset)
+                sleep(bloom_monitor)
 
     except KeyboardInterrupt:
         print(" Shutting down.")
@@ -277,6 +129,28 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/firewall.json')
+    parser.add_argument('--topology', help='topology/rule-set file (JSON or YAML)',
+                        type=str, action="store", required=False,
+                        default='./firewall-topology.json')
+    parser.add_argument('--batch-size', help='max updates per WriteRequest (1 for one per entry)',
+                        type=batchSizeArg, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--rules-cache', help='directory for compiled rule sets',
+                        type=str, action="store", required=False,
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--warm-restart', help='keep the running pipeline and its rules when unchanged',
+                        action="store_true", default=False)
+    parser.add_argument('--aggregate-routes', help='merge redundant ipv4_lpm routes before installing',
+                        action="store_true", default=False)
+    parser.add_argument('--bloom-monitor', help='seconds between bloom filter checks (0 disables)',
+                        type=float, action="store", required=False, default=0)
+    parser.add_argument('--bloom-max-fpr', help='reset the bloom filter above this false-positive rate',
+                        type=float, action="store", required=False, default=DEFAULT_MAX_FPR)
+    parser.add_argument('--bloom-reset-interval', help='also reset the bloom filter every N seconds (0 disables)',
+                        type=float, action="store", required=False, default=0)
+    parser.add_argument('--bloom-registers', help='comma-separated bloom filter register arrays',
+                        type=str, action="store", required=False,
+                        default=','.join(DEFAULT_BLOOM_REGISTERS))
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -287,4 +161,10 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topology):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topology)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topology, args.batch_size, args.rules_cache,
+         args.warm_restart, args.aggregate_routes, args.bloom_monitor, args.bloom_max_fpr,
+         args.bloom_reset_interval, args.bloom_registers.split(','))
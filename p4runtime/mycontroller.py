@@ -3,90 +3,143 @@ import argparse
 import grpc
 import os
 import sys
-from time import sleep
+from time import sleep, time
 
 # 引入库和需要用到的 p4runtime_lib
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
-import p4runtime_lib.bmv2
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 import p4runtime_lib.helper
 
-def writeTunnelRules(p4info_helper, ingress_sw, egress_sw, tunnel_id,
-                     dst_eth_addr, dst_ip_addr,SWITCH_TO_HOST_PORT,SWITCH_TO_SWITCH_PORT):
-    # 1) Tunnel Ingress Rule
-    # 将数据封装到指定ID的隧道上
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.ipv4_lpm",
-        match_fields={
-            "hdr.ipv4.dstAddr": (dst_ip_addr, 32)
-        },
-        action_name="MyIngress.myTunnel_ingress",
-        action_params={
-            "dst_id": tunnel_id,
-        })
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    # 2) Tunnel Transit Rule
-    # 指定数据从交换机输出的端口，基于指定的隧道ID转发数据。
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.myTunnel_exact",
-        match_fields={
-            "hdr.myTunnel.dst_id": tunnel_id
-        },
-        action_name="MyIngress.myTunnel_forward",
-        action_params={
-            "port": SWITCH_TO_SWITCH_PORT
-        })
-    ingress_sw.WriteTableEntry(table_entry)
-    print("Installed transit tunnel rule on %s" % ingress_sw.name)
-
-    # 3) Tunnel Egress Rule
-    # 指定主机连接交换机的端口，使用特定的隧道ID对数据解封装，并且发送数据到主机。
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.myTunnel_exact",
-        match_fields={
-            "hdr.myTunnel.dst_id": tunnel_id
-        },
-        action_name="MyIngress.myTunnel_egress",
-        action_params={
-            "dstAddr": dst_eth_addr,
-            "port": SWITCH_TO_HOST_PORT
-        })
-    egress_sw.WriteTableEntry(table_entry)
-    print("Installed egress tunnel rule on %s" % egress_sw.name)
-
-
-def readTableRules(p4info_helper, sw):
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller_lib.batch import DEFAULT_BATCH_SIZE, batchSizeArg
+from controller_lib.bringup import bringUpSwitches, printBringUpSummary
+from controller_lib.connection import HealthMonitor
+from controller_lib.counter_history import CounterHistory
+from controller_lib.counters import CounterPoller
+from controller_lib.ctl import socketInUse, socketPath
+from controller_lib.daemon import ControlServer
+from controller_lib.journal import Journal, settleUncertain
+from controller_lib.metrics import MetricsRegistry, instrumentSwitch, startMetricsServer
+from controller_lib.p4info_index import attachIndex, indexFor
+from controller_lib.paths import PathEngine, TunnelIdAllocator, meshTunnels, tunnelPathRules
+from controller_lib.pipeline import PreparedPipeline, ensurePipeline, printPipelineStatus
+from controller_lib.reroute import Rerouter, followEvents, parseEvent
+from controller_lib.ruleset import compileRulesCached, installRuleSet
+from controller_lib.scheduler import WriteScheduler, tablePriorities
+from controller_lib.shadow import ShadowAuditor, ShadowStore
+from controller_lib.sharding import DEFAULT_STANDBYS, Mastership, ShardMap, isMaster, parseControllers
+from controller_lib.table_dump import decodeEntry, formatEntry, iterTableEntries
+from controller_lib.topology import connectSwitches, loadTopology
+
+INGRESS_TUNNEL_COUNTER = "MyIngress.ingressTunnelCounter"
+EGRESS_TUNNEL_COUNTER = "MyIngress.egressTunnelCounter"
+DEFAULT_CACHE_DIR = './build/rules-cache'
+
+def tunnelRules(ingress_sw, egress_sw, tunnel_id,
+                dst_eth_addr, dst_ip_addr,SWITCH_TO_HOST_PORT,SWITCH_TO_SWITCH_PORT):
+    # 返回 (交换机名, 规则) 列表，规则格式与拓扑文件中的 "rules" 相同
+    return [
+        # 1) Tunnel Ingress Rule
+        # 将数据封装到指定ID的隧道上
+        (ingress_sw, {
+            "table": "MyIngress.ipv4_lpm",
+            "match": {"hdr.ipv4.dstAddr": [dst_ip_addr, 32]},
+            "action": "MyIngress.myTunnel_ingress",
+            "params": {"dst_id": tunnel_id},
+        }),
+        # 2) Tunnel Transit Rule
+        # 指定数据从交换机输出的端口，基于指定的隧道ID转发数据。
+        (ingress_sw, {
+            "table": "MyIngress.myTunnel_exact",
+            "match": {"hdr.myTunnel.dst_id": tunnel_id},
+            "action": "MyIngress.myTunnel_forward",
+            "params": {"port": SWITCH_TO_SWITCH_PORT},
+        }),
+        # 3) Tunnel Egress Rule
+        # 指定主机连接交换机的端口，使用特定的隧道ID对数据解封装，并且发送数据到主机。
+        (egress_sw, {
+            "table": "MyIngress.myTunnel_exact",
+            "match": {"hdr.myTunnel.dst_id": tunnel_id},
+            "action": "MyIngress.myTunnel_egress",
+            "params": {"dstAddr": dst_eth_addr, "port": SWITCH_TO_HOST_PORT},
+        }),
+    ]
+
+def topologyTunnels(topology, engine):
+    # "tunnels" 为列表时使用给出的隧道；为 {"mesh": true, "first_id": N} 时
+    # 根据 "hosts" 和 "links" 为每个交换机到每台远端主机生成一条隧道，隧道ID由位图分配
+    tunnels = topology.get('tunnels', [])
+    if isinstance(tunnels, dict):
+        if not tunnels.get('mesh'):
+            return []
+        allocator = TunnelIdAllocator(tunnels.get('first_id', 1))
+        return meshTunnels(engine, topology.get('hosts', {}), allocator)
+    return list(tunnels)
+
+def topologyRules(topology, tunnels, engine):
+    # 拓扑文件中直接给出的规则加上由隧道展开得到的规则
+    rules = dict((name, list(topology['rules'].get(name, ())))
+                 for name in topology['switches'])
+    for tunnel in tunnels:
+        if 'switch_to_switch_port' in tunnel:
+            # 手工指定端口的单跳隧道
+            tunnel_rules = tunnelRules(
+                tunnel['ingress'], tunnel['egress'], tunnel['tunnel_id'],
+                tunnel['dst_eth_addr'], tunnel['dst_ip_addr'],
+                tunnel['switch_to_host_port'], tunnel['switch_to_switch_port'])
+        else:
+            # 沿最短路径：入口封装，路径上每一跳（含中间交换机）按隧道ID转发，出口解封装
+            tunnel_rules = tunnelPathRules(engine, tunnel)
+        for sw_name, rule in tunnel_rules:
+            rules[sw_name].append(rule)
+    return rules
+
+
+def readTableRules(p4info_helper, sw, shadow=None):
 
+    index = indexFor(p4info_helper)
     print('\n----- Reading tables rules for %s -----' % sw.name)
-    for response in sw.ReadTableEntries():
-        for entity in response.entities:
-            entry = entity.table_entry
-            table_name = p4info_helper.get_tables_name(entry.table_id)
-            print('%s: ' % table_name, end=' ')
-            for m in entry.match:
-                print(p4info_helper.get_match_field_name(table_name, m.field_id), end=' ')
-                print('%r' % (p4info_helper.get_match_field_value(m),), end=' ')
-            action = entry.action.action
-            action_name = p4info_helper.get_actions_name(action.action_id)
-            print('->', action_name, end=' ')
-            for p in action.params:
-                print(p4info_helper.get_action_param_name(action_name, p.param_id), end=' ')
-                print('%r' % p.value, end=' ')
-            print()
-
-def printCounter(p4info_helper, sw, counter_name, index):
-    #对传输的数据包进行监听并读取、打印
-    for response in sw.ReadCounters(p4info_helper.get_counters_id(counter_name), index):
-        for entity in response.entities:
-            counter = entity.counter_entry
-            print("%s %s %d: %d packets (%d bytes)" % (
-                sw.name, counter_name, index,
-                counter.data.packet_count, counter.data.byte_count
-            ))
+    # 有影子表时直接从内存中读取，否则表项随Read响应流式解码；每条规则只写一次stdout
+    if shadow is not None:
+        entries = (decodeEntry(index, sw.name, e) for e in shadow.entries(sw.name))
+    else:
+        entries = iterTableEntries(index, sw)
+    for entry in entries:
+        sys.stdout.write(formatEntry(entry))
+    sys.stdout.flush()
+
+def printTunnelCounters(history, ingress_sw, egress_sw, tunnel_id):
+    print('\n ----- %s->%s -----' % (ingress_sw.name, egress_sw.name))
+    keys = ((ingress_sw.name, INGRESS_TUNNEL_COUNTER, tunnel_id),
+            (egress_sw.name, EGRESS_TUNNEL_COUNTER, tunnel_id))
+    for key in keys:
+        series = history.get(*key)
+        pps, bps = series.rate()
+        print("%s %s %d: %d packets (%d bytes) %.1f pps %.1f bps" % (
+            key[0], key[1], tunnel_id, series.raw_packets, series.raw_bytes, pps, bps
+        ))
+    # 同一隧道入口与出口计数器之差即为该周期内的丢包
+    _, _, lost, ratio = history.loss(*keys)
+    print("loss: %d packets (%.2f%%)" % (lost, ratio * 100))
+
+def exportTunnelCounters(registry, history, ingress_sw, egress_sw, tunnel_id):
+    keys = ((ingress_sw.name, INGRESS_TUNNEL_COUNTER, tunnel_id),
+            (egress_sw.name, EGRESS_TUNNEL_COUNTER, tunnel_id))
+    for key in keys:
+        series = history.get(*key)
+        pps, bps = series.rate()
+        labels = (('switch', key[0]), ('counter', key[1]), ('tunnel', tunnel_id))
+        registry.setGauge('p4rt_tunnel_packets', 'Tunnel counter packets', labels, series.raw_packets)
+        registry.setGauge('p4rt_tunnel_bytes', 'Tunnel counter bytes', labels, series.raw_bytes)
+        registry.setGauge('p4rt_tunnel_pps', 'Tunnel counter packet rate', labels, pps)
+        registry.setGauge('p4rt_tunnel_bps', 'Tunnel counter bit rate', labels, bps)
+    _, _, lost, ratio = history.loss(*keys)
+    labels = (('ingress', ingress_sw.name), ('egress', egress_sw.name), ('tunnel', tunnel_id))
+    registry.setGauge('p4rt_tunnel_lost_packets', 'Packets lost in the last interval', labels, lost)
+    registry.setGauge('p4rt_tunnel_loss_ratio', 'Loss ratio in the last interval', labels, ratio)
 
 def printGrpcError(e):
     print("gRPC Error:", e.details(), end=' ')
@@ -95,89 +148,185 @@ def printGrpcError(e):
     traceback = sys.exc_info()[2]
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
-def main(p4info_file_path, bmv2_file_path):
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+def main(args):
+    # args为解析后的命令行参数（见文件末尾的argparse选项）
+    p4info_helper = p4runtime_lib.helper.P4InfoHelper(args.p4info)
+    attachIndex(p4info_helper, args.p4info)
+    # 已写入交换机的表项保存在内存影子表中，读取和差异比较不再整表读取交换机
+    # 写前日志：每个写请求先记录意图再发送，崩溃重启后重放日志即可重建影子表，无需整表读取交换机
+    journal = Journal(args.journal) if args.journal else None
+    shadow = ShadowStore(journal=journal)
+    if journal is not None:
+        print("Journal: replayed %d records from %s" % (journal.recover(), args.journal))
+    # 写请求按优先级（默认表项、关键表、其余表项）发送，按交换机的写延迟调整并发窗口，RESOURCE_EXHAUSTED时退避并只重发失败的更新
+    batcher = WriteScheduler(args.batch_size, observers=[shadow],
+                             priorities=tablePriorities(p4info_helper))
+    topology = loadTopology(args.topology)
+
+    # 规则只在拓扑文件或p4info变化时重新编译，其余情况直接读取缓存
+    engine = PathEngine(topology.get('links', ()))
+    tunnels = topologyTunnels(topology, engine)
+    desired = compileRulesCached(p4info_helper, topologyRules(topology, tunnels, engine), args.rules_cache)
+    # bmv2 JSON只读取一次，所有交换机共用同一份序列化后的程序配置
+    prepared = PreparedPipeline(p4info_helper.p4info, args.bmv2_json)
 
+    # 多个控制器按一致性哈希划分交换机；本控制器只连接自己作为主或备用的交换机
+    shard = ShardMap(parseControllers(args.controllers), args.controller_id, args.standbys)
+    local = shard.localSwitches(topology['switches'])
+    election_ids = dict((name, shard.electionId(name)) for name in local)
+    print("Controller %s: primary for %s, standby for %s" % (
+        args.controller_id, ', '.join(shard.primarySwitches(local)) or '-',
+        ', '.join(name for name in local if shard.rank(name) > 0) or '-'))
+    # 每个控制器默认使用自己的socket；已有进程在该socket上服务时拒绝启动，避免抢占另一个控制器的socket
+    control_socket = args.control_socket
+    if control_socket is None:
+        control_socket = socketPath(args.controller_id)
+    if control_socket and socketInUse(control_socket):
+        print("Control socket %s is in use by another controller; pass --control-socket" % control_socket)
+        if journal is not None:
+            journal.close()
+        return
+
+    store = None
     try:
-        #创建三个交换机的grpc连接
-        s1 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s1',
-            address='127.0.0.1:50051',
-            device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
-        s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s2',
-            address='127.0.0.1:50052',
-            device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
-        s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
-            name='s3',
-            address='127.0.0.1:50053',
-            device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-
-
-        # 将p4程序安装到交换机中
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-
-        # 根据拓扑结构定义三个交换机与主机连接的端口，以及交换机与交换机之间的端口规则
-        writeTunnelRules(p4info_helper, ingress_sw=s1, egress_sw=s2, tunnel_id=100,
-                         dst_eth_addr="08:00:00:00:02:22", dst_ip_addr="10.0.2.2",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=2)
-
-        writeTunnelRules(p4info_helper, ingress_sw=s2, egress_sw=s1, tunnel_id=200,
-                         dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=2)
-
-        writeTunnelRules(p4info_helper, ingress_sw=s1, egress_sw=s3, tunnel_id=300,
-                         dst_eth_addr="08:00:00:00:03:33", dst_ip_addr="10.0.3.3",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=3)
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, egress_sw=s1, tunnel_id=400,
-                         dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=2)
-
-        writeTunnelRules(p4info_helper, ingress_sw=s2, egress_sw=s3, tunnel_id=500,
-                         dst_eth_addr="08:00:00:00:03:33", dst_ip_addr="10.0.3.3",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=3)
-
-        writeTunnelRules(p4info_helper, ingress_sw=s3, egress_sw=s2, tunnel_id=600,
-                         dst_eth_addr="08:00:00:00:02:22", dst_ip_addr="10.0.2.2",SWITCH_TO_HOST_PORT=1,SWITCH_TO_SWITCH_PORT=3)
-
-        readTableRules(p4info_helper, s1)
-        readTableRules(p4info_helper, s2)
-        readTableRules(p4info_helper, s3)
+        #根据拓扑文件创建各交换机的grpc连接
+        # 同一交换机的主备控制器可能在同一主机上，多控制器时请求日志文件名加上控制器ID，避免互相覆盖
+        connections = connectSwitches(topology, local, election_ids=election_ids,
+                                      log_suffix=args.controller_id if len(shard.controllers) > 1 else None)
+        switches = list(connections.values())
+
+        # 开启metrics时所有RPC都经过拦截器统计延迟、错误码和字节数
+        registry = None
+        if args.metrics_port:
+            registry = MetricsRegistry()
+            for sw in switches:
+                instrumentSwitch(sw, registry)
+            startMetricsServer(registry, args.metrics_port)
+            print("Serving metrics on http://127.0.0.1:%d/metrics" % args.metrics_port)
+
+        def installSwitch(sw, warm):
+            # 将p4程序安装到交换机中；warm restart时若交换机上的程序相同则跳过，保留现有表项
+            pushed = ensurePipeline(sw, p4info_helper.p4info, args.bmv2_json,
+                                    warm=warm, prepared=prepared)
+            printPipelineStatus(sw, pushed)
+            if journal is not None and not pushed:
+                # 只读回崩溃时结果未知的那些表项
+                settled = settleUncertain(sw, shadow, journal)
+                if settled:
+                    print("%s: read back %d entries with an unknown write outcome" % (sw.name, settled))
+            # 与交换机当前的表项做差异比较，只下发需要的INSERT/MODIFY/DELETE（刚推送过程序时表为空，无需读取）
+            print(installRuleSet(sw, desired[sw.name], batcher,
+                                 current=[] if pushed else None, shadow=shadow))
 
+        def onMastershipChange(sw, is_master):
+            # 主控制器失效后交换机把备用控制器提升为master，由它接管（保留交换机上已有的程序和表项）
+            if not is_master:
+                print("%s: no longer master" % sw.name)
+                return
+            print("%s: became master, taking over" % sw.name)
+            try:
+                installSwitch(sw, True)
+            except grpc.RpcError as e:
+                printGrpcError(e)
+
+        mastership = Mastership(onMastershipChange)
+
+        def setupSwitch(sw):
+            # Send master arbitration update message to establish this controller as
+            # master (required by P4Runtime before performing any other write operation)
+            # 选举ID最高的控制器成为master，其余控制器作为备用只保持连接
+            if not isMaster(sw.MasterArbitrationUpdate()):
+                print("%s: standby" % sw.name)
+                return
+            mastership.update(sw, True)
+            installSwitch(sw, args.warm_restart)
+
+        # 每个交换机一个线程，全部完成后才继续（barrier）
+        ready = printBringUpSummary(bringUpSwitches(switches, setupSwitch))
+        if len(ready) != len(switches):
+            for sw in mastership.masters(ready):
+                readTableRules(p4info_helper, sw, shadow)
+            if journal is not None:
+                journal.close()
+            ShutdownAllSwitchConnections()
+            return
+
+        for sw in mastership.masters(switches):
+            readTableRules(p4info_helper, sw, shadow)
+
+        def resyncSwitch(sw):
+            # 重连后若交换机已重启（程序丢失），重新推送程序并安装全部规则；否则未确认的写请求会自动重发
+            if not mastership.isMaster(sw):
+                return
+            if ensurePipeline(sw, p4info_helper.p4info, args.bmv2_json, warm=True, prepared=prepared):
+                printPipelineStatus(sw, True)
+                print(installRuleSet(sw, desired[sw.name], batcher, current=[], shadow=shadow))
+
+        for sw in switches:
+            sw.reconnect_callbacks.append(resyncSwitch)
+            # 跟踪StreamChannel上的仲裁消息，主控制器失效时接管
+            mastership.watch(sw)
+        # 后台并发检查所有交换机的连接，断开时自动重连
+        if args.health_interval:
+            HealthMonitor(switches, args.health_interval).start()
+        # 后台定期整表读取，核对影子表与交换机是否一致
+        if args.audit_interval:
+            ShadowAuditor(shadow, lambda: mastership.masters(switches), args.audit_interval).start()
+        # 链路/端口/交换机故障时只重算经过它的隧道，按先建后拆（INSERT、MODIFY、DELETE）的顺序下发最少的更新
+        rerouter = Rerouter(p4info_helper, engine, tunnels, topology.get('links', ()),
+                            lambda: dict((sw.name, sw) for sw in mastership.masters(switches)),
+                            desired, args.batch_size, observers=[shadow], registry=registry)
+
+        def onLinkEvent(line, received):
+            try:
+                print(rerouter.handle(parseEvent(line, received)))
+            except ValueError as e:
+                print("Ignoring link event: %s" % e)
+
+        # 故障事件可以追加到事件文件中，也可以通过 python -m controller_lib.ctl event 发送
+        if args.link_events:
+            followEvents(args.link_events, onLinkEvent)
+        # 运维查询（python -m controller_lib.ctl）通过Unix socket复用本进程的连接和影子表
+        if control_socket:
+            ControlServer(p4info_helper, switches, shadow, mastership, rerouter).start(control_socket)
+
+        # 每个交换机每轮只发一个ReadRequest，整个计数器数组通配读取后在本地按隧道分发
+        poller = CounterPoller(p4info_helper, [INGRESS_TUNNEL_COUNTER, EGRESS_TUNNEL_COUNTER])
+        history = CounterHistory()
+        tunnel_ids = [tunnel["tunnel_id"] for tunnel in tunnels]
+        # 计数器历史写入本地内存映射的时序文件（原始样本、1分钟和1小时汇总），每个交换机只保存以它为入口或出口的隧道
+        if args.tsdb:
+            # numpy只在开启--tsdb时才需要，不开启时控制器不依赖它
+            from controller_lib.tsdb import CounterStore
+            store = CounterStore(args.tsdb)
+            store_indices = {}
+            for tunnel in tunnels:
+                for counter, name in ((INGRESS_TUNNEL_COUNTER, tunnel["ingress"]),
+                                      (EGRESS_TUNNEL_COUNTER, tunnel["egress"])):
+                    store_indices.setdefault((name, counter), []).append(tunnel["tunnel_id"])
         while True:
             sleep(2) #每两秒读一次隧道计数器
+            # 只轮询本控制器作为master的交换机
+            masters = mastership.masters(switches)
+            snapshot = poller.poll(masters)
+            now = time()
+            history.recordSnapshot(snapshot, now, tunnel_ids)
+            if store is not None:
+                store.recordSnapshot(snapshot, now, store_indices)
+            # 两端都由本控制器负责的隧道才能计算丢包
+            names = set(sw.name for sw in masters)
+            local_tunnels = [tunnel for tunnel in tunnels
+                             if tunnel["ingress"] in names and tunnel["egress"] in names]
+            if registry is not None:
+                # 计数器以gauge形式通过metrics接口导出，不再打印
+                for tunnel in local_tunnels:
+                    exportTunnelCounters(registry, history, connections[tunnel["ingress"]],
+                                         connections[tunnel["egress"]], tunnel["tunnel_id"])
+                continue
             print('\n----- Reading tunnel counters -----')
-            print('\n ----- s1->s2 -----')
-            printCounter(p4info_helper, s1, "MyIngress.ingressTunnelCounter", 100)
-            printCounter(p4info_helper, s2, "MyIngress.egressTunnelCounter", 100)
-            print('\n ----- s2->s1 -----')
-            printCounter(p4info_helper, s2, "MyIngress.ingressTunnelCounter", 200)
-            printCounter(p4info_helper, s1, "MyIngress.egressTunnelCounter", 200)
-            print('\n ----- s1->s3 -----')
-            printCounter(p4info_helper, s1, "MyIngress.ingressTunnelCounter", 300)
-            printCounter(p4info_helper, s3, "MyIngress.egressTunnelCounter", 300)
-            print('\n ----- s3->s1 -----')
-            printCounter(p4info_helper, s3, "MyIngress.ingressTunnelCounter", 400)
-            printCounter(p4info_helper, s1, "MyIngress.egressTunnelCounter", 400)
-            print('\n ----- s2->s3 -----')
-            printCounter(p4info_helper, s2, "MyIngress.ingressTunnelCounter", 500)
-            printCounter(p4info_helper, s3, "MyIngress.egressTunnelCounter", 500)
-            print('\n ----- s3->s2 -----')
-            printCounter(p4info_helper, s3, "MyIngress.ingressTunnelCounter", 600)
-            printCounter(p4info_helper, s2, "MyIngress.egressTunnelCounter", 600)
+            for tunnel in local_tunnels:
+                printTunnelCounters(history, connections[tunnel["ingress"]],
+                                    connections[tunnel["egress"]], tunnel["tunnel_id"])
             print('\n----------- Finished -----------')
 
     except KeyboardInterrupt:
@@ -185,6 +334,10 @@ def main(p4info_file_path, bmv2_file_path):
     except grpc.RpcError as e:
         printGrpcError(e)
 
+    if journal is not None:
+        journal.close()
+    if store is not None:
+        store.flush()
     ShutdownAllSwitchConnections()
 
 if __name__ == '__main__':
@@ -195,6 +348,37 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/advanced_tunnel.json')
+    parser.add_argument('--topology', help='topology/rule-set file (JSON or YAML)',
+                        type=str, action="store", required=False,
+                        default='./topology.json')
+    parser.add_argument('--batch-size', help='max updates per WriteRequest (1 for one per entry)',
+                        type=batchSizeArg, action="store", required=False,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--rules-cache', help='directory for compiled rule sets',
+                        type=str, action="store", required=False,
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--warm-restart', help='keep the running pipeline and its rules when unchanged',
+                        action="store_true", default=False)
+    parser.add_argument('--metrics-port', help='serve Prometheus metrics on this port instead of printing counters',
+                        type=int, action="store", required=False, default=0)
+    parser.add_argument('--health-interval', help='seconds between concurrent switch health checks (0 disables)',
+                        type=float, action="store", required=False, default=5.0)
+    parser.add_argument('--audit-interval', help='seconds between background audits of the shadow tables (0 disables)',
+                        type=float, action="store", required=False, default=60.0)
+    parser.add_argument('--controller-id', help='id of this controller among --controllers',
+                        type=str, action="store", required=False, default='0')
+    parser.add_argument('--controllers', help='number of controllers, or their ids separated by commas',
+                        type=str, action="store", required=False, default='1')
+    parser.add_argument('--standbys', help='controllers standing by for each switch',
+                        type=int, action="store", required=False, default=DEFAULT_STANDBYS)
+    parser.add_argument('--control-socket', help='Unix socket for controller_lib.ctl queries (default: one per --controller-id, empty disables)',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--link-events', help='file of link events (e.g. "link-down s1 s2") to follow and reroute on',
+                        type=str, action="store", required=False, default='')
+    parser.add_argument('--journal', help='directory for a write-ahead journal of table writes, replayed on --warm-restart (empty disables)',
+                        type=str, action="store", required=False, default='')
+    parser.add_argument('--tsdb', help='directory for on-disk tunnel counter history with 1m/1h rollups (empty disables)',
+                        type=str, action="store", required=False, default='')
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -205,4 +389,8 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topology):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topology)
+        parser.exit(1)
+    main(args)
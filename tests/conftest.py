@@ -0,0 +1,63 @@
+import os
+import sys
+
+import grpc
+import pytest
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Where the exercise scripts find p4runtime_lib
+sys.path.append(os.path.join(ROOT, '../utils/'))
+
+from benchmarks.fake_p4runtime import FakeP4RuntimeServer  # noqa: E402
+
+
+class FakeSwitch(object):
+    """The parts of a switch connection the write paths use, on a fake server."""
+
+    def __init__(self, name, server):
+        self.name = name
+        self.device_id = 0
+        self.server = server
+        self.channel = grpc.insecure_channel(server.address)
+        self.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+
+    def ReadTableEntries(self, table_id=None):
+        request = p4runtime_pb2.ReadRequest(device_id=self.device_id)
+        request.entities.add().table_entry.table_id = table_id or 0
+        return self.client_stub.Read(request)
+
+
+@pytest.fixture
+def make_switch():
+    """make_switch(name, latency=0.0) -> a FakeSwitch on its own fake server.
+
+    Patch FakeP4RuntimeServicer before calling it to inject failures.
+    """
+    servers = []
+
+    def make(name='s1', latency=0.0):
+        server = FakeP4RuntimeServer(latency=latency).start()
+        servers.append(server)
+        return FakeSwitch(name, server)
+
+    yield make
+    for server in servers:
+        server.stop()
+
+
+def _tableEntry(key, table_id=7, action_id=1, param=b'\x01'):
+    entry = p4runtime_pb2.TableEntry(table_id=table_id)
+    match = entry.match.add()
+    match.field_id = 1
+    match.exact.value = key.to_bytes(4, 'big')
+    entry.action.action.action_id = action_id
+    entry.action.action.params.add(param_id=1, value=param)
+    return entry
+
+
+@pytest.fixture
+def table_entry():
+    """table_entry(key, table_id=7, action_id=1, param) -> an exact-match TableEntry."""
+    return _tableEntry
@@ -0,0 +1,29 @@
+import grpc
+import pytest
+
+from benchmarks.fake_p4runtime import FakeP4RuntimeServicer
+from controller_lib.batch import WriteBatcher
+
+
+def test_updates_after_a_failed_write_stay_queued(monkeypatch, make_switch, table_entry):
+    write = FakeP4RuntimeServicer.Write
+    calls = []
+
+    def Write(self, request, context):
+        calls.append(len(request.updates))
+        if len(calls) == 2:
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'injected')
+        return write(self, request, context)
+
+    monkeypatch.setattr(FakeP4RuntimeServicer, 'Write', Write)
+    sw = make_switch()
+    batcher = WriteBatcher(2)
+    for i in range(7):
+        batcher.add(sw, table_entry(i))
+    with pytest.raises(grpc.RpcError):
+        batcher.flush()
+    # The failed request's outcome is unknown; the three after it were never sent
+    assert batcher.pending(sw) == 3
+    assert batcher.flush() == []
+    assert batcher.pending() == 0
+    assert sorted(len(t) for t in sw.server.servicer.tables.values()) == [5]
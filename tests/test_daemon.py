@@ -0,0 +1,46 @@
+import os
+import socket
+
+import pytest
+
+from controller_lib.ctl import query, socketInUse, socketPath
+from controller_lib.daemon import ControlServer
+
+
+class Helper(object):
+    # indexFor() takes an index that is already attached
+    p4info_index = object()
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return os.path.join(str(tmp_path), 'c.sock')
+
+
+def test_each_controller_has_its_own_default_socket():
+    assert socketPath('0') != socketPath('1')
+    assert os.path.isabs(socketPath('daemon'))
+
+
+def test_a_live_socket_is_not_taken_over(socket_path):
+    first = ControlServer(Helper(), []).start(socket_path)
+    try:
+        assert socketInUse(socket_path)
+        with pytest.raises(IOError):
+            ControlServer(Helper(), []).start(socket_path)
+        assert query({'cmd': 'switches'}, socket_path) == {'ok': True, 'result': []}
+    finally:
+        first.stop()
+    assert not socketInUse(socket_path)
+
+
+def test_a_socket_left_behind_is_replaced(socket_path):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert os.path.exists(socket_path) and not socketInUse(socket_path)
+    server = ControlServer(Helper(), []).start(socket_path)
+    try:
+        assert query({'cmd': 'switches'}, socket_path)['ok']
+    finally:
+        server.stop()
@@ -0,0 +1,147 @@
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import WriteBatcher, buildUpdate, writeUpdates
+from controller_lib.journal import Journal, settleUncertain
+from controller_lib.ruleset import installRuleSet
+from controller_lib.shadow import ShadowStore
+
+
+@pytest.fixture
+def start(tmp_path):
+    """start(snapshot_bytes) -> (journal, shadow, records) recovered from tmp_path.
+
+    Journals are left open, as after a crash, until the test ends.
+    """
+    journals = []
+
+    def start(snapshot_bytes=1 << 20):
+        journal = Journal(str(tmp_path), snapshot_bytes=snapshot_bytes)
+        shadow = ShadowStore(journal=journal)
+        records = journal.recover()
+        journals.append(journal)
+        return journal, shadow, records
+
+    yield start
+    for journal in journals:
+        journal.close()
+
+
+def assertInSync(shadow, sw):
+    result = shadow.audit(sw, repair=False)
+    assert result is not None and result.clean, result
+
+
+def test_a_crash_loses_nothing_that_was_written(start, make_switch, table_entry):
+    sw = make_switch()
+    journal, shadow, records = start()
+    assert records == 0
+    batcher = WriteBatcher(16, observers=[shadow])
+    installRuleSet(sw, [table_entry(i) for i in range(100)], batcher, current=[], shadow=shadow)
+    installRuleSet(sw, [table_entry(i, param=b'\x02') for i in range(50, 150)], batcher,
+                   shadow=shadow)
+    # No close(): the next journal recovers from what reached the disk.
+    # Acks are not waited for, so the last writes may still be uncertain.
+    journal, shadow, records = start()
+    assert records > 0
+    settleUncertain(sw, shadow, journal)
+    assert journal.uncertain() == {}
+    assert shadow.count('s1') == 100
+    assertInSync(shadow, sw)
+
+
+def test_rejected_updates_are_not_replayed(start, make_switch, table_entry):
+    sw = make_switch()
+    journal, shadow, _ = start()
+    batcher = WriteBatcher(observers=[shadow])
+    batcher.add(sw, table_entry(1), p4runtime_pb2.Update.INSERT)
+    batcher.flush()
+    batcher.add(sw, table_entry(1, param=b'\x02'), p4runtime_pb2.Update.INSERT)
+    batcher.add(sw, table_entry(2), p4runtime_pb2.Update.INSERT)
+    assert len(batcher.flush()) == 1
+    journal.close()
+    journal, shadow, _ = start()
+    assert journal.uncertain() == {}
+    assert shadow.count('s1') == 2
+    assertInSync(shadow, sw)
+
+
+def test_a_torn_tail_is_ignored(start, tmp_path, make_switch, table_entry):
+    sw = make_switch()
+    journal, shadow, _ = start()
+    installRuleSet(sw, [table_entry(i) for i in range(10)], WriteBatcher(observers=[shadow]),
+                   current=[], shadow=shadow)
+    journal.close()
+    segment = sorted(p for p in os.listdir(str(tmp_path)) if p.endswith('.log'))[-1]
+    with open(os.path.join(str(tmp_path), segment), 'ab') as f:
+        f.write(b'\x40\x00\x00\x00garbage')
+    journal, shadow, _ = start()
+    assert shadow.count('s1') == 10
+    assertInSync(shadow, sw)
+
+
+def test_intents_without_an_ack_are_settled_from_the_switch(start, make_switch, table_entry):
+    sw = make_switch()
+    journal, shadow, _ = start()
+    installRuleSet(sw, [table_entry(i) for i in range(10)], WriteBatcher(observers=[shadow]),
+                   current=[], shadow=shadow)
+    # Written to the switch, but the controller died before the ack
+    sent = [buildUpdate(table_entry(i, param=b'\x03'), p4runtime_pb2.Update.MODIFY)
+            for i in range(3)] + [buildUpdate(table_entry(20), p4runtime_pb2.Update.INSERT)]
+    journal.intent('s1', sent)
+    writeUpdates(sw, sent)
+    # ... and this one never left the controller
+    journal.intent('s1', [buildUpdate(table_entry(9), p4runtime_pb2.Update.DELETE)])
+
+    journal, shadow, _ = start()
+    assert [len(updates) for _, updates in journal.uncertain()['s1']] == [4, 1]
+    assert not shadow.audit(sw, repair=False).clean
+    assert settleUncertain(sw, shadow, journal) == 5
+    assert journal.uncertain() == {}
+    assertInSync(shadow, sw)
+    # The settlement is journaled as well
+    journal, shadow, _ = start()
+    assert journal.uncertain() == {}
+    assertInSync(shadow, sw)
+
+
+def test_snapshots_bound_recovery_and_prune_old_segments(start, tmp_path, make_switch,
+                                                         table_entry):
+    sw = make_switch()
+    journal, shadow, _ = start(snapshot_bytes=4096)
+    batcher = WriteBatcher(8, observers=[shadow])
+    installRuleSet(sw, [table_entry(i) for i in range(300)], batcher, current=[], shadow=shadow)
+    assert journal.snapshots > 1
+    journal.close()
+    files = os.listdir(str(tmp_path))
+    assert len([p for p in files if p.endswith('.log')]) == 1
+    assert len([p for p in files if p.endswith('.bin')]) == 1
+    journal, shadow, records = start(snapshot_bytes=4096)
+    assert records * 8 < 300
+    assert shadow.count('s1') == 300
+    assertInSync(shadow, sw)
+
+
+def test_a_failing_disk_fails_the_writers_instead_of_blocking_them(start, monkeypatch, make_switch,
+                                                                   table_entry):
+    sw = make_switch()
+    journal, shadow, _ = start()
+
+    def _sync(f):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(journal, '_sync', _sync)
+    updates = [buildUpdate(table_entry(1), p4runtime_pb2.Update.INSERT)]
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with pytest.raises(OSError):
+            pool.submit(journal.intent, 's1', updates).result(timeout=5)
+        # Later writers fail right away, and nothing reaches the switch
+        batcher = WriteBatcher(observers=[shadow])
+        batcher.add(sw, table_entry(2))
+        with pytest.raises(OSError):
+            pool.submit(batcher.flush).result(timeout=5)
+    assert sw.server.servicer.tables == {}
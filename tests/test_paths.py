@@ -0,0 +1,78 @@
+import pytest
+
+from controller_lib.paths import (TUNNEL_INGRESS_TABLE, TUNNEL_TABLE, PathEngine, TunnelIdAllocator,
+                                  meshTunnels, tunnelPathRules)
+
+
+def ring(count):
+    names = ['s%d' % i for i in range(count)]
+    return [dict(a=names[i], a_port=2, b=names[(i + 1) % count], b_port=3) for i in range(count)]
+
+
+def host(i, switch):
+    return {"ip": "10.0.%d.1" % i, "mac": "08:00:00:00:00:%02x" % i, "switch": switch, "port": 1}
+
+
+def test_paths_are_shortest_and_follow_links():
+    engine = PathEngine(ring(6))
+    assert engine.path('s0', 's3') in (['s0', 's1', 's2', 's3'], ['s0', 's5', 's4', 's3'])
+    assert engine.path('s0', 's1') == ['s0', 's1']
+    assert engine.nextHop('s1', 's1') is None
+    assert engine.port('s0', 's1') == 2 and engine.port('s1', 's0') == 3
+
+
+def test_ties_are_broken_the_same_way_every_time():
+    assert PathEngine(ring(6)).path('s0', 's3') == PathEngine(reversed(ring(6))).path('s0', 's3')
+
+
+def test_removing_a_link_reroutes_and_can_disconnect():
+    engine = PathEngine(ring(4))
+    engine.path('s0', 's1')
+    engine.removeLink('s0', 's1')
+    assert engine.path('s0', 's1') == ['s0', 's3', 's2', 's1']
+    engine.removeLink('s2', 's1')
+    assert engine.path('s0', 's1') is None
+    assert engine.nextHop('s0', 's1') is None
+
+
+def test_allocator_hands_out_each_id_once_and_reuses_freed_ones():
+    allocator = TunnelIdAllocator(100, 109)
+    allocator.reserve(103)
+    ids = [allocator.allocate() for _ in range(9)]
+    assert sorted(ids) == [100, 101, 102, 104, 105, 106, 107, 108, 109]
+    with pytest.raises(ValueError):
+        allocator.allocate()
+    allocator.free(105)
+    assert allocator.allocate() == 105
+    with pytest.raises(ValueError):
+        allocator.reserve(105)
+    with pytest.raises(ValueError):
+        allocator.isUsed(110)
+
+
+def test_mesh_has_a_tunnel_from_every_other_reachable_switch():
+    engine = PathEngine(ring(4) + [dict(a='x', a_port=1, b='y', b_port=1)])
+    hosts = {"h0": host(0, 's0'), "h2": host(2, 's2')}
+    tunnels = meshTunnels(engine, hosts, TunnelIdAllocator(100))
+    assert [(t['ingress'], t['egress']) for t in tunnels] == [
+        ('s1', 's0'), ('s2', 's0'), ('s3', 's0'), ('s0', 's2'), ('s1', 's2'), ('s3', 's2')]
+    assert [t['tunnel_id'] for t in tunnels] == list(range(100, 106))
+
+
+def test_tunnel_rules_encapsulate_forward_and_decapsulate_along_the_path():
+    engine = PathEngine(ring(4))
+    tunnel = dict(ingress='s0', egress='s2', tunnel_id=7, dst_eth_addr="08:00:00:00:00:02",
+                  dst_ip_addr="10.0.2.1", switch_to_host_port=1)
+    rules = tunnelPathRules(engine, tunnel)
+    path = engine.path('s0', 's2')
+    assert [sw for sw, _ in rules] == [path[0]] + path
+    assert rules[0][1]["table"] == TUNNEL_INGRESS_TABLE
+    forwards = [rule for _, rule in rules[1:-1]]
+    assert [rule["params"]["port"] for rule in forwards] == [
+        engine.port(a, b) for a, b in zip(path, path[1:])]
+    assert rules[-1][1]["table"] == TUNNEL_TABLE
+    assert rules[-1][1]["action"] == "MyIngress.myTunnel_egress"
+    engine.removeLink('s1', 's2')
+    engine.removeLink('s3', 's2')
+    with pytest.raises(ValueError):
+        tunnelPathRules(engine, tunnel)
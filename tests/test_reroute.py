@@ -0,0 +1,181 @@
+import socket
+
+import pytest
+from p4.v1 import p4runtime_pb2
+
+from controller_lib.batch import WriteBatcher
+from controller_lib.paths import PathEngine, TunnelIdAllocator, meshTunnels, tunnelPathRules
+from controller_lib.reroute import Rerouter, parseEvent
+from controller_lib.ruleset import actionKey, compileRules, entryKey, installRuleSet, readCurrentEntries
+
+IDS = {
+    'MyIngress.ipv4_lpm': 1, 'MyIngress.myTunnel_exact': 2,
+    'MyIngress.myTunnel_ingress': 10, 'MyIngress.myTunnel_forward': 11,
+    'MyIngress.myTunnel_egress': 12,
+}
+
+
+class Helper(object):
+    """Just enough of P4InfoHelper.buildTableEntry for the tunnel rules."""
+
+    def buildTableEntry(self, table_name, match_fields=None, default_action=False,
+                        action_name=None, action_params=None, priority=None):
+        entry = p4runtime_pb2.TableEntry(table_id=IDS[table_name])
+        for field_id, (_, value) in enumerate(sorted((match_fields or {}).items()), 1):
+            match = entry.match.add(field_id=field_id)
+            if isinstance(value, tuple):
+                match.lpm.value = socket.inet_aton(value[0])
+                match.lpm.prefix_len = value[1]
+            else:
+                match.exact.value = value.to_bytes(2, 'big')
+        entry.action.action.action_id = IDS[action_name]
+        for param_id, (_, value) in enumerate(sorted((action_params or {}).items()), 1):
+            value = value.encode() if isinstance(value, str) else value.to_bytes(2, 'big')
+            entry.action.action.params.add(param_id=param_id, value=value)
+        return entry
+
+
+class UpdateRecorder(object):
+    def __init__(self):
+        self.types = []
+
+    def beforeWrite(self, sw, updates):
+        self.types.extend(update.type for update in updates)
+
+    def afterWrite(self, sw, updates, errors):
+        pass
+
+
+def pathRules(engine, tunnels, names):
+    rules = dict((name, []) for name in names)
+    for tunnel in tunnels:
+        for sw_name, rule in tunnelPathRules(engine, tunnel):
+            rules[sw_name].append(rule)
+    return rules
+
+
+def contents(entries):
+    return sorted((entryKey(e), actionKey(e)) for e in entries)
+
+
+@pytest.fixture
+def network(make_switch):
+    """Six switches in a ring with a chord s0-s3, full tunnel mesh installed."""
+    names = ['s%d' % i for i in range(6)]
+    links = [dict(a=names[i], a_port=2, b=names[(i + 1) % 6], b_port=3) for i in range(6)]
+    links.append(dict(a='s0', a_port=4, b='s3', b_port=4))
+    hosts = dict(('h%d' % i, {"ip": "10.0.%d.1" % i, "mac": "08:00:00:00:00:%02x" % i,
+                              "switch": name, "port": 1}) for i, name in enumerate(names))
+    helper = Helper()
+    engine = PathEngine(links)
+    tunnels = meshTunnels(engine, hosts, TunnelIdAllocator(100))
+    desired = compileRules(helper, pathRules(engine, tunnels, names))
+    switches = dict((name, make_switch(name)) for name in names)
+    for name in names:
+        assert installRuleSet(switches[name], desired[name], WriteBatcher(), current=[]).ok
+    recorder = UpdateRecorder()
+    rerouter = Rerouter(helper, engine, tunnels, links, lambda: switches, desired,
+                        observers=[recorder])
+
+    class Network(object):
+        pass
+
+    net = Network()
+    net.__dict__.update(names=names, links=links, helper=helper, engine=engine, tunnels=tunnels,
+                        desired=desired, switches=switches, rerouter=rerouter, recorder=recorder)
+    return net
+
+
+def assertConverged(net):
+    """Switches hold desired, and desired is what the current topology gives."""
+    fresh = compileRules(net.helper, pathRules(net.engine, net.tunnels, net.names))
+    for name in net.names:
+        installed = contents(readCurrentEntries(net.switches[name]))
+        assert installed == contents(net.desired[name]), name
+        assert installed == contents(fresh[name]), name
+
+
+def test_link_down_moves_only_the_tunnels_that_crossed_it(network):
+    paths = [network.engine.path(t['ingress'], t['egress']) for t in network.tunnels]
+    crossing = [p for p in paths if ('s0', 's3') in zip(p, p[1:]) or ('s3', 's0') in zip(p, p[1:])]
+    result = network.rerouter.handle(parseEvent('link-down s0 s3'))
+    assert result.ok
+    assert result.tunnels == len(crossing) > 0
+    assertConverged(network)
+
+
+def test_updates_are_make_before_break(network):
+    network.rerouter.handle(parseEvent('link-down s0 s3'))
+    types = network.recorder.types
+    assert types, "the chord carries tunnels, so something must move"
+    order = [p4runtime_pb2.Update.INSERT, p4runtime_pb2.Update.MODIFY, p4runtime_pb2.Update.DELETE]
+    assert [order.index(t) for t in types] == sorted(order.index(t) for t in types)
+
+
+def test_link_up_restores_the_original_paths(network):
+    before = dict((name, contents(readCurrentEntries(sw))) for name, sw in network.switches.items())
+    network.rerouter.handle(parseEvent('link-down s0 s3'))
+    network.rerouter.handle(parseEvent('port-down s1 2'))
+    network.rerouter.handle(parseEvent('port-up s1 2'))
+    network.rerouter.handle(parseEvent('link-up s0 s3'))
+    assertConverged(network)
+    after = dict((name, contents(readCurrentEntries(sw))) for name, sw in network.switches.items())
+    assert after == before
+
+
+def test_an_event_that_changes_nothing_writes_nothing(network):
+    network.rerouter.handle(parseEvent('link-down s0 s3'))
+    del network.recorder.types[:]
+    result = network.rerouter.handle(parseEvent('link-down s0 s3'))
+    assert result.tunnels == 0 and result.updates == 0
+    assert network.recorder.types == []
+
+
+def test_unreachable_tunnels_keep_their_entries(network):
+    to_s4 = [t['tunnel_id'] for t in network.tunnels if t['egress'] == 's4']
+    network.rerouter.handle(parseEvent('link-down s3 s4'))
+    before = dict((tid, dict(network.rerouter.installed[tid])) for tid in to_s4)
+    entries = contents(readCurrentEntries(network.switches['s4']))
+    result = network.rerouter.handle(parseEvent('link-down s4 s5'))
+    assert set(to_s4) <= set(result.unreachable)
+    # Nothing can reach s4, so its tunnels stay where they were
+    assert dict((tid, network.rerouter.installed[tid]) for tid in to_s4) == before
+    installed = contents(readCurrentEntries(network.switches['s4']))
+    assert [e for e in entries if e[1][0] == 12] == [e for e in installed if e[1][0] == 12]
+    network.rerouter.handle(parseEvent('link-up s4 s5'))
+    network.rerouter.handle(parseEvent('link-up s3 s4'))
+    assertConverged(network)
+
+
+def test_a_dead_switch_is_routed_around_without_writing_to_it(network, make_switch):
+    network.switches['s1'].server.stop()
+    result = network.rerouter.handle(parseEvent('switch-down s1'))
+    assert result.ok and result.tunnels > 0
+    assert 's1' not in result.switches
+    for tunnel_id, rules in network.rerouter.installed.items():
+        tunnel = network.rerouter.tunnels[tunnel_id]
+        if 's1' not in (tunnel['ingress'], tunnel['egress']):
+            assert 's1' not in rules, tunnel_id
+    # The next event does not go back to s1 either
+    assert network.rerouter.handle(parseEvent('link-down s3 s4')).ok
+    network.rerouter.handle(parseEvent('link-up s3 s4'))
+
+    # s1 reboots with empty tables and is resynced before it is reported up
+    network.switches['s1'] = make_switch('s1')
+    assert installRuleSet(network.switches['s1'], network.desired['s1'], WriteBatcher(),
+                          current=[]).ok
+    assert network.rerouter.handle(parseEvent('switch-up s1')).ok
+    assertConverged(network)
+
+
+def test_a_switch_can_come_back_with_its_old_entries(network):
+    before = contents(readCurrentEntries(network.switches['s1']))
+    assert network.rerouter.handle(parseEvent('switch-down s1')).ok
+    assert contents(readCurrentEntries(network.switches['s1'])) == before
+    assert network.rerouter.handle(parseEvent('switch-up s1')).ok
+    assertConverged(network)
+
+
+def test_unknown_links_are_rejected(network):
+    with pytest.raises(ValueError):
+        network.rerouter.handle(parseEvent('link-down s0 s2'))
@@ -0,0 +1,105 @@
+import random
+
+from controller_lib.route_compiler import (LPM_FIELD, LPM_TABLE, RouteCompiler, aggregateLpmRules,
+                                           aggregationReport, ipToInt)
+
+
+def lookup(routes, address):
+    """Longest-prefix match over {(prefix, prefix_len): action}."""
+    best_len, best = -1, None
+    for (prefix, prefix_len), action in routes.items():
+        mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+        if address & mask == prefix and prefix_len > best_len:
+            best_len, best = prefix_len, action
+    return best
+
+
+def randomRoutes(rng, count, actions=('a', 'b')):
+    base = ipToInt('10.0.0.0')
+    routes = {}
+    for _ in range(count):
+        prefix_len = rng.randint(24, 30)
+        mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+        routes[(base + rng.randrange(256)) & mask, prefix_len] = rng.choice(actions)
+    return routes
+
+
+def assertEquivalent(routes, compiled):
+    base = ipToInt('10.0.0.0')
+    for address in range(base - 4, base + 260):
+        assert lookup(compiled, address) == lookup(routes, address), address
+
+
+def test_siblings_with_the_same_action_merge_into_the_parent():
+    compiler = RouteCompiler()
+    compiler.setRoute('10.0.0.0', 25, 'a')
+    compiler.setRoute('10.0.0.128', 25, 'a')
+    assert compiler.compile() == {(ipToInt('10.0.0.0'), 24): 'a'}
+
+
+def test_uncovered_space_is_not_merged_over():
+    compiler = RouteCompiler()
+    compiler.setRoute('10.0.0.0', 26, 'a')
+    compiler.setRoute('10.0.0.128', 26, 'a')
+    assert len(compiler.compile()) == 2
+
+
+def test_redundant_more_specific_route_is_dropped():
+    compiler = RouteCompiler()
+    compiler.setRoute('10.0.0.0', 24, 'a')
+    compiler.setRoute('10.0.0.64', 26, 'a')
+    compiler.setRoute('10.0.0.128', 26, 'b')
+    assert compiler.compile() == {(ipToInt('10.0.0.0'), 24): 'a', (ipToInt('10.0.0.128'), 26): 'b'}
+
+
+def test_random_route_sets_compile_to_an_equivalent_table():
+    rng = random.Random(1)
+    for _ in range(50):
+        routes = randomRoutes(rng, rng.randint(1, 40))
+        compiler = RouteCompiler()
+        for (prefix, prefix_len), action in routes.items():
+            compiler.setRoute(prefix, prefix_len, action)
+        compiled = compiler.compile()
+        assert len(compiled) <= len(routes)
+        assertEquivalent(routes, compiled)
+
+
+def test_incremental_updates_match_a_fresh_compilation():
+    rng = random.Random(2)
+    routes = randomRoutes(rng, 30)
+    compiler = RouteCompiler()
+    for (prefix, prefix_len), action in routes.items():
+        compiler.setRoute(prefix, prefix_len, action)
+    table = compiler.compile()
+    for _ in range(200):
+        key = rng.choice(list(routes)) if routes and rng.random() < 0.4 else None
+        if key is not None:
+            compiler.removeRoute(*key)
+            del routes[key]
+        else:
+            new = randomRoutes(rng, 1)
+            routes.update(new)
+            for (prefix, prefix_len), action in new.items():
+                compiler.setRoute(prefix, prefix_len, action)
+        inserts, modifies, deletes = compiler.update()
+        for key in deletes:
+            del table[key]
+        for key, action in inserts + modifies:
+            table[key] = action
+        fresh = RouteCompiler()
+        for (prefix, prefix_len), action in routes.items():
+            fresh.setRoute(prefix, prefix_len, action)
+        assert table == fresh.compile()
+
+
+def test_aggregate_lpm_rules_keeps_other_rules_first():
+    other = {"table": "MyIngress.check_ports", "match": {"port": 1}, "action": "NoAction"}
+    rules = [other] + [
+        {"table": LPM_TABLE, "match": {LPM_FIELD: ["10.0.0.%d" % start, 25]},
+         "action": "MyIngress.ipv4_forward", "params": {"port": 2}}
+        for start in (0, 128)]
+    aggregated = aggregateLpmRules(rules)
+    assert aggregated[0] == other
+    assert [rule["match"] for rule in aggregated[1:]] == [{LPM_FIELD: ["10.0.0.0", 24]}]
+    assert aggregationReport({"s1": rules}, {"s1": aggregated}) == [
+        "s1: %s 2 routes -> 1 entries" % LPM_TABLE]
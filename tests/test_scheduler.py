@@ -0,0 +1,173 @@
+import grpc
+import pytest
+from google.rpc import code_pb2
+from p4.v1 import p4runtime_pb2
+
+import controller_lib.scheduler as scheduler
+from benchmarks.fake_p4runtime import FakeP4RuntimeServicer, _WriteFailed
+from controller_lib.scheduler import WriteScheduler
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """The backoff attempts the scheduler asked for; the tests do not sleep."""
+    attempts = []
+
+    def backoffDelay(attempt):
+        attempts.append(attempt)
+        return 0.0
+
+    monkeypatch.setattr(scheduler, 'backoffDelay', backoffDelay)
+    return attempts
+
+
+def recordWrites(monkeypatch, code=None, count=0, apply_first=False):
+    """Fail the first count Write RPCs as a whole with code; returns the table ids of each."""
+    write = FakeP4RuntimeServicer.Write
+    calls = []
+
+    def Write(self, request, context):
+        calls.append([u.entity.table_entry.table_id for u in request.updates])
+        if len(calls) <= count:
+            if apply_first:
+                write(self, request, context)
+            context.abort(code, 'injected')
+        return write(self, request, context)
+
+    monkeypatch.setattr(FakeP4RuntimeServicer, 'Write', Write)
+    return calls
+
+
+def installed(sw):
+    return sum(len(table) for table in sw.server.servicer.tables.values())
+
+
+def test_batch_size_must_be_positive():
+    with pytest.raises(ValueError):
+        WriteScheduler(0)
+
+
+def test_defaults_then_critical_tables_then_the_rest(monkeypatch, make_switch, table_entry):
+    calls = recordWrites(monkeypatch)
+    sw = make_switch()
+    writer = WriteScheduler(4, priorities={3: scheduler.PRIORITY_CRITICAL})
+    for i in range(10):
+        writer.add(sw, table_entry(i, table_id=7))
+    for i in range(5):
+        writer.add(sw, table_entry(i, table_id=3))
+    default = p4runtime_pb2.TableEntry(table_id=9, is_default_action=True)
+    default.action.action.action_id = 1
+    writer.add(sw, default, p4runtime_pb2.Update.MODIFY)
+    assert writer.flush() == []
+    assert [table_id for call in calls for table_id in call] == [9] + [3] * 5 + [7] * 10
+    # A WriteRequest never mixes priorities
+    assert all(len(set(call)) == 1 for call in calls)
+
+
+def test_deletes_free_table_space_before_inserts_use_it(monkeypatch, make_switch, table_entry):
+    apply = FakeP4RuntimeServicer._applyUpdate
+
+    def _applyUpdate(self, update):
+        table = self.tables.get(update.entity.table_entry.table_id, {})
+        if update.type == p4runtime_pb2.Update.INSERT and len(table) >= 8:
+            raise _WriteFailed(code_pb2.RESOURCE_EXHAUSTED)
+        apply(self, update)
+
+    monkeypatch.setattr(FakeP4RuntimeServicer, '_applyUpdate', _applyUpdate)
+    sw = make_switch()
+    writer = WriteScheduler(2)
+    for i in range(8):
+        writer.add(sw, table_entry(i))
+    assert writer.flush() == []
+    # Queued in the wrong order: the table only has room once the deletes are done
+    for i in range(8, 12):
+        writer.add(sw, table_entry(i))
+    for i in range(4):
+        writer.add(sw, table_entry(i, param=b'\x02'), p4runtime_pb2.Update.MODIFY)
+    for i in range(4, 8):
+        writer.add(sw, table_entry(i), p4runtime_pb2.Update.DELETE)
+    types = []
+
+    class Recorder(object):
+        def beforeWrite(self, sw, updates):
+            types.append(set(update.type for update in updates))
+
+        def afterWrite(self, sw, updates, errors):
+            pass
+
+    writer.observers.append(Recorder())
+    assert writer.flush() == []
+    assert installed(sw) == 8
+    assert types == [set([p4runtime_pb2.Update.DELETE])] * 2 + \
+        [set([p4runtime_pb2.Update.MODIFY])] * 2 + [set([p4runtime_pb2.Update.INSERT])] * 2
+
+
+def test_backpressure_is_retried_with_growing_backoff(monkeypatch, delays, make_switch,
+                                                      table_entry):
+    calls = recordWrites(monkeypatch, grpc.StatusCode.RESOURCE_EXHAUSTED, 3)
+    sw = make_switch()
+    writer = WriteScheduler(10)
+    for i in range(10):
+        writer.add(sw, table_entry(i))
+    assert writer.flush() == []
+    assert installed(sw) == 10
+    assert len(calls) == 4
+    assert delays == [0, 1, 2]
+    state = writer.state['s1']
+    assert (state.backoffs, state.retries, state.writes) == (3, 30, 1)
+
+
+def test_backpressure_gives_up_after_max_retries(monkeypatch, delays, make_switch, table_entry):
+    calls = recordWrites(monkeypatch, grpc.StatusCode.UNAVAILABLE, 100)
+    sw = make_switch()
+    writer = WriteScheduler(10, max_retries=2)
+    for i in range(5):
+        writer.add(sw, table_entry(i))
+    errors = writer.flush()
+    assert len(errors) == 5 and len(calls) == 3
+    assert set(error.code for error in errors) == set([grpc.StatusCode.UNAVAILABLE])
+    assert installed(sw) == 0
+
+
+def test_a_full_table_is_final_and_not_retried(monkeypatch, delays, make_switch, table_entry):
+    apply = FakeP4RuntimeServicer._applyUpdate
+
+    def _applyUpdate(self, update):
+        if len(self.tables.get(update.entity.table_entry.table_id, {})) >= 8:
+            raise _WriteFailed(code_pb2.RESOURCE_EXHAUSTED)
+        apply(self, update)
+
+    monkeypatch.setattr(FakeP4RuntimeServicer, '_applyUpdate', _applyUpdate)
+    sw = make_switch()
+    writer = WriteScheduler(4)
+    for i in range(20):
+        writer.add(sw, table_entry(i))
+    errors = writer.flush()
+    assert len(errors) == 12
+    assert set(error.code for error in errors) == set([grpc.StatusCode.RESOURCE_EXHAUSTED])
+    assert installed(sw) == 8
+    assert delays == []
+    assert (writer.state['s1'].backoffs, writer.state['s1'].retries) == (0, 0)
+
+
+def test_a_replayed_write_that_had_landed_is_not_an_error(monkeypatch, delays, make_switch,
+                                                          table_entry):
+    # The first Write is applied, but the reply is lost
+    recordWrites(monkeypatch, grpc.StatusCode.UNAVAILABLE, 1, apply_first=True)
+    sw = make_switch()
+    writer = WriteScheduler(10)
+    for i in range(5):
+        writer.add(sw, table_entry(i))
+    assert writer.flush() == []
+    assert installed(sw) == 5
+
+
+def test_other_whole_rpc_failures_are_raised(monkeypatch, delays, make_switch, table_entry):
+    recordWrites(monkeypatch, grpc.StatusCode.PERMISSION_DENIED, 1)
+    sw = make_switch()
+    writer = WriteScheduler(10)
+    writer.add(sw, table_entry(1))
+    with pytest.raises(grpc.RpcError) as raised:
+        writer.flush()
+    assert raised.value.code() == grpc.StatusCode.PERMISSION_DENIED
+    assert delays == []
@@ -0,0 +1,91 @@
+import numpy as np
+
+from controller_lib.tsdb import COMPACT_FRACTION, CounterStore, counterDeltas, rates
+
+T0 = 1000020.0
+COUNTER = 'MyIngress.ingressTunnelCounter'
+LEVELS = (('raw', 0, 10 ** 9), ('1m', 60, 10 ** 9))
+
+
+def test_deltas_handle_wraps_and_resets():
+    previous = np.array([10, 250, 100], dtype='<u8')
+    current = np.array([15, 5, 3], dtype='<u8')
+    # 250 -> 5 is a wrap of an 8-bit counter, 100 -> 3 a reset
+    assert list(counterDeltas(previous, current, width=8)) == [5, 11, 3]
+
+
+def test_totals_keep_growing_across_a_reset(tmp_path):
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    readings = [0, 10, 30, 5, 25]
+    for k, packets in enumerate(readings):
+        store.record('s1', COUNTER, T0 + k, {7: (packets, packets * 100)}, [7])
+    times, packets, bytes_ = store.series('s1', COUNTER, 7)
+    assert list(packets) == [0, 10, 30, 35, 55]
+    assert list(bytes_) == [0, 1000, 3000, 3500, 5500]
+    assert list(rates(times, packets)) == [10.0, 20.0, 5.0, 20.0]
+
+
+def test_rollups_hold_period_totals_and_peak_rates(tmp_path):
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    total = 0
+    for k in range(90):
+        # 2 s samples for 3 minutes, with one burst in the second minute
+        total += 100 if k == 40 else 10
+        store.record('s1', COUNTER, T0 + 2 * k, {7: (total, total)}, [7])
+    indices, rows = store.query('s1', COUNTER, level='1m')
+    assert list(indices) == [7]
+    # The last minute is still open
+    assert list(rows['time']) == [T0, T0 + 60]
+    _, raw = store.query('s1', COUNTER, end=T0 + 120)
+    assert list(rows['packets'][:, 0]) == [raw['packets'][29, 0], raw['packets'][59, 0]]
+    assert list(rows['peak_pps'][:, 0]) == [5.0, 50.0]
+
+
+def test_queries_are_views_of_the_file(tmp_path):
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    for k in range(10):
+        store.record('s1', COUNTER, T0 + k, {1: (k, k), 2: (2 * k, 2 * k)}, [1, 2])
+    _, rows = store.query('s1', COUNTER, T0 + 2, T0 + 5)
+    assert list(rows['time']) == [T0 + 2, T0 + 3, T0 + 4]
+    _, packets, _ = store.series('s1', COUNTER, 2)
+    assert not rows.flags.owndata and not packets.flags.owndata
+    assert np.shares_memory(rows, packets)
+
+
+def test_old_rows_are_compacted_away(tmp_path):
+    retention = 600
+    store = CounterStore(str(tmp_path), levels=(('raw', 0, retention),))
+    for k in range(5000):
+        store.record('s1', COUNTER, T0 + 2 * k, {1: (k, k)}, [1])
+    last = T0 + 2 * 4999
+    _, rows = store.query('s1', COUNTER)
+    assert len(rows) <= retention / 2 / (1 - COMPACT_FRACTION) + 1
+    assert rows['time'][-1] == last
+    assert len(store.query('s1', COUNTER, last - retention)[1]) == retention // 2 + 1
+
+
+def test_changed_indices_keep_their_history(tmp_path):
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    store.record('s1', COUNTER, T0, {1: (0, 0), 2: (0, 0)}, [1, 2])
+    store.record('s1', COUNTER, T0 + 1, {1: (5, 5), 2: (7, 7)}, [1, 2])
+    store.record('s1', COUNTER, T0 + 2, {2: (9, 9), 3: (4, 4)}, [2, 3])
+    store.record('s1', COUNTER, T0 + 3, {2: (10, 10), 3: (6, 6)}, [2, 3])
+    indices, rows = store.query('s1', COUNTER)
+    assert list(indices) == [1, 2, 3]
+    assert rows['packets'].tolist() == [[0, 0, 0], [5, 7, 0], [5, 7, 0], [5, 8, 2]]
+
+
+def test_a_restart_continues_from_the_totals_on_disk(tmp_path):
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    for k in range(5):
+        store.record('s1', COUNTER, T0 + k, {1: (10 * k, k)}, [1])
+    store.flush()
+
+    store = CounterStore(str(tmp_path), levels=LEVELS)
+    _, rows = store.query('s1', COUNTER)
+    assert list(rows['packets'][:, 0]) == [0, 10, 20, 30, 40]
+    # The traffic between the last sample before and the first after is lost
+    store.record('s1', COUNTER, T0 + 10, {1: (1000, 0)}, [1])
+    store.record('s1', COUNTER, T0 + 11, {1: (1010, 0)}, [1])
+    _, packets, _ = store.series('s1', COUNTER, 1)
+    assert list(packets) == [0, 10, 20, 30, 40, 40, 50]